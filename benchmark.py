@@ -0,0 +1,339 @@
+import argparse
+import json
+import os
+import random
+import re
+import socket
+import struct
+import subprocess
+import sys
+import tempfile
+import time
+from multiprocessing import Pool
+
+from dnslib import DNSRecord, RCODE
+
+import server
+
+SERVER_SCRIPT = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'server.py')
+BENCHMARK_DOMAIN = 'bench.test'
+QUERY_KINDS = ['hit', 'miss', 'cname']
+DEFAULT_MIX = 'hit=0.8,miss=0.1,cname=0.1'
+SERVER_START_TIMEOUT = 30.0
+SERVER_POLL_INTERVAL = 0.01
+# seconds from starting a headless server.py to its first answer (see test_server.ColdStartTestCase)
+COLD_START_BUDGET = 2.0
+QUERY_TIMEOUT = 2.0
+
+
+def record_name(position):
+    return 'host-%d.%s' % (position, BENCHMARK_DOMAIN)
+
+
+def alias_name(position):
+    return 'alias-%d.%s' % (position, BENCHMARK_DOMAIN)
+
+
+def seed_records(directory, zone_size, zone_file=False):
+    # synthetic zone: zone_size A records plus one CNAME per ten of them pointing at an A record
+    records = [server.DNSResourceRecord(record_name(position), 'IN', 'A',
+                                        '10.%d.%d.%d' % (position >> 16 & 255, position >> 8 & 255, position & 255))
+               for position in range(zone_size)]
+    records += [server.DNSResourceRecord(alias_name(position), 'IN', 'CNAME', record_name(position))
+                for position in range(max(1, zone_size // 10))]
+    records_path = os.path.join(directory, server.PERSISTENT_RECORDS)
+    store = server.RecordStore(records_path)
+    store.apply([('add', record) for record in records])
+    store.compact()
+    if zone_file:
+        server.convert_records(records_path, os.path.join(directory, 'records.zone'))
+    return len(records)
+
+
+def parse_mix(text):
+    mix = {}
+    for item in text.split(','):
+        kind, _, weight = item.partition('=')
+        if kind not in QUERY_KINDS:
+            raise ValueError('unknown query kind %r (expected one of %s)' % (kind, ', '.join(QUERY_KINDS)))
+        mix[kind] = float(weight)
+    return mix
+
+
+def query_names(mix, zone_size, count, seed):
+    # the names a client asks for, drawn in advance so that the timed loop only sends and receives
+    generator = random.Random(seed)
+    kinds = generator.choices(list(mix), weights=list(mix.values()), k=count)
+    names = []
+    for kind in kinds:
+        if kind == 'hit':
+            names.append(record_name(generator.randrange(zone_size)))
+        elif kind == 'cname':
+            names.append(alias_name(generator.randrange(max(1, zone_size // 10))))
+        else:
+            names.append('missing-%d.%s' % (generator.randrange(1 << 30), BENCHMARK_DOMAIN))
+    return names
+
+
+def send_udp(sock, address, packet):
+    sock.sendto(packet, address)
+    return sock.recv(65535)
+
+
+def send_tcp(sock, address, packet):
+    sock.sendall(struct.pack('>H', len(packet)) + packet)
+    buffer = b''
+    while len(buffer) < 2 or len(buffer) < 2 + struct.unpack('>H', buffer[:2])[0]:
+        chunk = sock.recv(65535)
+        if not chunk:
+            raise ConnectionError('connection closed by the server')
+        buffer += chunk
+    return buffer[2:]
+
+
+def run_client(job):
+    # one load client: sends its queries one after another and reports the latency of each answer
+    address, protocol, names, duration = job
+    if protocol == 'tcp':
+        sock, send = socket.create_connection(address, timeout=QUERY_TIMEOUT), send_tcp
+    else:
+        sock, send = socket.socket(socket.AF_INET, socket.SOCK_DGRAM), send_udp
+        sock.settimeout(QUERY_TIMEOUT)
+    packets = [DNSRecord.question(name, 'A').pack() for name in names]
+    latencies, errors, rcodes = [], 0, {}
+    started_at = time.time()
+    deadline = started_at + duration
+    try:
+        for packet in packets:
+            if time.time() >= deadline:
+                break
+            started = time.perf_counter()
+            try:
+                response = send(sock, address, packet)
+            except (socket.timeout, ConnectionError):
+                errors += 1
+                continue
+            latencies.append(time.perf_counter() - started)
+            rcode = RCODE.get(response[3] & 0xF)
+            rcodes[str(rcode)] = rcodes.get(str(rcode), 0) + 1
+    finally:
+        sock.close()
+    return latencies, errors, rcodes, started_at, time.time()
+
+
+def percentile(values, fraction):
+    if not values:
+        return None
+    return values[min(len(values) - 1, int(fraction * len(values)))]
+
+
+def wait_for_server(address, process):
+    deadline = time.time() + SERVER_START_TIMEOUT
+    packet = DNSRecord.question(record_name(0), 'A').pack()
+    sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    sock.settimeout(SERVER_POLL_INTERVAL)
+    try:
+        while time.time() < deadline:
+            if process.poll() is not None:
+                raise RuntimeError('server.py exited with status %d' % process.returncode)
+            try:
+                send_udp(sock, address, packet)
+                return
+            except OSError:
+                pass
+        raise RuntimeError('server.py did not answer within %.0f seconds' % SERVER_START_TIMEOUT)
+    finally:
+        sock.close()
+
+
+def start_server(directory, port, zone_file=False, server_args=(), stdout=subprocess.DEVNULL):
+    # returns the server process and its cold start: the seconds until it answered a first query
+    command = [sys.executable, SERVER_SCRIPT, '--headless', '--register_port', '0', '--request_port', str(port),
+               '--tcp', '1', '--query_log_level', 'off']
+    if zone_file:
+        command += ['--zone_file', 'records.zone']
+    started = time.perf_counter()
+    process = subprocess.Popen(command + list(server_args), cwd=directory, stdin=subprocess.DEVNULL,
+                               stdout=stdout, stderr=subprocess.DEVNULL)
+    try:
+        wait_for_server(('127.0.0.1', port), process)
+    except Exception:
+        stop_server(process)
+        raise
+    return process, time.perf_counter() - started
+
+
+def stop_server(process):
+    process.terminate()
+    try:
+        process.wait(10)
+    except subprocess.TimeoutExpired:
+        process.kill()
+        process.wait()
+
+
+def free_port():
+    with socket.socket(socket.AF_INET, socket.SOCK_DGRAM) as sock:
+        sock.bind(('127.0.0.1', 0))
+        return sock.getsockname()[1]
+
+
+def run_benchmark(zone_size, protocol='udp', clients=4, duration=5.0, queries=100000, mix=DEFAULT_MIX,
+                  zone_file=False, server_args=(), seed=0):
+    # seeds a synthetic zone, starts server.py on loopback and loads it from `clients` processes
+    mix = parse_mix(mix) if isinstance(mix, str) else mix
+    with tempfile.TemporaryDirectory() as directory:
+        seeded = seed_records(directory, zone_size, zone_file)
+        port = free_port()
+        process, cold_start = start_server(directory, port, zone_file, server_args)
+        try:
+            address = ('127.0.0.1', port)
+            jobs = [(address, protocol, query_names(mix, zone_size, queries, seed + client), duration)
+                    for client in range(clients)]
+            with Pool(clients) as pool:
+                results = pool.map(run_client, jobs)
+        finally:
+            stop_server(process)
+
+    # the load window runs from the first client starting to send until the last one is done
+    elapsed = max(result[4] for result in results) - min(result[3] for result in results)
+    latencies = sorted(latency for result in results for latency in result[0])
+    rcodes = {}
+    for result in results:
+        for rcode, count in result[2].items():
+            rcodes[rcode] = rcodes.get(rcode, 0) + count
+    return {
+        'zone_size': zone_size,
+        'records': seeded,
+        'protocol': protocol,
+        'clients': clients,
+        'mix': mix,
+        'zone_file': zone_file,
+        'server_args': list(server_args),
+        'cold_start_ms': round(cold_start * 1000, 1),
+        'elapsed': round(elapsed, 3),
+        'answered': len(latencies),
+        'errors': sum(result[1] for result in results),
+        'rcodes': rcodes,
+        'qps': round(len(latencies) / elapsed, 1) if elapsed else 0.0,
+        'p50_ms': round(percentile(latencies, 0.5) * 1000, 3) if latencies else None,
+        'p99_ms': round(percentile(latencies, 0.99) * 1000, 3) if latencies else None,
+        'p999_ms': round(percentile(latencies, 0.999) * 1000, 3) if latencies else None,
+    }
+
+
+# the registration validators as they were before validate_domain_entries, kept as the validation baseline
+LEGACY_AAAA = (r"(([0-9a-fA-F]{1,4}:){7,7}[0-9a-fA-F]{1,4}|([0-9a-fA-F]{1,4}:){1,7}:|([0-9a-fA-F]{1,4}:){1,"
+               r"6}:[0-9a-fA-F]{1,4}|([0-9a-fA-F]{1,4}:){1,5}(:[0-9a-fA-F]{1,4}){1,2}|([0-9a-fA-F]{1,4}:){1,"
+               r"4}(:[0-9a-fA-F]{1,4}){1,3}|([0-9a-fA-F]{1,4}:){1,3}(:[0-9a-fA-F]{1,4}){1,4}|([0-9a-fA-F]{1,4}:){1,"
+               r"2}(:[0-9a-fA-F]{1,4}){1,5}|[0-9a-fA-F]{1,4}:((:[0-9a-fA-F]{1,4}){1,6})|:((:[0-9a-fA-F]{1,4}){1,"
+               r"7}|:)|fe80:(:[0-9a-fA-F]{0,4}){0,4}%[0-9a-zA-Z]{1,}|::(ffff(:0{1,4}){0,1}:){0,1}((25[0-5]|(2["
+               r"0-4]|1{0,1}[0-9]){0,1}[0-9])\.){3,3}(25[0-5]|(2[0-4]|1{0,1}[0-9]){0,1}[0-9])|([0-9a-fA-F]{1,4}:){1,"
+               r"4}:((25[0-5]|(2[0-4]|1{0,1}[0-9]){0,1}[0-9])\.){3,3}(25[0-5]|(2[0-4]|1{0,1}[0-9]){0,1}[0-9]))")
+
+
+def legacy_validate_name(name):
+    if not name or len(name) > 255 or any(len(label) > 63 for label in name.split('.')):
+        return None
+    if not re.match(r"^[a-zA-Z]", name) or not re.match(r".*[a-zA-Z.]$", name) or re.match(r".*[^\w\.\-]", name):
+        return None
+    return name
+
+
+def legacy_validate_new_domain(entry):
+    fields = entry.split()
+    if len(fields) != 4 or legacy_validate_name(fields[0]) is None:
+        return None
+    if fields[1] not in ('IN', 'CS', 'CH', 'Hesiod', 'None', '*') or fields[2] not in ('A', 'CNAME', 'TXT', 'AAAA'):
+        return None
+    data = fields[3]
+    if fields[2] == 'A' and not re.match(r"^((25[0-5]|(2[0-4]|1[0-9]|[1-9]|)[0-9])(\.(?!$)|$)){4}$", data):
+        return None
+    if fields[2] == 'AAAA' and not re.match(LEGACY_AAAA, data):
+        return None
+    if fields[2] == 'CNAME' and legacy_validate_name(data) is None:
+        return None
+    if fields[2] == 'TXT' and not re.match(r".*[=]", data):
+        return None
+    return {'domain_name': fields[0], 'class': fields[1], 'qtype': fields[2], 'data': data, 'ttl': 3600}
+
+
+def validation_entries(count):
+    entries = []
+    for position in range(count):
+        kind = position % 4
+        if kind == 0:
+            entries.append('host-%d.%s IN A 10.%d.%d.%d' % (position, BENCHMARK_DOMAIN, position >> 16 & 255,
+                                                              position >> 8 & 255, position & 255))
+        elif kind == 1:
+            entries.append('v6-%d.%s IN AAAA 2001:db8::%x:%x' % (position, BENCHMARK_DOMAIN, position >> 16,
+                                                                 position & 0xffff))
+        elif kind == 2:
+            entries.append('alias-%d.%s IN CNAME %s' % (position, BENCHMARK_DOMAIN, record_name(position)))
+        else:
+            entries.append('txt-%d.%s IN TXT key=value%d' % (position, BENCHMARK_DOMAIN, position))
+    return entries
+
+
+def benchmark_validation(count, processes=0):
+    # entries/s of the former per-entry validators, the current ones and the batch API
+    entries = validation_entries(count)
+    rates = {}
+    for label, validate in [('legacy', lambda: [legacy_validate_new_domain(entry) for entry in entries]),
+                            ('per_entry', lambda: [server.validate_new_domain(entry) for entry in entries]),
+                            ('batch', lambda: list(server.validate_domain_entries(entries, processes)))]:
+        started = time.perf_counter()
+        results = validate()
+        rates[label] = round(count / (time.perf_counter() - started), 1)
+        if any(result is None for result in results):
+            raise RuntimeError('%s validation rejected valid entries' % label)
+    return {'entries': count, 'processes': processes, 'entries_per_s': rates,
+            'speedup': round(rates['batch'] / rates['legacy'], 2)}
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Load generator and benchmark for server.py.')
+    parser.add_argument('--zone_sizes', default='100,10000,100000',
+                        help='Comma separated zone sizes, each benchmarked against a freshly seeded server.')
+    parser.add_argument('--protocols', default='udp,tcp', help='Comma separated protocols to benchmark.')
+    parser.add_argument('--clients', default=4, type=int, help='Number of load client processes.')
+    parser.add_argument('--duration', default=5.0, type=float, help='Seconds each run lasts.')
+    parser.add_argument('--queries', default=100000, type=int, help='Upper bound of queries sent by each client.')
+    parser.add_argument('--mix', default=DEFAULT_MIX, help='Weights of the hit, miss and cname queries.')
+    parser.add_argument('--zone_file', action='store_true', help='Serve the synthetic zone from a mapped zone file.')
+    parser.add_argument('--server_args', default='', help='Extra arguments passed to server.py.')
+    parser.add_argument('--seed', default=0, type=int, help='Seed of the query names drawn by the clients.')
+    parser.add_argument('--validation', default=0, type=int,
+                        help='Benchmark the registration validators over this many entries instead of the server.')
+    parser.add_argument('--validation_processes', default=0, type=int,
+                        help='Processes of the batch validation benchmark.')
+    parser.add_argument('--output', help='File receiving the results as JSON.')
+    args = parser.parse_args()
+
+    results = []
+    if args.validation:
+        result = benchmark_validation(args.validation, args.validation_processes)
+        results.append(result)
+        print('%d entries: %s entries/s, batch %.2fx the former validators' % (
+            result['entries'], ', '.join('%s %.0f' % item for item in result['entries_per_s'].items()),
+            result['speedup']))
+        args.zone_sizes = ''
+
+    for zone_size in [int(size) for size in args.zone_sizes.split(',') if size]:
+        for protocol in args.protocols.split(','):
+            result = run_benchmark(zone_size, protocol, args.clients, args.duration, args.queries, args.mix,
+                                   args.zone_file, args.server_args.split(), args.seed)
+            results.append(result)
+            print('%8d records %s: %9.1f qps  p50 %s ms  p99 %s ms  p999 %s ms  errors %d  cold start %s ms' % (
+                result['records'], protocol, result['qps'], result['p50_ms'], result['p99_ms'], result['p999_ms'],
+                result['errors'], result['cold_start_ms']))
+            if result['cold_start_ms'] > COLD_START_BUDGET * 1000:
+                print('cold start over its %.1f s budget' % COLD_START_BUDGET)
+
+    if args.output:
+        with open(args.output, 'w') as output:
+            json.dump({'started': time.strftime('%Y-%m-%dT%H:%M:%S'), 'results': results}, output, indent=2)
+
+
+if __name__ == '__main__':
+    main()
@@ -1,13 +1,35 @@
 import argparse
+import array
+import collections
+import concurrent.futures
+import contextlib
+import copy
+import csv
 import datetime
-from multiprocessing import Process
+import fcntl
+import gc
+import hashlib
+import ipaddress
+import itertools
+import json
+import mmap
+from multiprocessing import Process, Semaphore
+import os
 import pickle
+import queue
+import random
 import re
+import signal
+import socket
 import subprocess
 import sys
 import socketserver
 import threading
+import time
 import traceback
+import zlib
+
+STARTED = time.perf_counter()
 
 
 # Since pip v10, all code has been moved to pip._internal
@@ -17,25 +39,89 @@ def install(package):
     subprocess.check_call([sys.executable, "-m", "pip", "install", package])
 
 
+# only an interactive run of the script installs missing dependencies: importing this module or
+# serving --headless never changes the environment
 try:
     from dnslib import *
 except ImportError:
     print("Missing dependency dnslib: <https://pypi.python.org/pypi/dnslib>.")
+    if __name__ != '__main__' or '--headless' in sys.argv:
+        raise
     print("Installing dnslib now with `pip`:")
     install('dnslib')
-try:
-    from prompt_toolkit import prompt
-except ImportError:
-    print("Missing dependency prompt_toolkit: <https://python-prompt-toolkit.readthedocs.io/en/stable/index.html>.")
-    print("Installing prompt_toolkit now with `pip`:")
-    install('prompt_toolkit')
+    from dnslib import *
 
 
 PERSISTENT_RECORDS = "records.p"
+RECORDS_REFRESH_INTERVAL = 1.0
+JOURNAL_COMPACT_RATIO = 0.25
+JOURNAL_COMPACT_MIN_SIZE = 1 << 20
+RESPONSE_CACHE_SIZE = 10000
+CNAME_CHAIN_CACHE_SIZE = 10000
+CNAME_CHAIN_MAX_LENGTH = 8
+NEGATIVE_FILTER_BITS_PER_NAME = 10
+NEGATIVE_FILTER_HASHES = 7
+IMPORT_PROGRESS_INTERVAL = 100000
+IMPORT_ERRORS_SHOWN = 20
+VALIDATION_CHUNK_SIZE = 5000
+REGISTRATION_ACTIONS = ['add', 'replace', 'delete']
+REGISTRATION_COMMIT_BATCH = 10000
+REGISTRATION_LINE_LIMIT = 65536
+HANDLER_POOL_SIZE = 16
+HANDLER_QUEUE_SIZE = 1024
+OVERLOAD_POLICIES = ['drop', 'servfail', 'refused']
+TCP_IDLE_TIMEOUT = 10.0
+TCP_CONNECTIONS_PER_CLIENT = 16
+TCP_MAX_CONNECTIONS = 1024
+TCP_PIPELINE_DEPTH = 16
+QUERY_LOG_LEVELS = ['off', 'error', 'info']
+QUERY_LOG_QUEUE_SIZE = 100000
+QUERY_LOG_FLUSH_INTERVAL = 0.2
+LATENCY_BUCKETS = 24
+STATS_QNAME = 'stats.server'
+STATS_SUMMARY = ('uptime', 'queries', 'qps', 'active_handlers', 'rcodes', 'response_cache')
+RRL_SLIP = 2
+RRL_WINDOW = 5.0
+RRL_TABLE_SIZE = 65536
+RRL_PROBES = 4
+RCODE_NOERROR = 0
+RCODE_NXDOMAIN = 3
+EDNS_UDP_SIZE = 1232
+CLASSIC_UDP_SIZE = 512
+DNS_PORT = 53
+FORWARD_TIMEOUT = 2.0
+FORWARD_POOL_SIZE = 8
+FORWARD_CACHE_SIZE = 10000
+FORWARD_PREFETCH_FRACTION = 0.1
+FORWARD_PREFETCH_THREADS = 2
+FORWARD_THREADS = 16
+FORWARD_QUEUE_SIZE = 256
+FORWARD_NEGATIVE_TTL = 60
+FORWARD_MAX_TTL = 86400
+ZONE_QTYPES = (QTYPE.SOA, QTYPE.IXFR, QTYPE.AXFR)
+TRANSFER_HISTORY = 10000
+TRANSFER_MESSAGE_SIZE = 16384
+TRANSFER_ALLOWED = '127.0.0.1,::1'
+SOA_TTL = 3600
+SOA_REFRESH = 3600
+SOA_RETRY = 600
+SOA_EXPIRE = 604800
+SOA_MINIMUM = 60
+NOTIFY_TIMEOUT = 1.0
+NOTIFY_RETRIES = 3
+STATS_QUESTION = (STATS_QNAME, 16, 3)
+
+record_store = None
+forwarder = None
+notifier = None
 
 
 class BaseRequestHandler(socketserver.BaseRequestHandler):
 
+    # answers over UDP are bounded by the payload size of the client and, as their source address can be
+    # spoofed, go through the response rate limiter
+    udp = False
+
     def get_data(self):
         raise NotImplementedError
 
@@ -43,45 +129,815 @@ class BaseRequestHandler(socketserver.BaseRequestHandler):
         raise NotImplementedError
 
     def handle(self):
-        now = datetime.datetime.utcnow().strftime('%Y-%m-%d %H:%M:%S')
-        print("%s - [%s]: Received request from (%s on port %s)" %
-              (now, self.__class__.__name__, self.client_address[0], self.client_address[1]))
         try:
             data = self.get_data()
-            response_packets = handle_dns_client(data)
-            for resp_packet in response_packets:
-                self.send_data(resp_packet)
         except Exception:
             traceback.print_exc(file=sys.stderr)
+            return
+        serve_query(data, self.client_address, self.send_data, self.udp)
 
 
 class TCPRequestHandler(BaseRequestHandler):
 
+    # a connection carries any number of length-prefixed queries until the client closes it or
+    # stays idle; pipelined queries are answered concurrently, each response sent as soon as it is ready
+    def handle(self):
+        client = self.client_address[0]
+        if not self.server.acquire_connection(client):
+            return
+        in_flight = threading.BoundedSemaphore(self.server.pipeline_depth)
+        self.send_lock = threading.Lock()
+        try:
+            self.request.settimeout(self.server.idle_timeout)
+            while True:
+                data = self.get_data()
+                if data is None:
+                    break
+                in_flight.acquire()
+                self.server.pipeline.submit(self.handle_query, data, in_flight)
+        except (socket.timeout, ConnectionError):
+            pass
+        except Exception:
+            traceback.print_exc(file=sys.stderr)
+        finally:
+            # letting the queries in flight answer before the connection gets closed
+            for _ in range(self.server.pipeline_depth):
+                in_flight.acquire()
+            self.server.release_connection(client)
+
+    def handle_query(self, data, in_flight):
+        # forwarded queries hold their in_flight slot until answered, so the connection outlives them
+        serve_query(data, self.client_address, self.send_data, done=in_flight.release)
+
+    def recv_exactly(self, size):
+        data = b''
+        while len(data) < size:
+            chunk = self.request.recv(size - len(data))
+            if not chunk:
+                if data:
+                    raise ConnectionError("Connection closed in the middle of a TCP message")
+                return None
+            data += chunk
+        return data
+
+    # None once the client closed the connection
     def get_data(self):
-        data = self.request.recv(8192).strip()
-        sz = struct.unpack('>H', data[:2])[0]
-        if sz < len(data) - 2:
-            raise Exception("Wrong size of TCP packet")
-        elif sz > len(data) - 2:
-            raise Exception("Too big TCP packet")
-        return data[2:]
+        sz = self.recv_exactly(2)
+        if sz is None:
+            return None
+        data = self.recv_exactly(struct.unpack('>H', sz)[0])
+        if data is None:
+            raise ConnectionError("Connection closed in the middle of a TCP message")
+        return data
 
     def send_data(self, data):
         sz = struct.pack('>H', len(data))
-        return self.request.sendall(sz + data)
+        with self.send_lock:
+            return self.request.sendall(sz + data)
 
 
 class UDPRequestHandler(BaseRequestHandler):
+    udp = True
 
     # self.request[0] - request data (bytes)
     def get_data(self):
-        return self.request[0].strip()
+        return self.request[0]
 
     # self.request[1] - request socket
     def send_data(self, data):
         return self.request[1].sendto(data, self.client_address)
 
 
+class AsyncioServer:
+
+    # event loop counterpart of the socketserver servers: binds on creation and
+    # serves every client from the single thread running serve_forever
+    socket_type = None
+
+    def __init__(self, server_address, RequestHandlerClass):
+        # asyncio takes a third of the startup of a headless server, so only this engine imports it
+        import asyncio
+        self.server_address = server_address
+        self.RequestHandlerClass = RequestHandlerClass
+        self.socket = socket.socket(socket.AF_INET, self.socket_type)
+        self.server_bind()
+        self.socket.setblocking(False)
+        self.server_activate()
+        self.loop = asyncio.new_event_loop()
+
+    def server_bind(self):
+        self.socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self.socket.bind(self.server_address)
+        self.server_address = self.socket.getsockname()
+
+    def server_activate(self):
+        pass
+
+    async def start(self):
+        raise NotImplementedError
+
+    async def stop(self):
+        raise NotImplementedError
+
+    def serve_forever(self):
+        import asyncio
+        asyncio.set_event_loop(self.loop)
+        try:
+            self.loop.run_until_complete(self.start())
+            self.loop.run_forever()
+            self.loop.run_until_complete(self.stop())
+            # cancelling the handlers of connections still open
+            tasks = asyncio.all_tasks(self.loop)
+            for task in tasks:
+                task.cancel()
+            self.loop.run_until_complete(asyncio.gather(*tasks, return_exceptions=True))
+        finally:
+            self.server_close()
+
+    def shutdown(self):
+        self.loop.call_soon_threadsafe(self.loop.stop)
+
+    def server_close(self):
+        self.loop.close()
+        self.socket.close()
+
+
+class AsyncioUDPServer(AsyncioServer):
+    socket_type = socket.SOCK_DGRAM
+
+    async def start(self):
+        self.transport, _ = await self.loop.create_datagram_endpoint(self.RequestHandlerClass, sock=self.socket)
+
+    async def stop(self):
+        self.transport.close()
+
+
+class ConnectionLimitMixIn:
+
+    # TCP settings shared by both engines, capping the connections open from a single client address
+    # and from all of them
+    idle_timeout = TCP_IDLE_TIMEOUT
+    connections_per_client = TCP_CONNECTIONS_PER_CLIENT
+    max_connections = TCP_MAX_CONNECTIONS
+    pipeline_depth = TCP_PIPELINE_DEPTH
+
+    connections = None
+    open_connections = 0
+    refused_connections = 0
+
+    def acquire_connection(self, client):
+        with self.connections_lock:
+            if self.connections is None:
+                self.connections = collections.Counter()
+            if self.connections[client] >= self.connections_per_client or \
+                    self.open_connections >= self.max_connections:
+                self.refused_connections += 1
+                return False
+            self.connections[client] += 1
+            self.open_connections += 1
+            return True
+
+    def release_connection(self, client):
+        with self.connections_lock:
+            self.open_connections -= 1
+            self.connections[client] -= 1
+            if self.connections[client] <= 0:
+                del self.connections[client]
+
+
+class AsyncioTCPServer(ConnectionLimitMixIn, AsyncioServer):
+    socket_type = socket.SOCK_STREAM
+    request_queue_size = 128
+    connections_lock = contextlib.nullcontext()
+
+    def server_activate(self):
+        self.socket.listen(self.request_queue_size)
+
+    async def start(self):
+        import asyncio
+        self.server = await asyncio.start_server(
+            lambda reader, writer: self.RequestHandlerClass(reader, writer, self).handle(), sock=self.socket)
+
+    async def stop(self):
+        self.server.close()
+
+
+class AsyncioUDPRequestHandler:
+
+    # datagram protocol of the asyncio UDP server; implements the whole asyncio.DatagramProtocol
+    # interface rather than subclassing it, so this module does not import asyncio
+    def connection_made(self, transport):
+        import asyncio
+        self.transport = transport
+        self.loop = asyncio.get_running_loop()
+
+    def connection_lost(self, exc):
+        pass
+
+    def error_received(self, exc):
+        pass
+
+    def pause_writing(self):
+        pass
+
+    def resume_writing(self):
+        pass
+
+    def datagram_received(self, data, client_address):
+        # answers waiting for the upstreams come from a forwarder thread, and are sent from the loop
+        send = lambda resp_packet: self.transport.sendto(resp_packet, client_address)
+        serve_query(data, client_address, send, udp=True, deferred_send=lambda resp_packet: self.send_later(send,
+                                                                                                         resp_packet))
+
+    def send_later(self, send, resp_packet):
+        # from a forwarder thread, the server may have stopped since
+        if not self.loop.is_closed():
+            self.loop.call_soon_threadsafe(send, resp_packet)
+
+
+class AsyncioTCPRequestHandler:
+
+    def __init__(self, reader, writer, server):
+        self.reader = reader
+        self.writer = writer
+        self.server = server
+        self.client_address = writer.get_extra_info('peername')
+
+    async def handle(self):
+        # serving length-prefixed messages until the client closes the connection or stays idle;
+        # answers are computed on the event loop, so they are written in query order, except the answers waiting
+        # for the upstreams, written when they arrive
+        import asyncio
+        if not self.server.acquire_connection(self.client_address[0]):
+            self.writer.close()
+            return
+        try:
+            while True:
+                sz = await asyncio.wait_for(self.reader.readexactly(2), self.server.idle_timeout)
+                data = await self.reader.readexactly(struct.unpack('>H', sz)[0])
+                loop = asyncio.get_running_loop()
+                if transfer_request(data):
+                    # zone transfers would block the event loop: answering from a thread, each message waiting
+                    # for the previous ones to be sent
+                    send = lambda resp_packet: asyncio.run_coroutine_threadsafe(self.drain_data(resp_packet),
+                                                                                loop).result()
+                    await loop.run_in_executor(None, serve_query, data, self.client_address, send)
+                else:
+                    serve_query(data, self.client_address, self.send_data,
+                                deferred_send=lambda resp_packet: loop.call_soon_threadsafe(self.send_data,
+                                                                                            resp_packet))
+                await self.writer.drain()
+        except (asyncio.IncompleteReadError, asyncio.TimeoutError, ConnectionError):
+            pass
+        except Exception:
+            traceback.print_exc(file=sys.stderr)
+        finally:
+            self.server.release_connection(self.client_address[0])
+            self.writer.close()
+
+    def send_data(self, data):
+        if not self.writer.is_closing():
+            self.writer.write(struct.pack('>H', len(data)) + data)
+
+    async def drain_data(self, data):
+        self.send_data(data)
+        await self.writer.drain()
+
+
+class PoolMixIn:
+
+    # serves requests from a fixed set of handler threads fed by a bounded queue, instead of
+    # a new thread per request; once the queue is full, requests are shed following overload_policy:
+    # 'drop' ignores them, 'servfail'/'refused' answer UDP queries with that rcode (TCP connections are closed)
+    pool_size = HANDLER_POOL_SIZE
+    queue_size = HANDLER_QUEUE_SIZE
+    overload_policy = 'drop'
+    daemon_threads = True
+
+    requests = None
+    dropped = 0
+    rejected = 0
+
+    def serve_forever(self, poll_interval=0.5):
+        if self.pool_size > 0 and self.requests is None:
+            self.requests = queue.Queue(self.queue_size)
+            for _ in range(self.pool_size):
+                threading.Thread(target=self.process_queue, daemon=True).start()
+        super().serve_forever(poll_interval)
+
+    def process_request(self, request, client_address):
+        if self.requests is None:
+            # no pool: a thread per request, as socketserver.ThreadingMixIn
+            threading.Thread(target=self.process_request_thread, args=(request, client_address),
+                             daemon=self.daemon_threads).start()
+            return
+        try:
+            self.requests.put_nowait((request, client_address))
+        except queue.Full:
+            self.shed_request(request, client_address)
+
+    def process_queue(self):
+        while True:
+            request, client_address = self.requests.get()
+            self.process_request_thread(request, client_address)
+
+    def process_request_thread(self, request, client_address):
+        try:
+            self.finish_request(request, client_address)
+        except Exception:
+            self.handle_error(request, client_address)
+        finally:
+            self.shutdown_request(request)
+
+    def shed_request(self, request, client_address):
+        response = None
+        if self.overload_policy != 'drop' and self.socket_type == socket.SOCK_DGRAM:
+            rcode = RCODE.SERVFAIL if self.overload_policy == 'servfail' else RCODE.REFUSED
+            response = error_response(request[0], rcode)
+        if response is None:
+            self.dropped += 1
+        else:
+            self.rejected += 1
+            try:
+                request[1].sendto(response, client_address)
+            except OSError:
+                pass
+        self.shutdown_request(request)
+
+    def stats(self):
+        return {'pool_size': self.pool_size, 'queue_size': self.queue_size,
+                'queue_depth': self.requests.qsize() if self.requests is not None else 0,
+                'dropped': self.dropped, 'rejected': self.rejected}
+
+
+class PooledUDPServer(PoolMixIn, socketserver.UDPServer):
+    pass
+
+
+class PooledTCPServer(PoolMixIn, ConnectionLimitMixIn, socketserver.TCPServer):
+
+    # connections mostly wait for their next query: each one is read by a thread of its own and only its
+    # queries are answered by the pool (pipeline), so idle connections never hold a handler thread.
+    # max_connections bounds the reader threads
+    pipeline = None
+
+    def __init__(self, server_address, RequestHandlerClass, bind_and_activate=True):
+        super().__init__(server_address, RequestHandlerClass, bind_and_activate)
+        self.connections_lock = threading.Lock()
+
+    def serve_forever(self, poll_interval=0.5):
+        if self.pipeline is None:
+            self.pipeline = concurrent.futures.ThreadPoolExecutor(max(self.pool_size, 1))
+        socketserver.TCPServer.serve_forever(self, poll_interval)
+
+    def process_request(self, request, client_address):
+        threading.Thread(target=self.process_request_thread, args=(request, client_address),
+                         daemon=self.daemon_threads).start()
+
+    def server_close(self):
+        super().server_close()
+        if self.pipeline is not None:
+            self.pipeline.shutdown(wait=False)
+
+    def stats(self):
+        return {'pool_size': self.pool_size, 'connections': self.open_connections,
+                'max_connections': self.max_connections, 'refused_connections': self.refused_connections}
+
+
+class ReusePortMixIn:
+
+    # lets every worker process bind the request port, the kernel spreading clients among them
+    def server_bind(self):
+        self.socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+        super().server_bind()
+
+
+class ReusePortPooledUDPServer(ReusePortMixIn, PooledUDPServer):
+    pass
+
+
+class ReusePortPooledTCPServer(ReusePortMixIn, PooledTCPServer):
+    pass
+
+
+class ReusePortAsyncioUDPServer(ReusePortMixIn, AsyncioUDPServer):
+    pass
+
+
+class ReusePortAsyncioTCPServer(ReusePortMixIn, AsyncioTCPServer):
+    pass
+
+
+class WorkerSupervisor:
+
+    # keeps `count` processes running target(*args, position), restarting any that dies
+    def __init__(self, count, target, args=(), interval=1.0):
+        self.count = count
+        self.target = target
+        self.args = args
+        self.interval = interval
+        self.workers = []
+        self.restarts = 0
+        self._stopped = threading.Event()
+
+    def _spawn(self, position):
+        worker = Process(target=self.target, args=self.args + (position,), daemon=True)
+        worker.start()
+        return worker
+
+    def start(self):
+        self.workers = [self._spawn(position) for position in range(self.count)]
+        thread = threading.Thread(target=self._supervise, daemon=True)
+        thread.start()
+        return thread
+
+    def _supervise(self):
+        while not self._stopped.wait(self.interval):
+            for position, worker in enumerate(self.workers):
+                if worker.is_alive() or self._stopped.is_set():
+                    continue
+                print("Worker process %s exited with code %s, restarting it" % (worker.pid, worker.exitcode),
+                      file=sys.stderr)
+                worker.join()
+                worker.close()
+                self.workers[position] = self._spawn(position)
+                self.restarts += 1
+
+    def stop(self):
+        self._stopped.set()
+        for worker in self.workers:
+            worker.terminate()
+        for worker in self.workers:
+            worker.join()
+            worker.close()
+
+
+def error_response(data, rcode):
+    # cheap error answer echoing the question of a request that will not be looked up,
+    # None for data that should not be answered at all (responses, truncated headers)
+    if len(data) < 12:
+        return None
+    request_id, flags = struct.unpack_from('>HH', data)
+    if flags & 0x8000:
+        return None
+    # QR set, opcode and RD copied from the request
+    flags = 0x8000 | (flags & 0x7900) | rcode
+    question = parse_question(data)
+    if question is None:
+        return QUERY_HEADER.pack(request_id, flags, 0, 0, 0, 0)
+    return QUERY_HEADER.pack(request_id, flags, 1, 0, 0, 0) + bytes(data[12:question.end])
+
+
+def serve_query(data, client_address, send, udp=False, deferred_send=None, done=None):
+    # shared by every handler: answers one message, times the send and logs the query. Questions waiting for
+    # the upstreams are answered from a forwarder thread, with deferred_send (send by default), and get SERVFAIL
+    # when too many are pending; done is called once the response is sent, whichever thread sends it
+    started = time.perf_counter()
+    server_metrics.active_handlers += 1
+    forwarded_later = False
+    try:
+        try:
+            messages = handle_dns_client(data, udp, client_address, defer_forward=True)
+        except Exception:
+            traceback.print_exc(file=sys.stderr)
+            messages = []
+        if isinstance(messages, ForwardedQuestion):
+            forwarded_later = forwarder.submit(serve_forwarded, messages, data, client_address,
+                                               deferred_send or send, started, done)
+            if forwarded_later:
+                return
+            response = error_response(data, RCODE.SERVFAIL)
+            messages = [finish_response(response, messages.edns, udp)] if response is not None else []
+        send_response(data, client_address, send, messages, started, udp)
+    finally:
+        server_metrics.active_handlers -= 1
+        if done is not None and not forwarded_later:
+            done()
+
+
+def serve_forwarded(question, data, client_address, send, started, done):
+    try:
+        messages = question.messages()
+    except Exception:
+        traceback.print_exc(file=sys.stderr)
+        messages = []
+    try:
+        send_response(data, client_address, send, messages, started, question.udp)
+    finally:
+        if done is not None:
+            done()
+
+
+def send_response(data, client_address, send, messages, started, udp=False):
+    # sends the response messages to data (rate limited over UDP) and logs the query
+    response_packets = []
+    try:
+        response_packets = messages
+        if not isinstance(messages, list):
+            # zone transfers stream their messages, the first one standing for all of them in the log
+            response_packets = [next(messages)]
+            messages = itertools.chain(response_packets, messages)
+        elif udp:
+            response_packets = messages = response_limiter.limit(client_address, data, response_packets)
+        sending = time.perf_counter()
+        for resp_packet in messages:
+            send(resp_packet)
+        server_metrics.observe('send', sending)
+    except Exception:
+        traceback.print_exc(file=sys.stderr)
+    finally:
+        query_log.log(client_address, data, response_packets, started)
+
+
+class ResponseRateLimiter:
+
+    # response rate limiting (RRL): a token bucket per client prefix (/24 for IPv4, /56 for IPv6) and response
+    # (question name and type of answers, any NXDOMAIN, any error), refilled with `rate` tokens a second up to
+    # `rate * window`. Limited responses are dropped, except one out of `slip` sent truncated (TC set, no
+    # records) so legitimate clients retry over TCP. Buckets live in fixed arrays of `size` slots: a bucket is
+    # searched among RRL_PROBES slots from its hash and, when missing, replaces the least recently used of them,
+    # so memory stays bounded whatever the number of sources. Disabled while rate is 0
+    def __init__(self, rate=0, slip=RRL_SLIP, window=RRL_WINDOW, size=RRL_TABLE_SIZE):
+        self.lock = threading.Lock()
+        self.configure(rate, slip, window, size)
+
+    def configure(self, rate, slip=RRL_SLIP, window=RRL_WINDOW, size=RRL_TABLE_SIZE):
+        with self.lock:
+            self.rate = rate
+            self.slip = slip
+            self.burst = max(rate * window, 1.0)
+            # power of two slot count, key 0 marking free slots
+            self.size = 1 << max(size - 1, 1).bit_length()
+            self.keys = array.array('q', bytes(8 * self.size))
+            self.tokens = array.array('d', bytes(8 * self.size))
+            self.used = array.array('d', bytes(8 * self.size))
+            self.responses = self.limited = self.slipped = self.dropped = self.evictions = 0
+
+    @staticmethod
+    def client_prefix(address):
+        if ':' in address:
+            return socket.inet_pton(socket.AF_INET6, address.split('%', 1)[0])[:7]
+        return address.rsplit('.', 1)[0]
+
+    @staticmethod
+    def response_kind(data, response):
+        rcode = response[3] & 0xF
+        if rcode == RCODE_NXDOMAIN:
+            return 'nxdomain'
+        if rcode != RCODE_NOERROR:
+            return 'error'
+        # the wire question name (case folded) and type, without a full parse
+        end = data.find(b'\0', 12)
+        return bytes(data[12:end + 3]).lower() if end > 0 else 'error'
+
+    def _take(self, key, now):
+        # spends a token of the bucket of key, False when it is empty
+        mask = self.size - 1
+        slot = oldest = key & mask
+        for probe in range(RRL_PROBES):
+            slot = (key + probe) & mask
+            if self.keys[slot] == key:
+                break
+            if self.used[slot] < self.used[oldest]:
+                oldest = slot
+        else:
+            slot = oldest
+            if self.keys[slot]:
+                self.evictions += 1
+            self.keys[slot], self.tokens[slot], self.used[slot] = key, self.burst, now
+        tokens = min(self.burst, self.tokens[slot] + (now - self.used[slot]) * self.rate)
+        self.used[slot] = now
+        if tokens >= 1.0:
+            self.tokens[slot] = tokens - 1.0
+            return True
+        self.tokens[slot] = tokens
+        return False
+
+    def limit(self, client_address, data, response_packets):
+        # returns the packets to send in answer to data
+        if self.rate <= 0 or not response_packets or len(response_packets[0]) < 12:
+            return response_packets
+        response = response_packets[0]
+        key = hash((self.client_prefix(client_address[0]), self.response_kind(data, response))) or 1
+        with self.lock:
+            self.responses += 1
+            if self._take(key, time.monotonic()):
+                return response_packets
+            self.limited += 1
+            if self.slip and self.limited % self.slip == 0:
+                self.slipped += 1
+                return [truncated_response(data, response)]
+            self.dropped += 1
+        return []
+
+    def stats(self):
+        return {'rate': self.rate, 'slip': self.slip, 'table_size': self.size, 'responses': self.responses,
+                'limited': self.limited, 'slipped': self.slipped, 'dropped': self.dropped,
+                'evictions': self.evictions}
+
+
+response_limiter = ResponseRateLimiter()
+
+
+def truncated_response(data, response):
+    # header of response with TC set and no records, followed by the question of the request
+    request_id, flags = struct.unpack_from('>HH', response)
+    question = parse_question(data)
+    if question is None:
+        return QUERY_HEADER.pack(request_id, flags | 0x0200, 0, 0, 0, 0)
+    return QUERY_HEADER.pack(request_id, flags | 0x0200, 1, 0, 0, 0) + bytes(data[12:question.end])
+
+
+class LatencyHistogram:
+
+    # power of two microsecond buckets: bucket n counts latencies below 2**n us
+    def __init__(self, buckets=LATENCY_BUCKETS):
+        self.counts = [0] * buckets
+        self.count = 0
+        self.total = 0.0
+
+    def observe(self, seconds):
+        bucket = min(int(seconds * 1000000).bit_length(), len(self.counts) - 1)
+        self.counts[bucket] += 1
+        self.count += 1
+        self.total += seconds
+
+    def percentile(self, fraction):
+        # upper bound (in microseconds) of the bucket holding the given fraction of observations
+        threshold, seen = fraction * self.count, 0
+        for bucket, count in enumerate(self.counts):
+            seen += count
+            if count and seen >= threshold:
+                return 2 ** bucket
+        return 0
+
+    def snapshot(self):
+        return {'count': self.count,
+                'mean_us': round(self.total / self.count * 1000000, 1) if self.count else 0,
+                'p50_us': self.percentile(0.5), 'p99_us': self.percentile(0.99), 'p999_us': self.percentile(0.999)}
+
+
+class ServerMetrics:
+
+    # low overhead counters updated without locks: under concurrent handlers an increment may
+    # occasionally be lost, which is fine for monitoring
+    def __init__(self):
+        self.started = time.time()
+        self.stages = collections.defaultdict(LatencyHistogram)
+        self.qtypes = collections.Counter()
+        self.rcodes = collections.Counter()
+        self.active_handlers = 0
+        self.servers = []
+
+    def observe(self, stage, since):
+        # records the time elapsed since `since` for a stage, returning now for chained stages
+        now = time.perf_counter()
+        self.stages[stage].observe(now - since)
+        return now
+
+    def count_query(self, qtype, response):
+        self.qtypes[QTYPE.get(qtype)] += 1
+        if len(response) > 3:
+            self.rcodes[RCODE.get(response[3] & 0xF)] += 1
+
+    def snapshot(self):
+        uptime = time.time() - self.started
+        queries = sum(self.qtypes.values())
+        stats = {'uptime': round(uptime, 1), 'queries': queries,
+                 'qps': round(queries / uptime, 1) if uptime else 0,
+                 'active_handlers': self.active_handlers,
+                 'qtypes': dict(self.qtypes), 'rcodes': dict(self.rcodes),
+                 'stages': {stage: histogram.snapshot() for stage, histogram in list(self.stages.items())},
+                 'response_cache': response_cache.stats(), 'cname_chains': cname_chains.stats(),
+                 'negative_filter': negative_filter.stats(), 'rate_limit': response_limiter.stats(),
+                 'query_log_dropped': query_log.dropped}
+        if forwarder is not None:
+            stats['forwarder'] = forwarder.stats()
+        if zone_transfers.zones:
+            stats['zone_transfers'] = zone_transfers.stats()
+        if notifier is not None:
+            stats['notify'] = notifier.stats()
+        for server in self.servers:
+            if hasattr(server, 'stats'):
+                stats['%s:%s' % (type(server).__name__, server.server_address[1])] = server.stats()
+        return stats
+
+    def txt_lines(self, keys=None):
+        # flattened key=value strings for the CHAOS TXT answer, of the given top level keys only if any
+        lines = []
+
+        def flatten(prefix, value):
+            if isinstance(value, dict):
+                for key, item in value.items():
+                    flatten('%s.%s' % (prefix, key) if prefix else str(key), item)
+            else:
+                lines.append('%s=%s' % (prefix, value))
+
+        stats = self.snapshot()
+        flatten('', stats if keys is None else {key: stats[key] for key in keys if key in stats})
+        return lines
+
+
+server_metrics = ServerMetrics()
+
+
+def stats_response(request_id, limit=None):
+    # CHAOS class TXT answer to stats.server queries; the full statistics do not fit a UDP payload (limit),
+    # which gets the STATS_SUMMARY lines instead, as many as fit, rather than an empty truncated answer
+    answer = DNSRecord(DNSHeader(id=request_id, qr=1, aa=1, ra=1), q=DNSQuestion(STATS_QNAME, QTYPE.TXT, CLASS.CH))
+    if limit is None:
+        for line in server_metrics.txt_lines():
+            answer.add_answer(RR(STATS_QNAME, QTYPE.TXT, CLASS.CH, 0, TXT(line)))
+        return answer.pack()
+    packed = answer.pack()
+    for line in server_metrics.txt_lines(STATS_SUMMARY):
+        answer.add_answer(RR(STATS_QNAME, QTYPE.TXT, CLASS.CH, 0, TXT(line)))
+        if len(answer.pack()) > limit:
+            break
+        packed = answer.pack()
+    return packed
+
+
+class QueryLogger:
+
+    # per-query log kept off the hot path: handlers only append the raw query of sampled entries
+    # to a bounded buffer (dropping entries when it is full), a background thread decodes,
+    # formats and writes them in batches as
+    #   timestamp client#port qname qtype rcode latency
+    # levels: 'off' logs nothing, 'error' only failed queries (rcode other than NOERROR/NXDOMAIN), 'info' all
+    def __init__(self, stream=None, level='info', sample_rate=1.0, queue_size=QUERY_LOG_QUEUE_SIZE,
+                 flush_interval=QUERY_LOG_FLUSH_INTERVAL):
+        self.stream = stream
+        self.level = level
+        self.sample_rate = sample_rate
+        self.queue_size = queue_size
+        self.flush_interval = flush_interval
+        self.dropped = 0
+        self._entries = collections.deque()
+        self._writer_lock = threading.Lock()
+        self._writer_pid = None
+
+    def log(self, client_address, data, response_packets, started):
+        if self.level == 'off':
+            return
+        rcode = response_packets[0][3] & 0xF if response_packets and len(response_packets[0]) > 3 \
+            else RCODE.SERVFAIL
+        if self.level == 'error' and rcode in (RCODE.NOERROR, RCODE.NXDOMAIN):
+            return
+        if self.sample_rate < 1.0 and random.random() >= self.sample_rate:
+            return
+        if len(self._entries) >= self.queue_size:
+            self.dropped += 1
+            return
+        self._entries.append((time.time(), client_address, data, rcode, time.perf_counter() - started))
+        # the writer thread does not survive a fork into worker processes
+        if self._writer_pid != os.getpid():
+            self._start_writer()
+
+    def _start_writer(self):
+        with self._writer_lock:
+            if self._writer_pid == os.getpid():
+                return
+            self._writer_pid = os.getpid()
+            threading.Thread(target=self._write_loop, daemon=True).start()
+
+    def _write_loop(self):
+        while True:
+            time.sleep(self.flush_interval)
+            try:
+                self.flush()
+            except Exception:
+                traceback.print_exc(file=sys.stderr)
+
+    def flush(self):
+        lines = []
+        while self._entries:
+            lines.append(self.format(*self._entries.popleft()))
+        if lines:
+            stream = self.stream or sys.stdout
+            stream.write(''.join(lines))
+            stream.flush()
+
+    @staticmethod
+    def format(timestamp, client_address, data, rcode, latency):
+        qname, qtype = '-', '-'
+        question = parse_question(data) if data else None
+        if question is not None:
+            qname, qtype = question.key[0] or '.', QTYPE.get(question.key[1])
+        elif data:
+            try:
+                request = DNSRecord.parse(data)
+                qname, qtype = str(request.q.qname), QTYPE.get(request.q.qtype)
+            except Exception:
+                pass
+        return "%s.%03dZ %s#%s %s %s %s %.3fms\n" % (
+            time.strftime('%Y-%m-%dT%H:%M:%S', time.gmtime(timestamp)), int(timestamp * 1000) % 1000,
+            client_address[0], client_address[1], qname, qtype, RCODE.get(rcode), latency * 1000)
+
+
+query_log = QueryLogger()
+
+
 class DNSResourceRecord:
     domain_name: string
     record_class: CLASS
@@ -97,7 +953,1992 @@ class DNSResourceRecord:
         self.data = data
 
 
-def domain_registration():
+class RecordJournal:
+
+    # append-only log of record changes: [length][crc32][pickled operation] frames
+    frame_header = struct.Struct('>II')
+
+    def __init__(self, path):
+        self.path = path
+        self.lock_path = path + '.lock'
+
+    def identity(self):
+        try:
+            stat = os.stat(self.path)
+        except FileNotFoundError:
+            return None, 0
+        return stat.st_ino, stat.st_size
+
+    def read(self, offset=0):
+        # yields (end_offset, operation) for every complete frame, stopping at a torn tail
+        try:
+            journal_file = open(self.path, "rb")
+        except FileNotFoundError:
+            return
+        with journal_file:
+            journal_file.seek(offset)
+            while True:
+                header = journal_file.read(self.frame_header.size)
+                if len(header) < self.frame_header.size:
+                    return
+                size, checksum = self.frame_header.unpack(header)
+                payload = journal_file.read(size)
+                if len(payload) < size or zlib.crc32(payload) != checksum:
+                    return
+                offset += self.frame_header.size + size
+                yield offset, pickle.loads(payload)
+
+    def encode(self, operations):
+        frames = []
+        for operation in operations:
+            payload = pickle.dumps(operation, pickle.HIGHEST_PROTOCOL)
+            frames.append(self.frame_header.pack(len(payload), zlib.crc32(payload)) + payload)
+        return b''.join(frames)
+
+    def append(self, operations, offset):
+        # a single write + fsync per batch, dropping any torn tail left by a crashed writer
+        with open(self.path, "ab") as journal_file:
+            if journal_file.tell() != offset:
+                journal_file.truncate(offset)
+            journal_file.write(self.encode(operations))
+            journal_file.flush()
+            os.fsync(journal_file.fileno())
+            return journal_file.tell()
+
+    def reset(self, generation, serial=0):
+        # a new journal starts with the generation of its snapshot and the serial of the records it holds
+        write_atomically(self.path, self.encode([('generation', generation), ('serial', serial)]))
+        return self.identity()
+
+    @contextlib.contextmanager
+    def locked(self):
+        # serializes writers across processes (server, registration cli, ...)
+        with open(self.lock_path, "ab") as lock_file:
+            fcntl.flock(lock_file, fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+
+class MappedResourceRecord(DNSResourceRecord):
+    wire: bytes
+
+    # record read from a mapped zone, carrying its pre-encoded rdata
+    def __init__(self, domain_name, record_class, record_type, data, ttl, wire):
+        super().__init__(domain_name, record_class, record_type, data, ttl)
+        self.wire = wire
+
+
+class MappedZone:
+
+    # compact read-only zone file, shared between processes through mmap:
+    #   header: magic, snapshot generation, name count, slot count (power of two)
+    #   index:  open addressing table of (u64 name hash, u32 block offset) slots, offset 0 marking empty slots
+    #   blocks: u16 name length, name, u32 number of names holding records at or below this one, u16 record count,
+    #           records * (u16 class, u16 type, u32 ttl, u16 data length, data, u16 rdata length, rdata)
+    magic = b'DNSPYZ02'
+    header = struct.Struct('>8sIII')
+    index_entry = struct.Struct('>QI')
+    record_header = struct.Struct('>HHIH')
+
+    def __init__(self, path):
+        self.path = path
+        with open(path, "rb") as zone_file:
+            stat = os.fstat(zone_file.fileno())
+            self.buffer = mmap.mmap(zone_file.fileno(), 0, access=mmap.ACCESS_READ)
+        self.identity = stat.st_ino, stat.st_mtime_ns, stat.st_size
+        magic, self.generation, self.name_count, self.slot_count = self.header.unpack_from(self.buffer, 0)
+        if magic != self.magic:
+            raise ValueError("Not a zone file: [%s]" % path)
+
+    @staticmethod
+    def name_hash(name):
+        return int.from_bytes(hashlib.blake2b(name, digest_size=8).digest(), 'big')
+
+    def _block_offsets(self, name):
+        # linear probing from the hash slot, yielding every block offset sharing the hash
+        name_hash = self.name_hash(name)
+        mask = self.slot_count - 1
+        slot = name_hash & mask
+        while True:
+            entry_hash, offset = self.index_entry.unpack_from(
+                self.buffer, self.header.size + slot * self.index_entry.size)
+            if offset == 0:
+                return
+            if entry_hash == name_hash:
+                yield offset
+            slot = (slot + 1) & mask
+
+    def _find_block(self, name):
+        name = name.encode()
+        for offset in self._block_offsets(name):
+            size = struct.unpack_from('>H', self.buffer, offset)[0]
+            if self.buffer[offset + 2:offset + 2 + size] == name:
+                return offset
+        return None
+
+    def _read_block(self, offset):
+        size = struct.unpack_from('>H', self.buffer, offset)[0]
+        name = self.buffer[offset + 2:offset + 2 + size].decode()
+        offset += 6 + size
+        count = struct.unpack_from('>H', self.buffer, offset)[0]
+        offset += 2
+        for _ in range(count):
+            record_class, record_type, ttl, data_size = self.record_header.unpack_from(self.buffer, offset)
+            offset += self.record_header.size
+            data = self.buffer[offset:offset + data_size].decode()
+            offset += data_size
+            wire_size = struct.unpack_from('>H', self.buffer, offset)[0]
+            wire = self.buffer[offset + 2:offset + 2 + wire_size]
+            offset += 2 + wire_size
+            yield MappedResourceRecord(name, CLASS[record_class], QTYPE[record_type], data, ttl, wire)
+
+    def has_name(self, name):
+        offset = self._find_block(name)
+        return offset is not None and bool(next(self._read_block(offset), None))
+
+    def exists(self, name):
+        # names holding records as well as the empty non-terminals between them
+        return self._find_block(name) is not None
+
+    def count(self, name):
+        offset = self._find_block(name)
+        if offset is None:
+            return 0
+        size = struct.unpack_from('>H', self.buffer, offset)[0]
+        return struct.unpack_from('>I', self.buffer, offset + 2 + size)[0]
+
+    def records_by_name(self, name):
+        offset = self._find_block(name)
+        if offset is None:
+            return []
+        return list(self._read_block(offset))
+
+    def lookup(self, name, domain_class, domain_type):
+        offset = self._find_block(name)
+        if offset is None:
+            return []
+        return [record for record in self._read_block(offset)
+                if record.record_class == domain_class and record.record_type == domain_type]
+
+    def all_records(self):
+        for slot in range(self.slot_count):
+            offset = self.index_entry.unpack_from(self.buffer, self.header.size + slot * self.index_entry.size)[1]
+            if offset:
+                yield from self._read_block(offset)
+
+    @classmethod
+    def write(cls, path, resource_records, generation=0):
+        # returns the number of records written, skipping those that cannot be encoded
+        names = {}
+        for record in resource_records:
+            names.setdefault(normalize_domain_name(record.domain_name), []).append(record)
+        # empty non-terminals get blocks without records, so their existence is a single probe as well
+        for name in list(names):
+            for ancestor in name_ancestors(name):
+                names.setdefault(ancestor, [])
+
+        encoded_names = {}
+        for name, records in names.items():
+            encoded = []
+            for record in records:
+                wire = encode_record_data(record)
+                if wire is None:
+                    continue
+                data = record.data.encode()
+                encoded.append(cls.record_header.pack(getattr(CLASS, record.record_class),
+                                                      getattr(QTYPE, record.record_type), record.ttl, len(data)) +
+                               data + struct.pack('>H', len(wire)) + wire)
+            if encoded or not records:
+                encoded_names[name] = encoded
+        counts = collections.Counter()
+        for name, encoded in encoded_names.items():
+            if encoded:
+                counts.update([name] + name_ancestors(name))
+
+        blocks, written = [], 0
+        for name, encoded in encoded_names.items():
+            count = counts[name]
+            name = name.encode()
+            blocks.append((cls.name_hash(name), struct.pack('>H', len(name)) + name +
+                           struct.pack('>IH', count, len(encoded)) + b''.join(encoded)))
+            written += len(encoded)
+        # keeping the table at most half full so probes stay short
+        slot_count = 1
+        while slot_count < 2 * len(blocks):
+            slot_count *= 2
+        slots = [None] * slot_count
+        offset = cls.header.size + slot_count * cls.index_entry.size
+        for name_hash, block in blocks:
+            slot = name_hash & (slot_count - 1)
+            while slots[slot] is not None:
+                slot = (slot + 1) & (slot_count - 1)
+            slots[slot] = cls.index_entry.pack(name_hash, offset)
+            offset += len(block)
+        empty_slot = cls.index_entry.pack(0, 0)
+        write_atomically(path, cls.header.pack(cls.magic, generation, len(blocks), slot_count) +
+                         b''.join(slot or empty_slot for slot in slots) + b''.join(block for _, block in blocks))
+        return written
+
+
+def encode_record_data(record):
+    data = get_data_by_type(record.record_type, record.data)
+    if data is None:
+        return None
+    buffer = DNSBuffer()
+    data[1].pack(buffer)
+    return bytes(buffer.data)
+
+
+def convert_records(records_path, zone_path):
+    # converts a records.p snapshot (and its journal) into the mapped zone format
+    store = RecordStore(records_path)
+    store.load()
+    written = MappedZone.write(zone_path, store.records())
+    # any journal left next to the zone belongs to a previous zone file
+    RecordJournal(zone_path + '.journal').reset(0)
+    return written
+
+
+@contextlib.contextmanager
+def paused_gc():
+    # the millions of long-lived objects allocated by loads and imports of large record sets
+    # would otherwise trigger repeated full collections, doubling their time
+    enabled = gc.isenabled()
+    gc.disable()
+    try:
+        yield
+    finally:
+        if enabled:
+            gc.enable()
+
+
+# master file tokens: quoted strings, comments (up to the end of the line) and plain fields
+ZONE_FILE_TOKEN = re.compile(r'"((?:[^"\\]|\\.)*)"|(;.*)|([^\s;]+)')
+ZONE_FILE_CLASSES = {'IN', 'CS', 'CH', 'HS'}
+
+
+def absolute_name(name, origin):
+    if name == '@':
+        return origin
+    if name.endswith('.'):
+        return name[:-1]
+    return name + '.' + origin if origin else name
+
+
+def zone_file_entries(lines, origin='', ttl=3600):
+    # RFC 1035 master file subset: $ORIGIN/$TTL, '@', relative and blank (previous) owners, optional ttl and class
+    # in any order, quoted TXT data and ';' comments; yields (line number, fields or None, error)
+    origin, owner = normalize_domain_name(origin), None
+    for number, line in enumerate(lines, 1):
+        if '"' in line or ';' in line:
+            tokens = []
+            for match in ZONE_FILE_TOKEN.finditer(line):
+                if match.group(2) is not None:
+                    break
+                tokens.append(match.group(1) if match.group(1) is not None else match.group(3))
+        else:
+            tokens = line.split()
+        if not tokens:
+            continue
+        if tokens[0].startswith('$'):
+            directive = tokens[0].upper()
+            if directive == '$ORIGIN' and len(tokens) == 2:
+                origin = normalize_domain_name(tokens[1])
+            elif directive == '$TTL' and len(tokens) == 2 and tokens[1].isdigit():
+                ttl = int(tokens[1])
+            else:
+                yield number, None, "unsupported directive"
+            continue
+        if '(' in tokens or ')' in tokens:
+            yield number, None, "multi-line records are not supported"
+            continue
+        if line[0] in ' \t':
+            if owner is None:
+                yield number, None, "missing owner name"
+                continue
+        else:
+            owner = absolute_name(tokens.pop(0), origin)
+        record_ttl, record_class = ttl, 'IN'
+        while len(tokens) > 2 and (tokens[0].isdigit() or tokens[0].upper() in ZONE_FILE_CLASSES):
+            if tokens[0].isdigit():
+                record_ttl = int(tokens.pop(0))
+            else:
+                record_class = tokens.pop(0).upper()
+        if len(tokens) != 2:
+            yield number, None, "expected a type and its data"
+            continue
+        record_type, data = tokens[0].upper(), tokens[1]
+        if record_type == QTYPE[5]:
+            data = absolute_name(data, origin)
+        yield number, (owner, record_class, record_type, data, record_ttl), None
+
+
+def csv_entries(lines, ttl=3600):
+    # name,class,type,data[,ttl] rows, with an optional header row
+    for number, row in enumerate(csv.reader(lines), 1):
+        if not row or (number == 1 and row[0].strip().lower() in ('name', 'domain_name')):
+            continue
+        if len(row) not in (4, 5) or (len(row) == 5 and not row[4].strip().isdigit()):
+            yield number, None, "expected name,class,type,data[,ttl]"
+            continue
+        fields = [field.strip() for field in row]
+        yield number, (normalize_domain_name(fields[0]), fields[1].upper(), fields[2].upper(), fields[3],
+                       int(fields[4]) if len(fields) == 5 else ttl), None
+
+
+def import_records(path, store, file_format=None, progress=None, processes=0):
+    # streams a master file or CSV into store as a single new snapshot, returning (records, [(line, error)]);
+    # names present in the file replace their registered records, processes > 0 validating them in parallel
+    if file_format is None:
+        file_format = 'csv' if path.lower().endswith('.csv') else 'zone'
+    errors, names, counts = [], set(), {'lines': 0, 'records': 0}
+    parsed = collections.deque()
+    started = time.time()
+
+    def parsed_fields(entries):
+        # parsing errors are collected here, the fields of the other lines wait in `parsed` for their validation
+        for number, fields, error in entries:
+            counts['lines'] = number
+            if progress is not None and number % IMPORT_PROGRESS_INTERVAL == 0:
+                progress(number, counts['records'], len(errors), number / max(time.time() - started, 1e-6))
+            if fields is None:
+                errors.append((number, error))
+                continue
+            parsed.append((number, fields))
+            yield fields[:4]
+
+    def operations(entries):
+        for domain_dic in validate_domain_entries(parsed_fields(entries), processes):
+            number, fields = parsed.popleft()
+            if domain_dic is None:
+                errors.append((number, "invalid %s" % invalid_domain_field(*fields[:4])))
+                continue
+            record = DNSResourceRecord(domain_dic['domain_name'], domain_dic['class'], domain_dic['qtype'],
+                                       domain_dic['data'], fields[4])
+            name = normalize_domain_name(record.domain_name)
+            counts['records'] += 1
+            if name in names:
+                yield 'add', record
+            else:
+                names.add(name)
+                yield 'replace', record
+
+    with paused_gc(), open(path, newline='' if file_format == 'csv' else None) as source:
+        entries = csv_entries(source) if file_format == 'csv' else zone_file_entries(source)
+        store.apply_snapshot(operations(entries))
+    if progress is not None:
+        progress(counts['lines'], counts['records'], len(errors), counts['lines'] / max(time.time() - started, 1e-6))
+    return counts['records'], sorted(errors)
+
+
+class PersistentMap(collections.abc.Mapping):
+
+    # hash trie mapping copied in constant time: copies share every node, and a map only modifies the nodes it
+    # owns, copying the others on the path of a change first (as NameTree), so a change costs the same whatever
+    # the size of the map. Nodes are [owner, 32 slots], a slot holding None, a child node, an entry (key, value)
+    # or, once the 64 hash bits are used up, a dict of the colliding entries
+    __slots__ = ('owner', 'root', 'size')
+    missing = object()
+
+    def __init__(self):
+        self.owner = object()
+        self.root = None
+        self.size = 0
+
+    def copy(self):
+        copy = PersistentMap()
+        copy.root, copy.size = self.root, self.size
+        # neither map may change the nodes they now share
+        self.owner = object()
+        return copy
+
+    def _own(self, node):
+        if node is None:
+            return [self.owner, [None] * 32]
+        if node[0] is self.owner:
+            return node
+        return [self.owner, list(node[1])]
+
+    def __len__(self):
+        return self.size
+
+    def get(self, key, default=None):
+        node, key_hash, shift = self.root, hash(key) & 0xFFFFFFFFFFFFFFFF, 0
+        while node is not None:
+            slot = node[1][(key_hash >> shift) & 31]
+            if slot.__class__ is list:
+                node, shift = slot, shift + 5
+            elif slot.__class__ is tuple:
+                return slot[1] if slot[0] == key else default
+            elif slot is None:
+                return default
+            else:
+                return slot.get(key, default)
+        return default
+
+    def __getitem__(self, key):
+        value = self.get(key, self.missing)
+        if value is self.missing:
+            raise KeyError(key)
+        return value
+
+    def __contains__(self, key):
+        return self.get(key, self.missing) is not self.missing
+
+    def __setitem__(self, key, value):
+        key_hash, shift = hash(key) & 0xFFFFFFFFFFFFFFFF, 0
+        node = self.root = self._own(self.root)
+        while True:
+            index = (key_hash >> shift) & 31
+            slot = node[1][index]
+            if slot.__class__ is list:
+                node = node[1][index] = self._own(slot)
+                shift += 5
+            elif slot is None:
+                node[1][index] = key, value
+                self.size += 1
+                return
+            elif slot.__class__ is tuple and slot[0] == key:
+                node[1][index] = key, value
+                return
+            elif slot.__class__ is tuple and shift < 60:
+                # moving the entry down to a new node, where the key goes on looking for a slot
+                child = node[1][index] = [self.owner, [None] * 32]
+                child[1][((hash(slot[0]) & 0xFFFFFFFFFFFFFFFF) >> (shift + 5)) & 31] = slot
+                node, shift = child, shift + 5
+            else:
+                bucket = dict([slot]) if slot.__class__ is tuple else dict(slot)
+                self.size += key not in bucket
+                bucket[key] = value
+                node[1][index] = bucket
+                return
+
+    def pop(self, key, default=None):
+        value = self.get(key, self.missing)
+        if value is self.missing:
+            return default
+        key_hash, shift = hash(key) & 0xFFFFFFFFFFFFFFFF, 0
+        node = self.root = self._own(self.root)
+        while True:
+            index = (key_hash >> shift) & 31
+            slot = node[1][index]
+            if slot.__class__ is list:
+                node = node[1][index] = self._own(slot)
+                shift += 5
+                continue
+            if slot.__class__ is tuple:
+                node[1][index] = None
+            else:
+                bucket = dict(slot)
+                del bucket[key]
+                node[1][index] = bucket
+            self.size -= 1
+            return value
+
+    def __delitem__(self, key):
+        if self.pop(key, self.missing) is self.missing:
+            raise KeyError(key)
+
+    def items(self):
+        nodes = [self.root] if self.root is not None else []
+        while nodes:
+            for slot in nodes.pop()[1]:
+                if slot.__class__ is list:
+                    nodes.append(slot)
+                elif slot.__class__ is tuple:
+                    yield slot
+                elif slot is not None:
+                    yield from slot.items()
+
+    def __iter__(self):
+        for key, _ in self.items():
+            yield key
+
+    def values(self):
+        for _, value in self.items():
+            yield value
+
+
+class NameTree:
+
+    # names keyed by their reversed labels (www.example.com under com -> example -> www), each node being
+    # [children, holds records, owner, number of names holding records at or below it]; nodes exist for the
+    # names holding records and the empty non-terminals above them. Copies share every node: a tree only modifies
+    # the nodes it owns and copies the others on the path of a change first, so the trees of published indexes
+    # never change (see RecordIndex.copy). mapping: the type of the children maps, PersistentMap for the trees
+    # copied for every change, so that copying the children of a node does not depend on their number
+    def __init__(self, root=None, mapping=dict):
+        self.owner = object()
+        self.mapping = mapping
+        self.root = root if root is not None else [mapping(), False, self.owner, 0]
+
+    @staticmethod
+    def labels(name):
+        return name.split('.')[::-1] if name else []
+
+    def copy(self):
+        return NameTree(self.root, self.mapping)
+
+    def _own(self, node):
+        if node[2] is self.owner:
+            return node
+        return [node[0].copy(), node[1], self.owner, node[3]]
+
+    def _find(self, name):
+        node = self.root
+        for label in self.labels(name):
+            node = node[0].get(label)
+            if node is None:
+                return None
+        return node
+
+    def __contains__(self, name):
+        node = self._find(name)
+        return node is not None and node[1]
+
+    def count(self, name):
+        # number of names holding records at or below name
+        node = self._find(name)
+        return 0 if node is None else node[3]
+
+    def names(self):
+        nodes = [('', self.root)]
+        while nodes:
+            name, node = nodes.pop()
+            if node[1]:
+                yield name
+            nodes.extend(('%s.%s' % (label, name) if name else label, child) for label, child in node[0].items())
+
+    def add(self, name):
+        if name in self:
+            return
+        node = self.root = self._own(self.root)
+        node[3] += 1
+        for label in self.labels(name):
+            child = node[0].get(label)
+            child = node[0][label] = [self.mapping(), False, self.owner, 0] if child is None else self._own(child)
+            node = child
+            node[3] += 1
+        node[1] = True
+
+    def remove(self, name):
+        if name not in self:
+            return
+        labels = self.labels(name)
+        path = [self._own(self.root)]
+        self.root = path[0]
+        for label in labels:
+            node = path[-1][0][label] = self._own(path[-1][0][label])
+            path.append(node)
+        path[-1][1] = False
+        for node in path:
+            node[3] -= 1
+        # pruning the branch up to the first node still holding records or other children
+        for label in reversed(labels):
+            node = path.pop()
+            if node[0] or node[1]:
+                break
+            del path[-1][0][label]
+
+    def depth(self, name):
+        # number of trailing labels of name present in the tree: the closest encloser of name
+        node, depth = self.root, 0
+        for label in self.labels(name):
+            node = node[0].get(label)
+            if node is None:
+                break
+            depth += 1
+        return depth
+
+
+class RecordIndex:
+
+    # registered records indexed by normalized (name, class, type), optionally overlaying a mapped zone or
+    # another index: names present here (or deleted here) shadow the same names in the base. A name exists
+    # (possibly as an empty non-terminal) when a name at or below it holds records here, or when more names at or
+    # below it hold records in the base than were deleted here.
+    # Published indexes are never modified: writers change a copy and publish it as a whole (see RecordStore).
+    # serial: the number of changes applied to the records since the first one (see RecordStore.history)
+    # An overlay is copied for every change, so its maps are PersistentMaps and a change costs the same whatever
+    # the size of the overlay; a single layer, built once (snapshots, flattened), uses plain dicts
+    def __init__(self, base=None):
+        mapping = dict if base is None else PersistentMap
+        self.base = base
+        self.records = mapping()
+        self.names = mapping()
+        self.deleted = NameTree(mapping=mapping)
+        self.tree = NameTree(mapping=mapping)
+        self.serial = 0
+
+    def copy(self):
+        # the maps are copied (sharing their nodes in overlays), their record lists and name sets (replaced,
+        # never modified), the tree nodes and the base are shared
+        index = RecordIndex(self.base)
+        index.records = self.records.copy()
+        index.names = self.names.copy()
+        index.deleted = self.deleted.copy()
+        index.tree = self.tree.copy()
+        index.serial = self.serial
+        return index
+
+    def flattened(self):
+        # a single layer holding the records of both layers, when the base is another index without base
+        if self.base is None:
+            return self.copy()
+        index = self.base.copy()
+        for name in itertools.chain(self.deleted.names(), list(self.names)):
+            index.remove(name)
+        for records in self.records.values():
+            for record in records:
+                index._insert(record)
+        return index
+
+    def lookup(self, domain_name, domain_class, domain_type):
+        key = record_key(domain_name, domain_class, domain_type)
+        records = self.records.get(key)
+        if records is not None:
+            return records
+        if self.base is None or key[0] in self.names or key[0] in self.deleted:
+            return []
+        return self.base.lookup(*key)
+
+    def has_name(self, domain_name):
+        name = normalize_domain_name(domain_name)
+        if name in self.names:
+            return True
+        return self.base is not None and name not in self.deleted and self.base.has_name(name)
+
+    def exists(self, name):
+        labels = NameTree.labels(name)
+        if self.tree.depth(name) == len(labels):
+            return True
+        return self.base is not None and self.base.count(name) > self.deleted.count(name)
+
+    def count(self, name):
+        # number of names holding records at or below name, for an index without base
+        return self.tree.count(name)
+
+    def match(self, domain_name):
+        # returns (owner, encloser): the closest existing ancestor of the name (the name itself when it exists,
+        # possibly as an empty non-terminal) and the owner of the records answering it, that is the name,
+        # the wildcard of its closest encloser, or None when neither exists (NXDOMAIN)
+        name = normalize_domain_name(domain_name)
+        labels = NameTree.labels(name)
+        depth = self.tree.depth(name)
+        if self.base is not None:
+            for base_depth in range(len(labels), depth, -1):
+                ancestor = '.'.join(reversed(labels[:base_depth]))
+                if self.base.count(ancestor) > self.deleted.count(ancestor):
+                    depth = base_depth
+                    break
+        if depth == len(labels):
+            return name, name
+        encloser = '.'.join(reversed(labels[:depth]))
+        if encloser and self.exists('*.' + encloser):
+            return '*.' + encloser, encloser
+        return None, encloser
+
+    def records_by_name(self, name):
+        if name in self.names:
+            return [record for key in self.names[name] for record in self.records[key]]
+        if self.base is None or name in self.deleted:
+            return []
+        return self.base.records_by_name(name)
+
+    def overlay_records(self):
+        for records in list(self.records.values()):
+            yield from records
+
+    def all_records(self):
+        yield from self.overlay_records()
+        if self.base is not None:
+            for record in self.base.all_records():
+                name = normalize_domain_name(record.domain_name)
+                if name not in self.names and name not in self.deleted:
+                    yield record
+
+    def apply(self, operation):
+        action = operation[0]
+        if action == 'add':
+            self.insert(operation[1])
+        elif action == 'replace':
+            self.remove(operation[1].domain_name)
+            self.insert(operation[1])
+        elif action == 'delete':
+            return self.remove(operation[1])
+
+    def insert(self, record):
+        key = record_key(record.domain_name, record.record_class, record.record_type)
+        if key[0] not in self.names and self.base is not None and key[0] not in self.deleted:
+            # copying the zone records of this name up, so the overlay keeps shadowing them
+            for base_record in self.base.records_by_name(key[0]):
+                self._insert(base_record)
+        self.deleted.remove(key[0])
+        self._insert(record)
+
+    def _insert(self, record):
+        key = record_key(record.domain_name, record.record_class, record.record_type)
+        self.records[key] = self.records.get(key, []) + [record]
+        if key[0] not in self.names:
+            self.tree.add(key[0])
+        self.names[key[0]] = self.names.get(key[0], frozenset()) | {key}
+
+    def remove(self, domain_name):
+        name = normalize_domain_name(domain_name)
+        keys = self.names.pop(name, frozenset())
+        for key in keys:
+            self.records.pop(key, None)
+        if keys:
+            self.tree.remove(name)
+        if self.base is not None and self.base.has_name(name):
+            self.deleted.add(name)
+            return True
+        return bool(keys)
+
+
+class RecordStore:
+
+    # resident copy of the persistent records, indexed by normalized (name, class, type)
+    # records.p (or a mapped zone file) holds a compacted snapshot, newer changes are appended to the journal.
+    # The index is published copy-on-write: writers (serialized by the lock) change a copy of the current index
+    # and swap the reference, so readers never lock and a query reading snapshot() sees a single version;
+    # an old version (and the zone file it maps) is released once the last reader drops it.
+    # Once the journal outgrows compact_ratio of the snapshot (and compact_min_size bytes), a background
+    # compaction writes a new snapshot, so the amortized cost of a change does not depend on the zone size
+    def __init__(self, path=PERSISTENT_RECORDS, journal_path=None, compact_ratio=JOURNAL_COMPACT_RATIO,
+                 compact_min_size=JOURNAL_COMPACT_MIN_SIZE, zone_path=None):
+        self.path = path
+        self.zone_path = zone_path
+        self.journal = RecordJournal(journal_path or (zone_path or path) + '.journal')
+        self.compact_ratio = compact_ratio
+        self.compact_min_size = compact_min_size
+        self.compaction = None
+        self.lock = threading.RLock()
+        self._index = RecordIndex()
+        self._snapshot_id = None
+        self._generation = 0
+        self._journal_id = None
+        self._journal_offset = None
+        self._journal_entries = 0
+        self._listeners = []
+        # (serial, name, records of the name before the change) of the latest changes, for IXFR
+        self.changes = collections.deque(maxlen=TRANSFER_HISTORY)
+
+    def __len__(self):
+        return sum(1 for _ in self.records())
+
+    def add_listener(self, callback):
+        # callback(names) runs after every change, names being None when everything may have changed
+        self._listeners.append(callback)
+
+    def _notify(self, names):
+        for callback in self._listeners:
+            callback(names)
+
+    def is_empty(self):
+        for _ in self.records():
+            return False
+        return True
+
+    def records(self):
+        return self._index.all_records()
+
+    def _snapshot_identity(self):
+        try:
+            stat = os.stat(self.zone_path or self.path)
+        except FileNotFoundError:
+            return None
+        return stat.st_ino, stat.st_mtime_ns, stat.st_size
+
+    def load(self):
+        with self.lock, paused_gc():
+            snapshot_id = self._snapshot_identity()
+            if self.zone_path is not None:
+                try:
+                    zone = MappedZone(self.zone_path)
+                    index, generation = RecordIndex(zone), zone.generation
+                except FileNotFoundError:
+                    # a new zone: the first compaction writes its file
+                    index, generation = RecordIndex(RecordIndex()), 0
+            else:
+                base, generation = RecordIndex(), 0
+                try:
+                    with open(self.path, "rb") as records_file:
+                        for name, record in pickle.load(records_file):
+                            if isinstance(record, DNSResourceRecord):
+                                base.insert(record)
+                        try:
+                            generation = pickle.load(records_file)['generation']
+                        except EOFError:
+                            pass
+                except FileNotFoundError:
+                    pass
+                # changes go to a small overlay, so copying the index for every change stays cheap
+                index = RecordIndex(base)
+            self._generation = generation
+            self._recover_journal(generation)
+            self._journal_id = self.journal.identity()[0]
+            changes = collections.deque(maxlen=TRANSFER_HISTORY)
+            self._journal_offset, self._journal_entries = self._replay(index, 0, changes=changes)
+            # the history goes on over a snapshot of the version served last (compactions of mapped zones)
+            if index.serial - self._journal_entries == self._index.serial:
+                self.changes.extend(changes)
+            else:
+                self.changes = changes
+            self._index, self._snapshot_id = index, snapshot_id
+        self._notify(None)
+
+    def _replay(self, index, offset, names=None, changes=None):
+        # returns the new journal offset, None when the journal belongs to another snapshot generation
+        entries = self._journal_entries if offset else 0
+        current = offset > 0
+        for offset, operation in self.journal.read(offset):
+            if operation[0] == 'generation':
+                current = operation[1] == self._generation
+                if not current:
+                    break
+                continue
+            if operation[0] == 'serial':
+                index.serial = operation[1]
+                continue
+            self._apply(index, operation, self.changes if changes is None else changes)
+            if names is not None:
+                names.add(operation_name(operation))
+            entries += 1
+        if not current:
+            return None, 0
+        return offset, entries
+
+    def refresh(self):
+        # follow changes written by other processes (e.g. the registration cli)
+        with self.lock:
+            snapshot_id = self._snapshot_identity()
+            journal_id, journal_size = self.journal.identity()
+            if snapshot_id != self._snapshot_id or journal_id != self._journal_id:
+                self.load()
+                return True
+            if self._journal_offset is None or journal_size <= self._journal_offset:
+                return False
+            names, index = set(), self._index.copy()
+            self._journal_offset, self._journal_entries = self._replay(index, self._journal_offset, names)
+            self._index = index
+        self._notify(names)
+        return True
+
+    def watch(self, interval=RECORDS_REFRESH_INTERVAL):
+        def refresh_loop():
+            while True:
+                time.sleep(interval)
+                try:
+                    self.refresh()
+                except Exception:
+                    traceback.print_exc(file=sys.stderr)
+
+        thread = threading.Thread(target=refresh_loop, daemon=True)
+        thread.start()
+        return thread
+
+    def apply(self, operations):
+        # durably records and applies ('add', record), ('replace', record) and ('delete', name) changes
+        operations = list(operations)
+        with self.lock, self.journal.locked():
+            self.refresh()
+            if self._journal_offset is None:
+                self._journal_id, self._journal_offset = self.journal.reset(self._generation, self._index.serial)
+            self._journal_offset = self.journal.append(operations, self._journal_offset)
+            self._publish(operations)
+            self._journal_entries += len(operations)
+            self._journal_id = self.journal.identity()[0]
+            snapshot_size = self._snapshot_id[2] if self._snapshot_id is not None else 0
+            if self._journal_offset > max(self.compact_min_size, self.compact_ratio * snapshot_size) and \
+                    (self.compaction is None or not self.compaction.is_alive()):
+                self.compaction = threading.Thread(target=self._compact_in_background, daemon=True,
+                                                   args=(self._index, self._journal_offset, self._generation))
+                self.compaction.start()
+        self._notify(set(operation_name(operation) for operation in operations))
+
+    def apply_snapshot(self, operations):
+        # bulk changes (imports) skip the journal: they are applied to the resident index as they stream in
+        # and written out as a single new snapshot, so either all of them or none are persisted
+        with self.lock, self.journal.locked():
+            self.refresh()
+            # too many changes to keep: IXFR clients older than the import get the whole zone
+            self._publish(operations, history=False)
+            self.changes.clear()
+            self._compact()
+        self._notify(None)
+
+    def _publish(self, operations, history=True):
+        index = self._index.copy()
+        changes = self.changes if history else None
+        for operation in operations:
+            self._apply(index, operation, changes)
+        self._index = index
+
+    @staticmethod
+    def _apply(index, operation, changes):
+        # applies operation as the next serial, logging the previous records of its name into changes (if any)
+        if changes is None:
+            index.serial += 1
+            return index.apply(operation)
+        name = operation_name(operation)
+        previous = index.records_by_name(name)
+        result = index.apply(operation)
+        index.serial += 1
+        changes.append((index.serial, name, previous))
+        return result
+
+    def snapshot(self):
+        # the current index, unchanged for as long as the caller holds it
+        return self._index
+
+    def history(self, serial):
+        # (index, changes published after serial): the current index and its changes since the version of the
+        # 32-bit SOA serial, None instead of the changes when the history does not go back that far
+        with self.lock:
+            index = self._index
+            # the latest version with that SOA serial (RFC 1982 serial arithmetic)
+            serial = index.serial - ((index.serial - serial) % (1 << 32))
+            if serial == index.serial:
+                return index, []
+            if serial < 0 or not self.changes or self.changes[0][0] > serial + 1:
+                return index, None
+            return index, list(itertools.islice(self.changes, serial + 1 - self.changes[0][0], None))
+
+    def compact(self):
+        with self.lock, self.journal.locked():
+            self.refresh()
+            self._compact()
+
+    def _write_snapshot(self, index, generation):
+        # writes the records of index as the snapshot of generation next to the current one, returning its path
+        if self.zone_path is not None:
+            path = self.zone_path + '.next'
+            MappedZone.write(path, index.all_records(), generation)
+        else:
+            path = self.path + '.next'
+            resource_records = [[record.domain_name, record] for record in index.all_records()]
+            write_atomically(path, pickle.dumps(resource_records, pickle.HIGHEST_PROTOCOL) +
+                             pickle.dumps({'generation': generation}, pickle.HIGHEST_PROTOCOL))
+        return path
+
+    def _compact_in_background(self, index, offset, generation):
+        # index: the published version matching the first offset bytes of the journal of generation.
+        # Its snapshot is written without the locks; then, with them, the changes journaled meanwhile move to
+        # the journal of the new generation and both files are renamed into place (a crash between the two
+        # renames is recovered by load). Abandoned when the store got a new snapshot in the meantime
+        try:
+            snapshot_path = self._write_snapshot(index, generation + 1)
+            base = RecordIndex(index.flattened()) if self.zone_path is None else None
+            with self.lock, self.journal.locked():
+                self.refresh()
+                if self._generation != generation or self._journal_offset is None:
+                    os.remove(snapshot_path)
+                    return
+                tail = [operation for _, operation in self.journal.read(offset)]
+                with open(self.journal.path, "rb") as journal_file:
+                    journal_file.seek(offset)
+                    frames = journal_file.read(self._journal_offset - offset)
+                next_journal = self.journal.path + '.next'
+                write_atomically(next_journal, self.journal.encode([('generation', generation + 1),
+                                                                    ('serial', index.serial)]) + frames)
+                os.replace(snapshot_path, self.zone_path or self.path)
+                try:
+                    os.replace(next_journal, self.journal.path)
+                except FileNotFoundError:
+                    # already recovered by a process loading the new snapshot
+                    pass
+                if self.zone_path is not None:
+                    self.load()
+                    return
+                # the changes journaled meanwhile go over the flattened version, as they went over index
+                base.serial = index.serial
+                for operation in tail:
+                    self._apply(base, operation, None)
+                self._generation = generation + 1
+                self._index = base
+                self._snapshot_id = self._snapshot_identity()
+                self._journal_id, self._journal_offset = self.journal.identity()
+                self._journal_entries = len(tail)
+        except Exception:
+            traceback.print_exc(file=sys.stderr)
+
+    def _recover_journal(self, generation):
+        # a compaction stopped between the renames of its snapshot and of its journal left the journal of the
+        # snapshot (generation) in .next, where the current journal belongs to the previous snapshot
+        next_journal = RecordJournal(self.journal.path + '.next')
+        first = next(next_journal.read(), None)
+        if first is None or first[1] != ('generation', generation):
+            return
+        current = next(self.journal.read(), None)
+        if current is None or current[1] != ('generation', generation):
+            try:
+                os.replace(next_journal.path, self.journal.path)
+            except FileNotFoundError:
+                pass
+
+    def _compact(self):
+        # the new snapshot carries the next generation, so a crash before the journal reset
+        # leaves an old-generation journal that is ignored instead of replayed twice
+        generation = self._generation + 1
+        os.replace(self._write_snapshot(self._index, generation), self.zone_path or self.path)
+        self.journal.reset(generation, self._index.serial)
+        if self.zone_path is not None:
+            # remapping the new zone file
+            self.load()
+        else:
+            self._generation = generation
+            index = RecordIndex(self._index.flattened())
+            index.serial = self._index.serial
+            self._index = index
+            self._snapshot_id = self._snapshot_identity()
+            self._journal_id, self._journal_offset = self.journal.identity()
+            self._journal_entries = 0
+
+    def lookup(self, domain_name, domain_class, domain_type):
+        return self._index.lookup(domain_name, domain_class, domain_type)
+
+    def has_name(self, domain_name):
+        return self._index.has_name(domain_name)
+
+    def match(self, domain_name):
+        return self._index.match(domain_name)
+
+
+class ResponseCache:
+
+    # bounded LRU of packed answers keyed by the normalized question, each entry remembering
+    # the names its answer was built from (the question and any CNAME targets) for invalidation;
+    # also holds the flattened CNAME chains (see check_domain_entry)
+    def __init__(self, size=RESPONSE_CACHE_SIZE):
+        self.size = size
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.version = 0
+        self._entries = collections.OrderedDict()
+        self._keys_by_name = {}
+
+    def __len__(self):
+        return len(self._entries)
+
+    def get(self, key):
+        with self.lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return entry[0]
+
+    def put(self, key, packed, names, version):
+        # answers computed before a concurrent invalidation (version changed) are not cached
+        if self.size <= 0:
+            return
+        with self.lock:
+            if version != self.version:
+                return
+            if key in self._entries:
+                self._discard(key)
+            self._entries[key] = packed, names
+            for name in names:
+                self._keys_by_name.setdefault(name, set()).add(key)
+            while len(self._entries) > self.size:
+                self._discard(next(iter(self._entries)))
+
+    def _discard(self, key):
+        packed, names = self._entries.pop(key)
+        for name in names:
+            keys = self._keys_by_name.get(name)
+            if keys is not None:
+                keys.discard(key)
+                if not keys:
+                    del self._keys_by_name[name]
+
+    def invalidate(self, names):
+        with self.lock:
+            self.version += 1
+            if names is None:
+                self._entries.clear()
+                self._keys_by_name.clear()
+                return
+            for name in names:
+                for key in list(self._keys_by_name.get(name, ())):
+                    self._discard(key)
+
+    def clear(self):
+        self.invalidate(None)
+
+    def stats(self):
+        return {'size': len(self._entries), 'capacity': self.size, 'hits': self.hits, 'misses': self.misses}
+
+
+response_cache = ResponseCache()
+cname_chains = ResponseCache(CNAME_CHAIN_CACHE_SIZE)
+
+
+class CnameChainError(Exception):
+    # CNAME chain looping back on itself or longer than CNAME_CHAIN_MAX_LENGTH
+    pass
+
+
+def invalidate_caches(names):
+    # a name appearing or vanishing also changes whether its ancestors exist
+    if names is not None:
+        names = set(names).union(*(name_ancestors(name) for name in names))
+    # chains first: an answer cached in between must be built from the new chains, as answers cached from the
+    # old ones are dropped by the invalidation of the response cache that follows
+    cname_chains.invalidate(names)
+    response_cache.invalidate(names)
+
+
+class NegativeFilter:
+
+    # Bloom filter over the names of a record store (with their empty non-terminals), telling names that
+    # certainly do not exist apart without touching the store; new names are added as they are registered,
+    # deleted ones only leave false positives (answered by the regular lookup) until the next rebuild.
+    # Rebuilds (on loads, or once the filter is full) run in a background thread when background is set,
+    # so startup does not depend on the zone size: meanwhile every name takes the regular lookup
+    def __init__(self, bits_per_name=NEGATIVE_FILTER_BITS_PER_NAME, hashes=NEGATIVE_FILTER_HASHES, background=False):
+        self.bits_per_name = bits_per_name
+        self.hashes = hashes
+        self.background = background
+        self.lock = threading.Lock()
+        self.store = None
+        # (bit array, bit count, parents of the wildcard names), replaced as a whole by rebuilds
+        self.filter = None
+        self.capacity = 0
+        self.count = 0
+        self.rejected = 0
+        # names registered while a rebuild reads the store, added to the new filter
+        self.building = False
+        self.pending = set()
+        self.generation = 0
+
+    def attach(self, store):
+        # follows the changes of store, built when the store loads
+        self.store = store
+        self.filter = None
+        store.add_listener(self.update)
+
+    def positions(self, name, size):
+        name_hash = MappedZone.name_hash(name.encode())
+        first, second = name_hash & 0xFFFFFFFF, (name_hash >> 32) | 1
+        return [(first + position * second) % size for position in range(self.hashes)]
+
+    def _add(self, state, name):
+        bits, size, wildcards = state
+        if name.startswith('*.'):
+            wildcards.add(name[2:])
+        for position in self.positions(name, size):
+            bits[position >> 3] |= 1 << (position & 7)
+
+    def update(self, names):
+        with self.lock:
+            if names is not None and self.building:
+                self.pending.update(names)
+                return
+            if names is not None and self.filter is not None and self.count < self.capacity:
+                for name in names:
+                    for ancestor in [name] + name_ancestors(name):
+                        self._add(self.filter, ancestor)
+                        self.count += 1
+                return
+            # the current filter may miss names from now on
+            self.filter = None
+            self.building = True
+            self.pending = set()
+            self.generation += 1
+            generation = self.generation
+        if self.background:
+            threading.Thread(target=self._rebuild, args=(generation,), daemon=True).start()
+        else:
+            self._rebuild(generation)
+
+    def rebuild(self):
+        self.update(None)
+
+    def _rebuild(self, generation):
+        # reads the store without the lock, the names registered meanwhile being pending
+        names = set()
+        for record in self.store.records():
+            name = normalize_domain_name(record.domain_name)
+            if name not in names:
+                names.add(name)
+                names.update(name_ancestors(name))
+        with self.lock:
+            if generation != self.generation:
+                # superseded by a later rebuild
+                return
+            for name in self.pending:
+                names.add(name)
+                names.update(name_ancestors(name))
+            # room for the current names and as many new ones before the next rebuild
+            self.capacity = 2 * max(len(names), 1024)
+            self.count = len(names)
+            size = self.capacity * self.bits_per_name
+            state = bytearray((size + 7) >> 3), size, set()
+            for name in names:
+                self._add(state, name)
+            self.filter, self.building, self.pending = state, False, set()
+
+    def missing(self, name):
+        # True only when name certainly does not exist in the served store and no wildcard could answer it
+        state = self.filter
+        if state is None or self.store is not record_store:
+            return False
+        bits, size, wildcards = state
+        for position in self.positions(name, size):
+            if not bits[position >> 3] & (1 << (position & 7)):
+                break
+        else:
+            return False
+        if wildcards and any(ancestor in wildcards for ancestor in name_ancestors(name)):
+            return False
+        self.rejected += 1
+        return True
+
+    def stats(self):
+        wildcards = self.filter[2] if self.filter is not None else ()
+        return {'names': self.count, 'capacity': self.capacity, 'wildcards': len(wildcards),
+                'rejected': self.rejected, 'building': self.building}
+
+
+negative_filter = NegativeFilter(background=True)
+
+# header of the NXDOMAIN answers built by handle_domain_entries, after the request id
+NXDOMAIN_HEADER = DNSRecord(DNSHeader(rcode=RCODE.NXDOMAIN, qr=1, ra=1), q=DNSQuestion('nxdomain')).pack()[2:12]
+
+
+def nxdomain_response(question, data):
+    return struct.pack('>H', question.id) + NXDOMAIN_HEADER + data[12:question.end]
+
+
+class UpstreamPool:
+
+    # reusable sockets to one upstream resolver: connected UDP sockets and TCP connections, each used by one
+    # query at a time and kept (up to `size` idle ones of each kind) for the next queries
+    def __init__(self, address, size=FORWARD_POOL_SIZE, timeout=FORWARD_TIMEOUT):
+        self.address = address
+        self.size = size
+        self.timeout = timeout
+        self.idle_udp = queue.LifoQueue()
+        self.idle_tcp = queue.LifoQueue()
+        self.opened = 0
+
+    def _open(self, socket_type):
+        family, _, _, _, address = socket.getaddrinfo(self.address[0], self.address[1], type=socket_type)[0]
+        sock = socket.socket(family, socket_type)
+        sock.settimeout(self.timeout)
+        try:
+            sock.connect(address)
+        except OSError:
+            sock.close()
+            raise
+        self.opened += 1
+        return sock
+
+    def _release(self, idle, sock):
+        if idle.qsize() < self.size:
+            idle.put(sock)
+        else:
+            sock.close()
+
+    def query(self, packet, tcp=False):
+        # returns the response to packet, raising OSError (timeouts included) when the upstream does not answer
+        idle = self.idle_tcp if tcp else self.idle_udp
+        try:
+            sock, reused = idle.get_nowait(), True
+        except queue.Empty:
+            sock, reused = self._open(socket.SOCK_STREAM if tcp else socket.SOCK_DGRAM), False
+        try:
+            response = self._exchange_tcp(sock, packet) if tcp else self._exchange_udp(sock, packet)
+        except OSError:
+            sock.close()
+            if tcp and reused:
+                # the upstream may have closed an idle connection
+                return self.query(packet, tcp)
+            raise
+        self._release(idle, sock)
+        return response
+
+    @staticmethod
+    def _exchange_udp(sock, packet):
+        sock.send(packet)
+        while True:
+            response = sock.recv(65535)
+            # skipping late answers to queries that timed out on this socket
+            if response[:2] == packet[:2]:
+                return response
+
+    @staticmethod
+    def _exchange_tcp(sock, packet):
+        sock.sendall(struct.pack('>H', len(packet)) + packet)
+        while True:
+            size = UpstreamPool._receive(sock, 2)
+            response = UpstreamPool._receive(sock, struct.unpack('>H', size)[0])
+            if response[:2] == packet[:2]:
+                return response
+
+    @staticmethod
+    def _receive(sock, size):
+        data = b''
+        while len(data) < size:
+            chunk = sock.recv(size - len(data))
+            if not chunk:
+                raise ConnectionError("Upstream closed the connection")
+            data += chunk
+        return data
+
+    def close(self):
+        for idle in (self.idle_udp, self.idle_tcp):
+            while not idle.empty():
+                idle.get_nowait().close()
+
+
+# cached upstream answer: its packet, the (offset, ttl) of its record TTL fields, its TTL and expiry
+ForwardedAnswer = collections.namedtuple('ForwardedAnswer', ['packed', 'ttl_fields', 'ttl', 'expires'])
+
+
+class Forwarder:
+
+    # answers the questions for names missing from the records with upstream resolvers, tried in order.
+    # Answers are kept in a shared LRU cache of `cache_size` entries until their smallest TTL expires (served
+    # with the remaining TTLs) and refreshed in the background when hit during the last
+    # FORWARD_PREFETCH_FRACTION of their TTL; concurrent misses of the same question share one upstream query.
+    # Questions missing from the cache wait for the upstreams in `threads` threads of their own (see submit),
+    # at most `queue_size` of them running or waiting, so a flood of random names never holds the handlers
+    clock = staticmethod(time.monotonic)
+
+    def __init__(self, upstreams, timeout=FORWARD_TIMEOUT, cache_size=FORWARD_CACHE_SIZE,
+                 pool_size=FORWARD_POOL_SIZE, threads=FORWARD_THREADS, queue_size=FORWARD_QUEUE_SIZE):
+        self.pools = [UpstreamPool(upstream, pool_size, timeout) for upstream in upstreams]
+        self.timeout = timeout
+        self.cache_size = cache_size
+        self.threads = threads
+        self.queue_size = queue_size
+        self.lock = threading.Lock()
+        self.cache = collections.OrderedDict()
+        self.in_flight = {}
+        self.prefetcher = None
+        self.executor = None
+        self.pending = 0
+        self.queries = self.hits = self.coalesced = self.prefetches = self.shed = 0
+        self.upstream_queries = self.upstream_errors = self.tcp_fallbacks = self.failures = 0
+
+    def cached_answer(self, key, request_id, data=None):
+        # the answer to the question key when it is cached, None otherwise
+        entry = self._cached(key)
+        if entry is None:
+            return None
+        self.queries += 1
+        return patch_response(self._remaining(entry), request_id, data)
+
+    def answer(self, key, request_id, data=None):
+        # the packed answer to the (normalized name, qtype, qclass) question key, SERVFAIL when no upstream answers;
+        # blocks while the upstreams are queried
+        packed_answer = self.cached_answer(key, request_id, data)
+        if packed_answer is not None:
+            return packed_answer
+        self.queries += 1
+        entry = self._fetch(key)
+        if entry is None:
+            self.failures += 1
+            answer = DNSRecord(DNSHeader(id=request_id, rcode=RCODE.SERVFAIL, qr=1, ra=1),
+                               q=DNSQuestion(key[0], key[1], key[2]))
+            return patch_response(answer.pack(), request_id, data)
+        return patch_response(self._remaining(entry), request_id, data)
+
+    def submit(self, function, *args):
+        # runs function(*args) in a forwarder thread, False (counted as shed) when queue_size are already pending
+        with self.lock:
+            if self.pending >= self.queue_size:
+                self.shed += 1
+                return False
+            self.pending += 1
+            if self.executor is None:
+                self.executor = concurrent.futures.ThreadPoolExecutor(self.threads)
+        self.executor.submit(self._run, function, args)
+        return True
+
+    def _run(self, function, args):
+        try:
+            function(*args)
+        except Exception:
+            traceback.print_exc(file=sys.stderr)
+        finally:
+            with self.lock:
+                self.pending -= 1
+
+    def _remaining(self, entry):
+        # the cached packet with the TTLs left
+        if not entry.ttl_fields:
+            return entry.packed
+        elapsed = int(entry.ttl - (entry.expires - self.clock()))
+        packed = bytearray(entry.packed)
+        for offset, ttl in entry.ttl_fields:
+            struct.pack_into('>I', packed, offset, max(ttl - elapsed, 0))
+        return packed
+
+    def _cached(self, key):
+        now = self.clock()
+        with self.lock:
+            entry = self.cache.get(key)
+            if entry is None:
+                return None
+            if now >= entry.expires:
+                del self.cache[key]
+                return None
+            self.cache.move_to_end(key)
+            self.hits += 1
+            prefetch = entry.expires - now < entry.ttl * FORWARD_PREFETCH_FRACTION and key not in self.in_flight
+            if prefetch:
+                self.prefetches += 1
+                if self.prefetcher is None:
+                    self.prefetcher = concurrent.futures.ThreadPoolExecutor(FORWARD_PREFETCH_THREADS)
+        if prefetch:
+            self.prefetcher.submit(self._fetch, key)
+        return entry
+
+    def _fetch(self, key):
+        # one upstream query per question at a time: later callers wait for the answer of the first one
+        with self.lock:
+            future = self.in_flight.get(key)
+            leader = future is None
+            if leader:
+                future = self.in_flight[key] = concurrent.futures.Future()
+            else:
+                self.coalesced += 1
+        if not leader:
+            try:
+                return future.result(self.timeout * (2 * len(self.pools) + 1))
+            except concurrent.futures.TimeoutError:
+                return None
+        entry = None
+        try:
+            entry = self._query_upstreams(key)
+        finally:
+            with self.lock:
+                if entry is not None:
+                    self.cache[key] = entry
+                    self.cache.move_to_end(key)
+                    while len(self.cache) > self.cache_size:
+                        self.cache.popitem(last=False)
+                del self.in_flight[key]
+            future.set_result(entry)
+        return entry
+
+    def _query_upstreams(self, key):
+        packet = DNSRecord(DNSHeader(id=random.getrandbits(16), rd=1), q=DNSQuestion(key[0], key[1], key[2])).pack()
+        for pool in self.pools:
+            try:
+                self.upstream_queries += 1
+                response = pool.query(packet)
+                if response[2] & 0x02:
+                    # truncated: asking again over TCP
+                    self.tcp_fallbacks += 1
+                    response = pool.query(packet, tcp=True)
+                return self._entry(response)
+            except (OSError, struct.error, IndexError, ValueError):
+                self.upstream_errors += 1
+        return None
+
+    def _entry(self, response):
+        # raises ValueError for answers that should not be used
+        rcode = response[3] & 0xF
+        if rcode not in (RCODE_NOERROR, RCODE_NXDOMAIN):
+            raise ValueError("Upstream answered with rcode %d" % rcode)
+        ttl_fields = record_ttl_fields(response)
+        ttl = min([ttl for _, ttl in ttl_fields] or [FORWARD_NEGATIVE_TTL])
+        ttl = min(ttl, FORWARD_MAX_TTL)
+        return ForwardedAnswer(bytes(response), ttl_fields, ttl, self.clock() + ttl)
+
+    def close(self):
+        for pool in self.pools:
+            pool.close()
+        if self.prefetcher is not None:
+            self.prefetcher.shutdown(wait=False)
+        if self.executor is not None:
+            self.executor.shutdown(wait=False)
+
+    def stats(self):
+        return {'upstreams': ['%s:%d' % pool.address for pool in self.pools], 'queries': self.queries,
+                'cache_size': len(self.cache), 'cache_capacity': self.cache_size, 'hits': self.hits,
+                'coalesced': self.coalesced, 'prefetches': self.prefetches, 'threads': self.threads,
+                'pending': self.pending, 'queue_size': self.queue_size, 'shed': self.shed,
+                'upstream_queries': self.upstream_queries, 'upstream_errors': self.upstream_errors,
+                'tcp_fallbacks': self.tcp_fallbacks, 'failures': self.failures,
+                'sockets_opened': sum(pool.opened for pool in self.pools)}
+
+
+def parse_upstream(text):
+    # host, host:port or [ipv6]:port
+    if text.startswith('['):
+        host, _, port = text[1:].partition(']')
+        port = port.lstrip(':')
+    elif text.count(':') == 1:
+        host, port = text.split(':')
+    else:
+        host, port = text, ''
+    return host, int(port) if port else DNS_PORT
+
+
+def create_forwarder(args):
+    if not args.forward:
+        return None
+    upstreams = [parse_upstream(upstream) for upstream in args.forward.split(',') if upstream]
+    return Forwarder(upstreams, args.forward_timeout, args.forward_cache_size, threads=args.forward_threads,
+                     queue_size=args.forward_queue_size)
+
+
+def in_zone(name, zone):
+    # whether a normalized name is zone or below it, '' being the root zone
+    return not zone or name == zone or name.endswith('.' + zone)
+
+
+def record_identity(record):
+    return normalize_domain_name(record.domain_name), record.record_class, record.record_type, record.data, record.ttl
+
+
+def transfer_request(data):
+    # AXFR or IXFR query, answered with a stream of messages
+    try:
+        return struct.unpack_from('>H', data, name_end(data, 12))[0] in (QTYPE.AXFR, QTYPE.IXFR)
+    except struct.error:
+        return False
+
+
+class ZoneTransfers:
+
+    # zones replicated to secondary servers with AXFR (RFC 5936) and IXFR (RFC 1995), under a synthesized SOA
+    # whose serial counts the changes of the record store, so every process following the journal announces the
+    # same serial. A transfer reads a single snapshot of the records and is streamed in messages of about
+    # TRANSFER_MESSAGE_SIZE bytes. IXFR sends the records changed since the serial of the client, condensed
+    # into one difference, while the store history goes back that far, and the whole zone otherwise
+    def __init__(self, zones=(), allowed=TRANSFER_ALLOWED):
+        self.configure(zones, allowed)
+
+    def configure(self, zones, allowed=TRANSFER_ALLOWED):
+        self.zones = set(normalize_domain_name(zone) for zone in zones)
+        self.allowed = [ipaddress.ip_network(network, strict=False) for network in allowed.split(',') if network]
+        self.transfers = self.incremental = self.refused = self.records_sent = 0
+
+    def zones_of(self, name):
+        return [zone for zone in self.zones if in_zone(name, zone)]
+
+    def permitted(self, client_address):
+        if client_address is None:
+            return False
+        address = ipaddress.ip_address(client_address[0].split('%', 1)[0])
+        return any(address in network for network in self.allowed)
+
+    @staticmethod
+    def soa(zone, serial):
+        times = serial % (1 << 32), SOA_REFRESH, SOA_RETRY, SOA_EXPIRE, SOA_MINIMUM
+        return RR(zone or '.', QTYPE.SOA, ttl=SOA_TTL,
+                  rdata=SOA('ns.' + zone if zone else 'ns', 'hostmaster.' + zone if zone else 'hostmaster', times))
+
+    def answer(self, request, data, client_address, udp):
+        # the messages answering an SOA, AXFR or IXFR question for a zone, None for other names
+        question = request.q
+        zone = normalize_domain_name(question.qname)
+        if zone not in self.zones:
+            return None if question.qtype == QTYPE.SOA else [error_response(data, RCODE.NOTAUTH)]
+        store = get_record_store()
+        if question.qtype == QTYPE.SOA:
+            answer = DNSRecord(DNSHeader(id=request.header.id, qr=1, aa=1, ra=1), q=question)
+            answer.add_answer(self.soa(zone, store.snapshot().serial))
+            return [answer.pack()]
+        if not self.permitted(client_address):
+            self.refused += 1
+            return [error_response(data, RCODE.REFUSED)]
+        if question.qtype == QTYPE.AXFR:
+            if udp:
+                # RFC 5936: AXFR is a TCP only exchange
+                return [error_response(data, RCODE.FORMERR)]
+            return self.stream(data, self.full_records(zone, store.snapshot()))
+        client_soa = [record for record in request.auth if record.rtype == QTYPE.SOA]
+        if not client_soa:
+            return [error_response(data, RCODE.FORMERR)]
+        index, changes = store.history(client_soa[0].rdata.times[0])
+        if udp or changes == []:
+            # the current SOA alone: the client is up to date or asks again over TCP
+            return [self.soa_message(data, zone, index.serial)]
+        if changes is None:
+            return self.stream(data, self.full_records(zone, index))
+        self.incremental += 1
+        return self.stream(data, self.changed_records(zone, index, changes))
+
+    def full_records(self, zone, index):
+        soa = self.soa(zone, index.serial)
+        yield soa
+        for record in index.all_records():
+            if in_zone(normalize_domain_name(record.domain_name), zone):
+                yield record
+        yield soa
+
+    def changed_records(self, zone, index, changes):
+        # the records of the names changed since the client serial that are gone, between the old and the
+        # current SOA, then the new ones followed by the current SOA
+        previous = {}
+        for serial, name, records in changes:
+            if name not in previous and in_zone(name, zone):
+                previous[name] = records
+        deleted, added = [], []
+        for name, records in previous.items():
+            current = index.records_by_name(name)
+            current_identities = set(record_identity(record) for record in current)
+            previous_identities = set(record_identity(record) for record in records)
+            deleted.extend(record for record in records if record_identity(record) not in current_identities)
+            added.extend(record for record in current if record_identity(record) not in previous_identities)
+        soa = self.soa(zone, index.serial)
+        yield soa
+        yield self.soa(zone, changes[0][0] - 1)
+        yield from deleted
+        yield soa
+        yield from added
+        yield soa
+
+    @staticmethod
+    def resource_record(record):
+        # RR of a registered record, None for records that cannot be encoded
+        if isinstance(record, RR):
+            return record
+        data = get_record_data(record)
+        if data is None:
+            return None
+        return RR(record.domain_name, data[0], getattr(CLASS, record.record_class), record.ttl, data[1])
+
+    @staticmethod
+    def message_buffer(data):
+        # buffer starting with the header (completed by message) and the question of data
+        buffer = DNSBuffer(data[:question_end(data)])
+        buffer.offset = len(buffer.data)
+        return buffer
+
+    @staticmethod
+    def message(buffer, count):
+        # authoritative answer holding the count records packed into buffer
+        QUERY_HEADER.pack_into(buffer.data, 0, struct.unpack_from('>H', buffer.data)[0], 0x8400, 1, count, 0, 0)
+        return bytes(buffer.data)
+
+    def soa_message(self, data, zone, serial):
+        buffer = self.message_buffer(data)
+        self.soa(zone, serial).pack(buffer)
+        return self.message(buffer, 1)
+
+    def stream(self, data, records):
+        # packs records into messages of about TRANSFER_MESSAGE_SIZE bytes as they are read, so the zone is
+        # never held in memory; names are compressed within each message
+        self.transfers += 1
+        buffer, count = self.message_buffer(data), 0
+        for record in records:
+            record = self.resource_record(record)
+            if record is None:
+                continue
+            end = len(buffer.data)
+            record.pack(buffer)
+            if count and len(buffer.data) > TRANSFER_MESSAGE_SIZE:
+                # the record starts the next message, where its names are compressed again
+                del buffer.data[end:]
+                yield self.message(buffer, count)
+                buffer, count = self.message_buffer(data), 0
+                record.pack(buffer)
+            count += 1
+            self.records_sent += 1
+        yield self.message(buffer, count)
+
+    def stats(self):
+        return {'zones': sorted(zone or '.' for zone in self.zones), 'transfers': self.transfers,
+                'incremental': self.incremental, 'refused': self.refused, 'records_sent': self.records_sent}
+
+
+zone_transfers = ZoneTransfers()
+
+
+class Notifier:
+
+    # sends NOTIFY messages (RFC 1996) for the transfer zones whose records changed to the secondary servers,
+    # from a background thread retrying every secondary up to NOTIFY_RETRIES times until it acknowledges;
+    # the changes arriving while notifications are being sent are announced together afterwards
+    def __init__(self, secondaries, timeout=NOTIFY_TIMEOUT, retries=NOTIFY_RETRIES):
+        self.secondaries = secondaries
+        self.timeout = timeout
+        self.retries = retries
+        self.condition = threading.Condition()
+        self.pending = set()
+        self.thread = None
+        self.sent = self.acknowledged = self.failed = 0
+
+    def changed(self, names):
+        # record store listener
+        if names is None:
+            zones = set(zone_transfers.zones)
+        else:
+            zones = set(zone for name in names for zone in zone_transfers.zones_of(name))
+        if not zones:
+            return
+        with self.condition:
+            self.pending.update(zones)
+            if self.thread is None:
+                self.thread = threading.Thread(target=self._notify_loop, daemon=True)
+                self.thread.start()
+            self.condition.notify()
+
+    def _notify_loop(self):
+        while True:
+            with self.condition:
+                while not self.pending:
+                    self.condition.wait()
+                zones, self.pending = self.pending, set()
+            serial = get_record_store().snapshot().serial
+            for zone in sorted(zones):
+                for secondary in self.secondaries:
+                    try:
+                        self.notify(zone, serial, secondary)
+                    except OSError:
+                        self.failed += 1
+
+    def notify(self, zone, serial, secondary):
+        # True once the secondary acknowledged the notification
+        packet = DNSRecord(DNSHeader(id=random.getrandbits(16), opcode=OPCODE.NOTIFY, aa=1),
+                           q=DNSQuestion(zone or '.', QTYPE.SOA), a=zone_transfers.soa(zone, serial)).pack()
+        family, _, _, _, address = socket.getaddrinfo(secondary[0], secondary[1], type=socket.SOCK_DGRAM)[0]
+        with socket.socket(family, socket.SOCK_DGRAM) as sock:
+            sock.settimeout(self.timeout)
+            sock.connect(address)
+            for _ in range(self.retries):
+                sock.send(packet)
+                self.sent += 1
+                try:
+                    while True:
+                        response = sock.recv(65535)
+                        if response[:2] == packet[:2] and len(response) > 2 and response[2] & 0x80:
+                            self.acknowledged += 1
+                            return True
+                except socket.timeout:
+                    continue
+        self.failed += 1
+        return False
+
+    def stats(self):
+        return {'secondaries': ['%s:%d' % secondary for secondary in self.secondaries], 'sent': self.sent,
+                'acknowledged': self.acknowledged, 'failed': self.failed}
+
+
+def operation_name(operation):
+    if operation[0] == 'delete':
+        return normalize_domain_name(operation[1])
+    return normalize_domain_name(operation[1].domain_name)
+
+
+def response_cache_key(question):
+    return normalize_domain_name(question.qname), question.qtype, question.qclass
+
+
+# edns: (UDP payload size, extended rcode and flags) of the OPT record of the request, None without one
+WireQuestion = collections.namedtuple('WireQuestion', ['id', 'flags', 'labels', 'key', 'end', 'edns'])
+
+QUERY_HEADER = struct.Struct('>HHHHHH')
+QUESTION_FOOTER = struct.Struct('>HH')
+OPT_RECORD_HEADER = struct.Struct('>BHHIH')
+RECORD_HEADER = struct.Struct('>HHIH')
+FAST_PATH_NAME = re.compile(rb'[A-Za-z0-9_*.-]+')
+
+
+def parse_question(data):
+    # lean decoder for the common standard query: one question, no answers and at most an OPT record;
+    # returns None whenever the message needs the full dnslib parser
+    if len(data) < 17:
+        return None
+    request_id, flags, qdcount, ancount, nscount, arcount = QUERY_HEADER.unpack_from(data)
+    # QR must be clear and the opcode must be QUERY
+    if flags & 0xF800 or qdcount != 1 or ancount or nscount or arcount > 1:
+        return None
+
+    labels, offset = [], 12
+    length = data[offset]
+    while length:
+        # compression pointers (and anything above 63) are left to dnslib
+        if length > 63 or offset + length + 1 >= len(data):
+            return None
+        labels.append(bytes(data[offset + 1:offset + 1 + length]))
+        offset += length + 1
+        length = data[offset]
+    name = b'.'.join(labels)
+    # plain host names only, so the cache key matches the normalized registered names
+    if labels and (not FAST_PATH_NAME.fullmatch(name) or name.count(b'.') != len(labels) - 1):
+        return None
+    end = offset + 1 + QUESTION_FOOTER.size
+    if end > len(data):
+        return None
+    qtype, qclass = QUESTION_FOOTER.unpack_from(data, offset + 1)
+
+    edns = None
+    if arcount:
+        # the only additional record accepted here is a root-owned OPT record (EDNS0)
+        if len(data) < end + OPT_RECORD_HEADER.size:
+            return None
+        owner, rtype, payload_size, ttl, rdlength = OPT_RECORD_HEADER.unpack_from(data, end)
+        if owner != 0 or rtype != 41 or end + OPT_RECORD_HEADER.size + rdlength != len(data):
+            return None
+        edns = payload_size, ttl
+    elif end != len(data):
+        return None
+
+    return WireQuestion(request_id, flags, labels, (name.decode().lower(), qtype, qclass), end, edns)
+
+
+def wire_request(question):
+    # the dnslib request matching a fast path question, for the lookup and packing of cache misses
+    qtype, qclass = question.key[1], question.key[2]
+    return DNSRecord(DNSHeader(id=question.id, rd=(question.flags >> 8) & 1),
+                     q=DNSQuestion(DNSLabel(question.labels), qtype, qclass))
+
+
+def name_end(packed, offset):
+    # end of the (possibly compressed) name starting at offset
+    while offset < len(packed) and packed[offset] != 0:
+        if packed[offset] >= 0xC0:
+            # compression pointer ending the name
+            return offset + 2
+        offset += packed[offset] + 1
+    return offset + 1
+
+
+def question_end(packed):
+    # end of the question section of a message
+    end = 12
+    for _ in range(struct.unpack_from('>H', packed, 4)[0]):
+        end = name_end(packed, end) + 4
+    return end
+
+
+def record_ttl_fields(packed):
+    # (offset, ttl) of the TTL field of every record of a message but OPT records
+    ancount, nscount, arcount = struct.unpack_from('>HHH', packed, 6)
+    offset, fields = question_end(packed), []
+    for _ in range(ancount + nscount + arcount):
+        offset = name_end(packed, offset)
+        rtype, _, ttl, rdlength = RECORD_HEADER.unpack_from(packed, offset)
+        if rtype != 41:
+            fields.append((offset + 4, ttl))
+        offset += RECORD_HEADER.size + rdlength
+    if offset > len(packed):
+        raise ValueError("Truncated message")
+    return fields
+
+
+def request_edns(request):
+    # (UDP payload size, extended rcode and flags) of the OPT record of a parsed request, None without one
+    for record in request.ar:
+        if record.rtype == QTYPE.OPT:
+            return record.rclass, record.ttl
+    return None
+
+
+def udp_payload_limit(edns, udp):
+    # largest response a client takes over UDP (None over TCP): 512 bytes, or its EDNS0 payload size up to 1232
+    if not udp:
+        return None
+    if edns is None:
+        return CLASSIC_UDP_SIZE
+    return min(max(edns[0], CLASSIC_UDP_SIZE), EDNS_UDP_SIZE)
+
+
+def finish_response(packed, edns, udp):
+    # answers an EDNS0 request with an OPT record (BADVERS for versions above 0) and truncates UDP answers
+    # beyond the payload size of the client (512 bytes without EDNS0) to the header and the question with TC
+    # set, so the client retries over TCP straight away; answers are cached without either
+    opt, limit = b'', udp_payload_limit(edns, udp)
+    if edns is not None:
+        if edns[1] & 0xFF0000:
+            # extended rcode BADVERS (16): 1 in the OPT record, 0 in the header
+            packed = packed[:3] + bytes([packed[3] & 0xF0]) + packed[4:6] + bytes(6) + packed[12:question_end(packed)]
+            opt = OPT_RECORD_HEADER.pack(0, 41, EDNS_UDP_SIZE, 1 << 24, 0)
+        else:
+            opt = OPT_RECORD_HEADER.pack(0, 41, EDNS_UDP_SIZE, 0, 0)
+    if limit is not None and len(packed) + len(opt) > limit:
+        packed = packed[:2] + bytes([packed[2] | 0x02, packed[3]]) + packed[4:6] + bytes(6) + \
+            packed[12:question_end(packed)]
+    if opt:
+        packed = packed[:10] + struct.pack('>H', struct.unpack_from('>H', packed, 10)[0] + 1) + packed[12:] + opt
+    return packed
+
+
+def patch_response(packed, request_id, request_data):
+    # a cached answer only differs from a fresh one in the id and the case of the echoed question
+    response = bytearray(packed)
+    response[0:2] = struct.pack('>H', request_id)
+    if request_data is not None:
+        end = question_end(response)
+        question = request_data[12:end]
+        if question.lower() == bytes(response[12:end]).lower():
+            response[12:end] = question
+    return bytes(response)
+
+
+def write_atomically(path, data):
+    # readers either see the previous file or the complete new one, never a partial write
+    tmp_path = '%s.%d.tmp' % (path, os.getpid())
+    with open(tmp_path, "wb") as tmp_file:
+        tmp_file.write(data)
+        tmp_file.flush()
+        os.fsync(tmp_file.fileno())
+    os.replace(tmp_path, path)
+
+
+def normalize_domain_name(domain_name):
+    # DNSLabel and registered names compare case-insensitively, without the trailing root dot
+    name = str(domain_name).lower()
+    if name.endswith('.'):
+        name = name[:-1]
+    return name
+
+
+def name_ancestors(name):
+    # parent names up to the top-level label: a.b.c -> b.c, c
+    labels = name.split('.')
+    return ['.'.join(labels[position:]) for position in range(1, len(labels))]
+
+
+def record_key(domain_name, domain_class, domain_type):
+    return normalize_domain_name(domain_name), domain_class, domain_type
+
+
+def load_record_store(path=PERSISTENT_RECORDS, zone_path=None):
+    global record_store
+    record_store = RecordStore(path, zone_path=zone_path)
+    record_store.add_listener(invalidate_caches)
+    negative_filter.attach(record_store)
+    record_store.load()
+    return record_store
+
+
+def get_record_store():
+    if record_store is None:
+        return load_record_store()
+    return record_store
+
+
+def domain_registration(path=PERSISTENT_RECORDS, zone_path=None):
+    # runs in a process forked from the running server, whose threads may have held the locks of its record store
+    # at fork time: registrations go through a store of this process, read from the files (the server follows them
+    # through the journal)
+    global record_store
+    record_store = RecordStore(path, zone_path=zone_path)
+    record_store.load()
+    # prompt_toolkit is only needed by this interactive cli, so it is not imported by headless servers
+    try:
+        from prompt_toolkit import prompt
+    except ImportError:
+        print("Missing dependency prompt_toolkit: <https://python-prompt-toolkit.readthedocs.io/en/stable/index.html>.")
+        print("Installing prompt_toolkit now with `pip`:")
+        install('prompt_toolkit')
+        from prompt_toolkit import prompt
     sys.stdin = open(0)
     while True:
         try:
@@ -122,46 +2963,80 @@ def domain_registration():
     print('So long, and thanks for all the fish!')
 
 
-def assemble_records_answer(record, domain_class, domain_type):
-    records_list = [record]
-    if record.record_type != domain_type:
-        next_entries = check_domain_entry(record.data, domain_class, domain_type)
-        for entry in next_entries:
-            records_list.append(entry)
-    return records_list
-
-
-def check_domain_entry(domain_name, domain_class, domain_type):
-    result_entry = []
-    resource_records = pickle.load(open(PERSISTENT_RECORDS, "rb"))
-    for name, record in resource_records:
-        if name != str(domain_name)[:-1] and name != str(domain_name):
-            continue
-        if isinstance(record, DNSResourceRecord) \
-                and (record.domain_name == str(domain_name)[:-1] or record.domain_name == str(domain_name)) \
-                and record.record_class == domain_class:
-            result_entry = assemble_records_answer(record, domain_class, domain_type)
+def match_records(store, name, domain_class, domain_type):
+    # records of the name, synthesized from the wildcard of its closest encloser when the name does not exist
+    owner, encloser = store.match(name)
+    if owner is None:
+        return [], None, name_watch(name, encloser)
+    records = store.lookup(owner, domain_class, domain_type)
+    if owner == name:
+        return records, owner, [name]
+    synthesized = []
+    for record in records:
+        record = copy.copy(record)
+        record.domain_name = name
+        synthesized.append(record)
+    return synthesized, owner, name_watch(name, encloser) + [owner]
+
+
+def name_watch(name, encloser):
+    # names whose changes can alter the answer for a name missing below its closest encloser
+    names = [name]
+    for ancestor in name_ancestors(name):
+        names.append(ancestor)
+        if ancestor == encloser:
             break
-    return result_entry
-
+    return names
 
-def check_domain_name_exists(domain_name, resource_records):
-    for name, record in resource_records:
-        if name == str(domain_name)[:-1] or name == str(domain_name):
-            return True
-    else:
-        return False
 
+def flatten_cname_chain(domain_name, domain_class, domain_type, index=None):
+    # follows CNAMEs from domain_name until a record of domain_type, returning the answer records,
+    # every name the answer depends on, whether the chain loops or exceeds CNAME_CHAIN_MAX_LENGTH
+    # and whether the queried name exists (NODATA rather than NXDOMAIN when it holds no record of the type)
+    store = index if index is not None else get_record_store().snapshot()
+    records, chain, names = [], [], set()
+    name = normalize_domain_name(domain_name)
+    exists = True
+    while True:
+        if name in chain or len(chain) > CNAME_CHAIN_MAX_LENGTH:
+            return records, names, True, exists
+        chain.append(name)
+        found, owner, watched = match_records(store, name, domain_class, domain_type)
+        names.update(watched)
+        if owner is None:
+            exists = len(chain) > 1
+            return records, names, False, exists
+        if found:
+            records.extend(found)
+            return records, names, False, exists
+        aliases = match_records(store, name, domain_class, QTYPE[5])[0]
+        if not aliases:
+            return records, names, False, exists
+        records.append(aliases[0])
+        name = normalize_domain_name(aliases[0].data)
+
+
+def lookup_domain_entry(domain_name, domain_class, domain_type, index=None):
+    # returns the answer records, whether the name exists and the names the answer depends on;
+    # CNAME chains are flattened once per (name, class, type) and kept until one of their links changes,
+    # so an alias chain costs a single lookup; raises CnameChainError for looping or too long chains.
+    # index: the snapshot of the records to read (see RecordStore.snapshot), the current one by default
+    key = record_key(domain_name, domain_class, domain_type)
+    chain = cname_chains.get(key)
+    if chain is None:
+        version = cname_chains.version
+        records, names, broken, exists = flatten_cname_chain(domain_name, domain_class, domain_type, index)
+        chain = tuple(records), broken, exists, frozenset(names)
+        # chains read from a snapshot replaced in the meantime may predate the invalidation of version
+        if index is None or index is get_record_store().snapshot():
+            cname_chains.put(key, chain, names, version)
+    if chain[1]:
+        raise CnameChainError("CNAME chain of [%s] loops or exceeds %d links" % (key[0], CNAME_CHAIN_MAX_LENGTH))
+    return list(chain[0]), chain[2], chain[3]
 
-def remove_record_by_name(domain_name):
-    resource_records = pickle.load(open(PERSISTENT_RECORDS, "rb"))
-    new_records = []
-    for name, record in resource_records:
-        if name == str(domain_name)[:-1] or name == str(domain_name):
-            continue
-        new_records.append([name, record])
 
-    pickle.dump(new_records, open(PERSISTENT_RECORDS, "wb"))
+def check_domain_entry(domain_name, domain_class, domain_type):
+    return lookup_domain_entry(domain_name, domain_class, domain_type)[0]
 
 
 def get_data_by_type(record_type, data):
@@ -177,42 +3052,200 @@ def get_data_by_type(record_type, data):
         return None
 
 
-def handle_domain_entries(request, entries):
-    # handling reply message for record not found
-    if len(entries) == 0:
-        answer = DNSRecord(DNSHeader(id=request.header.id, rcode=RCODE.NXDOMAIN, qr=1, ra=1), q=request.q)
-        return answer.pack()
+def get_record_data(record):
+    # records from a mapped zone were validated and encoded when the zone was written
+    if isinstance(record, MappedResourceRecord):
+        return getattr(QTYPE, record.record_type), RD(record.wire)
+    return get_data_by_type(record.record_type, record.data)
 
-    # handling successful message for record found
-    answer = DNSRecord(DNSHeader(id=request.header.id, qr=1, aa=1, ra=1), q=request.q)
+
+def add_domain_entries(answer, entries):
     for entry in entries:
-        data = get_data_by_type(entry.record_type, entry.data)
+        data = get_record_data(entry)
         if data is None:
             continue
         answer.add_answer(RR(entry.domain_name, data[0], ttl=entry.ttl, rdata=data[1]))
+
+
+def handle_domain_entries(request, entries, name_exists=False):
+    # handling reply message for record not found, an existing name without such records being NODATA
+    if len(entries) == 0 and not name_exists:
+        answer = DNSRecord(DNSHeader(id=request.header.id, rcode=RCODE.NXDOMAIN, qr=1, ra=1), q=request.q)
+        return answer.pack()
+
+    # handling successful message for record found
+    answer = DNSRecord(DNSHeader(id=request.header.id, qr=1, aa=1, ra=1), q=request.q)
+    add_domain_entries(answer, entries)
     # answer.add_auth(RR())
     # answer.add_ar(RR())
     return answer.pack()
 
 
-def db_lookup(request):
+def db_lookup(request, data=None):
+    # None for questions to forward, as resolve_answer
     question = request.q
-    domain_entries = check_domain_entry(question.qname, CLASS[question.qclass], QTYPE[question.qtype])
-    return handle_domain_entries(request, domain_entries)
+    key = response_cache_key(question)
+    packed_answer = response_cache.get(key)
+    if packed_answer is not None:
+        return patch_response(packed_answer, request.header.id, data)
+    return resolve_answer(request, key, data)
 
 
-def handle_dns_client(data):
+def forwarded(name):
+    # names missing from the records go to the forwarder, when there is one, except in the zones served here,
+    # which answer them with an authoritative NXDOMAIN
+    return forwarder is not None and not zone_transfers.zones_of(name)
+
+
+class ForwardedQuestion:
+
+    # a question for the upstreams, not in the forwarder cache: handle_dns_client returns it instead of waiting
+    # for the answer when told to, and serve_query gets its response messages from a forwarder thread
+    def __init__(self, key, request_id, data, edns, udp):
+        self.forwarder = forwarder
+        self.key = key
+        self.request_id = request_id
+        self.data = data
+        self.edns = edns
+        self.udp = udp
+
+    def messages(self):
+        started = time.perf_counter()
+        packed_answer = self.forwarder.answer(self.key, self.request_id, self.data)
+        server_metrics.observe('forward', started)
+        server_metrics.count_query(self.key[1], packed_answer)
+        return [finish_response(packed_answer, self.edns, self.udp)]
+
+
+def forward_question(key, request_id, data, edns, udp, defer):
+    # the response messages to a question for the upstreams, or a ForwardedQuestion when it has to wait for them
+    # and defer is set
+    packed_answer = forwarder.cached_answer(key, request_id, data)
+    if packed_answer is not None:
+        server_metrics.count_query(key[1], packed_answer)
+        return [finish_response(packed_answer, edns, udp)]
+    question = ForwardedQuestion(key, request_id, data, edns, udp)
+    return question if defer else question.messages()
+
+
+def resolve_answer(request, key, data=None):
+    # looks the question up in the records and caches the packed answer;
+    # None for the questions of missing names to forward (see forwarded)
+    question = request.q
+    version = response_cache.version
+    started = time.perf_counter()
+    try:
+        domain_entries, name_exists, names = lookup_domain_entry(question.qname, CLASS[question.qclass],
+                                                                 QTYPE[question.qtype])
+    except CnameChainError:
+        server_metrics.observe('lookup', started)
+        answer = DNSRecord(DNSHeader(id=request.header.id, rcode=RCODE.SERVFAIL, qr=1, ra=1), q=request.q)
+        return answer.pack()
+    started = server_metrics.observe('lookup', started)
+    if not domain_entries and not name_exists and forwarded(key[0]):
+        return None
+    packed_answer = handle_domain_entries(request, domain_entries, name_exists)
+    server_metrics.observe('pack', started)
+    response_cache.put(key, packed_answer, names, version)
+    return packed_answer
+
+
+def resolve_questions(request):
+    # answers every question of a query in one response, looked up in a single snapshot of the records:
+    # NXDOMAIN when none of the names exist, SERVFAIL when a CNAME chain of any of them is broken
+    started = time.perf_counter()
+    index = get_record_store().snapshot()
+    answer = DNSRecord(DNSHeader(id=request.header.id, qr=1, aa=1, ra=1), questions=list(request.questions))
+    rcode, resolved = RCODE.NXDOMAIN, set()
+    for question in request.questions:
+        key = response_cache_key(question)
+        if key in resolved:
+            continue
+        resolved.add(key)
+        try:
+            entries, exists, names = lookup_domain_entry(question.qname, CLASS[question.qclass],
+                                                         QTYPE[question.qtype], index)
+        except CnameChainError:
+            rcode = RCODE.SERVFAIL
+            continue
+        if exists and rcode != RCODE.SERVFAIL:
+            rcode = RCODE.NOERROR
+        add_domain_entries(answer, entries)
+    answer.header.rcode = rcode
+    started = server_metrics.observe('lookup', started)
+    packed_answer = answer.pack()
+    server_metrics.observe('pack', started)
+    return packed_answer
+
+
+def stats_payload_limit(edns, udp):
+    # room left for the stats answer by the OPT record finish_response appends
+    limit = udp_payload_limit(edns, udp)
+    if limit is None or edns is None:
+        return limit
+    return limit - OPT_RECORD_HEADER.size
+
+
+def handle_dns_client(data, udp=False, client_address=None, defer_forward=False):
+    # udp: answers are bounded by the payload size of the client; returns the response messages,
+    # a generator of them for zone transfers, and a ForwardedQuestion with defer_forward for questions
+    # that would wait for the upstreams
+    started = time.perf_counter()
+    question = parse_question(data)
+    if question is not None and zone_transfers.zones and question.key[1] in ZONE_QTYPES:
+        # SOA, AXFR and IXFR questions take the regular parser, see ZoneTransfers.answer
+        question = None
+    if question is not None:
+        started = server_metrics.observe('parse', started)
+        if question.key == STATS_QUESTION:
+            return [finish_response(stats_response(question.id, stats_payload_limit(question.edns, udp)),
+                                    question.edns, udp)]
+        packed_answer = response_cache.get(question.key)
+        if packed_answer is not None:
+            # cached answers echo the question with the same length, only its case may differ
+            packed_answer = struct.pack('>H', question.id) + packed_answer[2:12] + data[12:question.end] + \
+                packed_answer[question.end:]
+            server_metrics.observe('cache', started)
+        elif negative_filter.missing(question.key[0]):
+            if forwarded(question.key[0]):
+                return forward_question(question.key, question.id, data, question.edns, udp, defer_forward)
+            # names that certainly do not exist are answered from a template, keeping them out of the cache
+            packed_answer = nxdomain_response(question, data)
+            server_metrics.observe('negative', started)
+        else:
+            packed_answer = resolve_answer(wire_request(question), question.key, data)
+            if packed_answer is None:
+                return forward_question(question.key, question.id, data, question.edns, udp, defer_forward)
+        server_metrics.count_query(question.key[1], packed_answer)
+        return [finish_response(packed_answer, question.edns, udp)]
+
     request = DNSRecord.parse(data)
-    questions_number = len(request.questions)
-    questions_answers = []
-    for i in range(questions_number):
-        packed_answer = db_lookup(request)
-        questions_answers.append(packed_answer)
-    return questions_answers
+    server_metrics.observe('parse', started)
+    edns = request_edns(request)
+    if request.questions and response_cache_key(request.q) == STATS_QUESTION:
+        return [finish_response(stats_response(request.header.id, stats_payload_limit(edns, udp)), edns, udp)]
+    if not request.questions:
+        return []
+    if len(request.questions) == 1 and request.q.qtype in ZONE_QTYPES and zone_transfers.zones:
+        messages = zone_transfers.answer(request, data, client_address, udp)
+        if messages is not None:
+            if isinstance(messages, list):
+                return [finish_response(message, edns, udp) for message in messages]
+            return messages
+    if len(request.questions) == 1:
+        packed_answer = db_lookup(request, data)
+        if packed_answer is None:
+            return forward_question(response_cache_key(request.q), request.header.id, data, edns, udp,
+                                    defer_forward)
+    else:
+        packed_answer = resolve_questions(request)
+    for question in request.questions:
+        server_metrics.count_query(question.qtype, packed_answer)
+    return [finish_response(packed_answer, edns, udp)]
 
 
 def handle_domain_registration(data_str):
-    resource_records = pickle.load(open(PERSISTENT_RECORDS, "rb"))
+    store = get_record_store()
 
     domain_dic = validate_new_domain(data_str)
     if domain_dic is None:
@@ -222,20 +3255,179 @@ def handle_domain_registration(data_str):
     new_record = DNSResourceRecord(domain_dic['domain_name'], domain_dic['class'],
                                    domain_dic['qtype'], domain_dic['data'], domain_dic['ttl'])
     if new_record is not None:
-        if check_domain_name_exists(new_record.domain_name, resource_records):
-            remove_record_by_name(new_record.domain_name)
-            resource_records = pickle.load(open(PERSISTENT_RECORDS, "rb"))
-
-        resource_records.append([new_record.domain_name, new_record])
+        store.apply([('replace', new_record)])
         print("Registered domain: [%s %s %s %s]" %
               (new_record.domain_name, new_record.record_class, new_record.record_type, new_record.data))
-        pickle.dump(resource_records, open(PERSISTENT_RECORDS, "wb"))
     else:
         print("FAILED to create new record: [%s]" % domain_dic)
         return False
     return True
 
 
+def registration_operation(line):
+    # "[add|replace|delete] name class type data" (no action meaning replace, like the cli) or "delete name";
+    # returns (operation, None) or (None, error)
+    fields = line.split()
+    action = 'replace'
+    if fields and fields[0].lower() in REGISTRATION_ACTIONS:
+        action = fields.pop(0).lower()
+    if action == 'delete':
+        if len(fields) != 1 or validate_domain_name(fields[0], wildcard=True) is None:
+            return None, "expected: delete name"
+        return ('delete', fields[0]), None
+    if len(fields) != 4:
+        return None, "expected: %s name class type data" % action
+    domain_dic = validate_domain_fields(*fields)
+    if domain_dic is None:
+        return None, "invalid %s" % invalid_domain_field(*fields)
+    return (action, DNSResourceRecord(domain_dic['domain_name'], domain_dic['class'], domain_dic['qtype'],
+                                      domain_dic['data'], domain_dic['ttl'])), None
+
+
+class GroupCommitter:
+
+    # applies the operations of concurrent registrations together: whatever arrives while a commit is being
+    # written (and fsynced) goes into the next one, so writers share journal writes instead of queueing on them
+    def __init__(self, batch_size=REGISTRATION_COMMIT_BATCH):
+        self.batch_size = batch_size
+        self.queue = queue.Queue()
+        self.commits = 0
+        self.operations = 0
+        self.thread = threading.Thread(target=self.run, daemon=True)
+        self.thread.start()
+
+    def submit(self, operations):
+        # returns a future resolved once the operations are durable
+        future = concurrent.futures.Future()
+        self.queue.put((operations, future))
+        return future
+
+    def run(self):
+        while True:
+            batch = [self.queue.get()]
+            count = len(batch[0][0])
+            while count < self.batch_size:
+                try:
+                    batch.append(self.queue.get_nowait())
+                except queue.Empty:
+                    break
+                count += len(batch[-1][0])
+            try:
+                get_record_store().apply([operation for operations, _ in batch for operation in operations])
+            except Exception as error:
+                traceback.print_exc(file=sys.stderr)
+                for _, future in batch:
+                    future.set_exception(error)
+                continue
+            self.commits += 1
+            self.operations += count
+            for _, future in batch:
+                future.set_result(count)
+
+
+class RegistrationRequestHandler(socketserver.BaseRequestHandler):
+
+    # newline-delimited registration messages, each acknowledged in order with "OK action name" once durable
+    # or "ERROR reason"; the messages received together are committed together
+    def handle(self):
+        buffer = b''
+        while True:
+            try:
+                chunk = self.request.recv(65536)
+            except OSError:
+                return
+            if not chunk:
+                return
+            buffer += chunk
+            *lines, buffer = buffer.split(b'\n')
+            if len(buffer) > REGISTRATION_LINE_LIMIT:
+                self.request.sendall(b'ERROR line too long\n')
+                return
+            if lines:
+                self.request.sendall(self.server.register(lines))
+
+
+class RegistrationServer(socketserver.ThreadingTCPServer):
+
+    daemon_threads = True
+    allow_reuse_address = True
+
+    def __init__(self, server_address, RequestHandlerClass=RegistrationRequestHandler):
+        super().__init__(server_address, RequestHandlerClass)
+        self.committer = GroupCommitter()
+        self.rejected = 0
+
+    def register(self, lines):
+        # returns the acknowledgements of the lines
+        acks, operations = [], []
+        for line in lines:
+            line = line.decode(errors='replace').strip()
+            if not line:
+                continue
+            operation, error = registration_operation(line)
+            if operation is None:
+                self.rejected += 1
+                acks.append('ERROR %s' % error)
+            else:
+                operations.append(operation)
+                acks.append(operation)
+        if operations:
+            try:
+                self.committer.submit(operations).result()
+            except Exception as error:
+                failure = 'ERROR commit failed: %s' % error
+                acks = [ack if isinstance(ack, str) else failure for ack in acks]
+        acks = [ack if isinstance(ack, str) else 'OK %s %s' % (ack[0], operation_name(ack)) for ack in acks]
+        return ''.join(ack + '\n' for ack in acks).encode()
+
+    def stats(self):
+        return {'commits': self.committer.commits, 'operations': self.committer.operations,
+                'rejected': self.rejected}
+
+
+# RFC1035 host names: a leading letter, letters, digits, hyphens (and underscores) inside, a trailing letter or dot
+DOMAIN_NAME = re.compile(r"[a-zA-Z](?:[\w.\-]*[a-zA-Z.])?")
+TXT_DATA = re.compile(r".*=")
+REGISTERED_CLASSES = (CLASS[1], CLASS[2], CLASS[3], CLASS[4], CLASS[254], CLASS[255])
+REGISTERED_TYPES = (QTYPE[1], QTYPE[5], QTYPE[16], QTYPE[28])
+ADDRESS_FAMILIES = {QTYPE[1]: socket.AF_INET, QTYPE[28]: socket.AF_INET6}
+QTYPE_CNAME, QTYPE_TXT = QTYPE[5], QTYPE[16]
+
+
+def validate_domain_entry(entry):
+    # registration string or (name, class, type, data) fields
+    if isinstance(entry, str):
+        return validate_new_domain(entry)
+    return validate_domain_fields(*entry)
+
+
+def validate_domain_chunk(entries):
+    return [validate_domain_entry(entry) for entry in entries]
+
+
+def validate_domain_entries(entries, processes=0, chunk_size=VALIDATION_CHUNK_SIZE):
+    # validates many registration strings or field tuples, yielding validate_new_domain results in order;
+    # with processes > 0, chunks of entries are validated in a pool of worker processes, a bounded number
+    # of chunks being in flight so the entries are still streamed
+    if processes <= 0:
+        yield from map(validate_domain_entry, entries)
+        return
+    with concurrent.futures.ProcessPoolExecutor(processes) as pool:
+        pending = collections.deque()
+        chunk = []
+        for entry in entries:
+            chunk.append(entry)
+            if len(chunk) == chunk_size:
+                pending.append(pool.submit(validate_domain_chunk, chunk))
+                chunk = []
+                if len(pending) > 2 * processes:
+                    yield from pending.popleft().result()
+        if chunk:
+            pending.append(pool.submit(validate_domain_chunk, chunk))
+        while pending:
+            yield from pending.popleft().result()
+
+
 def validate_new_domain(data_str):
     # registration string like "www.google.com IN A 1.2.3.4"
     if not isinstance(data_str, str):
@@ -244,20 +3436,23 @@ def validate_new_domain(data_str):
     registration = data_str.split()
     if len(registration) != 4:
         return None
+    return validate_domain_fields(*registration)
+
 
-    new_domain_name = validate_domain_name(registration[0])
+def validate_domain_fields(domain_name, domain_class, domain_type, domain_data):
+    new_domain_name = validate_domain_name(domain_name, wildcard=True)
     if new_domain_name is None:
         return None
 
-    new_domain_class = validate_domain_class(registration[1])
+    new_domain_class = validate_domain_class(domain_class)
     if new_domain_class is None:
         return None
 
-    new_domain_type = validate_domain_type(registration[2])
+    new_domain_type = validate_domain_type(domain_type)
     if new_domain_type is None:
         return None
 
-    new_domain_data = validate_domain_data(new_domain_type, registration[3])
+    new_domain_data = validate_domain_data(new_domain_type, domain_data)
     if new_domain_data is None:
         return None
 
@@ -266,31 +3461,40 @@ def validate_new_domain(data_str):
     return domain_dic
 
 
-def validate_domain_name(domain_name):
+def invalid_domain_field(domain_name, domain_class, domain_type, domain_data):
+    # the first field rejected by validate_domain_fields, for error reports
+    if validate_domain_name(domain_name, wildcard=True) is None:
+        return "name [%s]" % domain_name
+    if validate_domain_class(domain_class) is None:
+        return "class [%s]" % domain_class
+    if validate_domain_type(domain_type) is None:
+        return "type [%s]" % domain_type
+    return "%s data [%s]" % (domain_type, domain_data)
+
+
+def validate_domain_name(domain_name, wildcard=False):
     # For sequences, (strings, lists, tuples), use the fact that empty sequences are false.
     if not domain_name:
         return None
+    # RFC4592: a wildcard owner name is a leading '*' label followed by a regular name
+    if wildcard and isinstance(domain_name, str) and domain_name.startswith('*.'):
+        return domain_name if validate_domain_name(domain_name[2:]) is not None else None
     # RFC1035: names - 255 octets or less
     if len(domain_name) > 255:
         return None
     # RFC1035: labels - 63 octets or less
-    labels = domain_name.split('.')
-    for domain_label in labels:
-        if len(domain_label) > 63:
-            return None
+    if max(map(len, domain_name.split('.'))) > 63:
+        return None
     # RFC1035: must start with a letter, end with a letter or digit,
     # and have as interior characters only letters, digits, and hyphen
-    if not re.match(r"^[a-zA-Z]", domain_name) or not re.match(r".*[a-zA-Z.]$", domain_name):
-        return None
-    if re.match(r".*[^\w\.\-]", domain_name):
+    if DOMAIN_NAME.fullmatch(domain_name) is None:
         return None
     return domain_name
 
 
 def validate_domain_class(domain_class):
     # CLASS =  Bimap('CLASS', {1:'IN', 2:'CS', 3:'CH', 4:'Hesiod', 254:'None', 255:'*'},DNSError)
-    if domain_class != CLASS[1] and domain_class != CLASS[2] and domain_class != CLASS[3] and \
-            domain_class != CLASS[4] and domain_class != CLASS[254] and domain_class != CLASS[255]:
+    if domain_class not in REGISTERED_CLASSES:
         return None
     else:
         return domain_class
@@ -298,8 +3502,7 @@ def validate_domain_class(domain_class):
 
 def validate_domain_type(domain_type):
     # TYPE = Bimap('QTYPE', {1:'A',..., 5:'CNAME',..., 16:'TXT',..., 28:'AAAA',...}, DNSError)
-    if domain_type != QTYPE[1] and domain_type != QTYPE[5] and \
-            domain_type != QTYPE[16] and domain_type != QTYPE[28]:
+    if domain_type not in REGISTERED_TYPES:
         return None
     else:
         return domain_type
@@ -311,69 +3514,303 @@ def validate_domain_data(domain_type, domain_data):
             not isinstance(domain_type, str) or not isinstance(domain_data, str):
         return None
     # A               1 a host address (x.y.z.w)
-    if domain_type == QTYPE[1] and \
-            not re.match(r"^((25[0-5]|(2[0-4]|1[0-9]|[1-9]|)[0-9])(\.(?!$)|$)){4}$", domain_data):
-        return None
     # AAAA            1 a host address (A:B:C:D:E:F:G:H) [RFC3596]
-    if domain_type == QTYPE[28] and \
-            not re.match(
-                r"(([0-9a-fA-F]{1,4}:){7,7}[0-9a-fA-F]{1,4}|([0-9a-fA-F]{1,4}:){1,7}:|([0-9a-fA-F]{1,4}:){1,"
-                r"6}:[0-9a-fA-F]{1,4}|([0-9a-fA-F]{1,4}:){1,5}(:[0-9a-fA-F]{1,4}){1,2}|([0-9a-fA-F]{1,4}:){1,"
-                r"4}(:[0-9a-fA-F]{1,4}){1,3}|([0-9a-fA-F]{1,4}:){1,3}(:[0-9a-fA-F]{1,4}){1,4}|([0-9a-fA-F]{1,4}:){1,"
-                r"2}(:[0-9a-fA-F]{1,4}){1,5}|[0-9a-fA-F]{1,4}:((:[0-9a-fA-F]{1,4}){1,6})|:((:[0-9a-fA-F]{1,4}){1,"
-                r"7}|:)|fe80:(:[0-9a-fA-F]{0,4}){0,4}%[0-9a-zA-Z]{1,}|::(ffff(:0{1,4}){0,1}:){0,1}((25[0-5]|(2["
-                r"0-4]|1{0,1}[0-9]){0,1}[0-9])\.){3,3}(25[0-5]|(2[0-4]|1{0,1}[0-9]){0,1}[0-9])|([0-9a-fA-F]{1,4}:){1,"
-                r"4}:((25[0-5]|(2[0-4]|1{0,1}[0-9]){0,1}[0-9])\.){3,3}(25[0-5]|(2[0-4]|1{0,1}[0-9]){0,1}[0-9]))",
-                domain_data):
-        return None
+    # both parsed by the C library, which also rejects zone-scoped IPv6 addresses
+    address_family = ADDRESS_FAMILIES.get(domain_type)
+    if address_family is not None:
+        try:
+            socket.inet_pton(address_family, domain_data)
+        except (OSError, ValueError):
+            return None
+        return domain_data
     # CNAME           5 the canonical name for an alias
-    if domain_type == QTYPE[5] and validate_domain_name(domain_data) is None:
+    if domain_type == QTYPE_CNAME and validate_domain_name(domain_data) is None:
         return None
     # TXT             16 text strings
     # [RFC1464] The format consists of the attribute name followed by the value of the attribute.
     # The name and value are separated by an equals sign (=)
     # Any printable ASCII character is permitted for the attribute name.
     # All printable ASCII characters are permitted in the attribute value
-    if domain_type == QTYPE[16] and not re.match(r".*[=]", domain_data):
+    if domain_type == QTYPE_TXT and TXT_DATA.match(domain_data) is None:
         return None
     return domain_data
 
 
-def main():
-    parser = argparse.ArgumentParser(description='Simple DNS implementation in Python.')
-    parser.add_argument('--request_port', default=2053, type=int, help='The server port to listen for DNS Clients.')
-    parser.add_argument('--register_port', default=2063, type=int, help='The server port to listen for registrations.')
-    parser.add_argument('--udp', default=True, help='Listen to UDP.')
-    parser.add_argument('--tcp', help='Listen to TCP.')
-    args = parser.parse_args()
-
-    # starting servers with respective sockets handling
+def create_servers(args, reuse_port=False):
     servers = []
+    if args.engine == 'asyncio':
+        udp_server, tcp_server = (ReusePortAsyncioUDPServer, ReusePortAsyncioTCPServer) if reuse_port \
+            else (AsyncioUDPServer, AsyncioTCPServer)
+        udp_handler, tcp_handler = AsyncioUDPRequestHandler, AsyncioTCPRequestHandler
+    else:
+        udp_server, tcp_server = (ReusePortPooledUDPServer, ReusePortPooledTCPServer) if reuse_port \
+            else (PooledUDPServer, PooledTCPServer)
+        udp_handler, tcp_handler = UDPRequestHandler, TCPRequestHandler
     if args.udp:
-        servers.append(socketserver.ThreadingUDPServer(('', args.request_port), UDPRequestHandler))
+        servers.append(udp_server(('', args.request_port), udp_handler))
     if args.tcp:
-        servers.append(socketserver.ThreadingTCPServer(('', args.request_port), TCPRequestHandler))
-
+        servers.append(tcp_server(('', args.request_port), tcp_handler))
+    for server in servers:
+        if isinstance(server, PoolMixIn):
+            server.pool_size = args.pool_size
+            server.queue_size = args.queue_size
+            server.overload_policy = args.overload_policy
+        if isinstance(server, ConnectionLimitMixIn):
+            server.idle_timeout = args.tcp_idle_timeout
+            server.connections_per_client = args.tcp_connections_per_client
+            server.max_connections = args.tcp_max_connections
+    return servers
+
+
+def start_servers(servers):
+    server_metrics.servers.extend(servers)
     for server in servers:
         thread = threading.Thread(target=server.serve_forever)
         thread.daemon = True
         thread.start()
         print("%s server running: [%s]" % (server.RequestHandlerClass.__name__, thread.name))
 
+
+def start_registration_server(address, port):
+    registration_server = RegistrationServer((address, port))
+    server_metrics.servers.append(registration_server)
+    thread = threading.Thread(target=registration_server.serve_forever, daemon=True)
+    thread.start()
+    print("Registrations accepted on %s:%d" % registration_server.server_address[:2])
+    return registration_server
+
+
+def start_stats_server(port):
+    # http.server is only imported when the statistics are served over HTTP
+    import http.server
+
+    class StatsRequestHandler(http.server.BaseHTTPRequestHandler):
+
+        # GET /stats returns the server metrics as JSON
+        def do_GET(self):
+            if self.path.rstrip('/') != '/stats':
+                self.send_error(404)
+                return
+            body = json.dumps(server_metrics.snapshot(), indent=2, sort_keys=True).encode()
+            self.send_response(200)
+            self.send_header('Content-Type', 'application/json')
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, format, *args):
+            pass
+
+    stats_server = http.server.ThreadingHTTPServer(('127.0.0.1', port), StatsRequestHandler)
+    thread = threading.Thread(target=stats_server.serve_forever, daemon=True)
+    thread.start()
+    print("Statistics available on http://127.0.0.1:%d/stats" % stats_server.server_address[1])
+    return stats_server
+
+
+def startup_time():
+    # seconds since the process started (interpreter startup included on Linux), since the imports elsewhere
+    try:
+        with open('/proc/self/stat') as stat_file:
+            started = int(stat_file.read().rsplit(')', 1)[1].split()[19]) / os.sysconf('SC_CLK_TCK')
+        with open('/proc/uptime') as uptime_file:
+            return float(uptime_file.read().split()[0]) - started
+    except (OSError, ValueError, IndexError):
+        return time.perf_counter() - STARTED
+
+
+def report_ready(description):
+    # for supervisors and orchestrators: a line on stdout once the sockets are bound and the records loaded
+    # and, under systemd (Type=notify), READY=1 on $NOTIFY_SOCKET
+    print("Ready: %s, started in %.0f ms" % (description, startup_time() * 1000), flush=True)
+    notify_socket = os.environ.get('NOTIFY_SOCKET')
+    if notify_socket:
+        if notify_socket.startswith('@'):
+            notify_socket = '\0' + notify_socket[1:]
+        with socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM) as notify:
+            notify.sendto(b'READY=1', notify_socket)
+
+
+def run_worker(args, ready, position):
+    # worker process: its own view of the shared records (mapped zone pages are shared
+    # between workers), following registrations through the journal; releases ready once serving
+    global response_cache, cname_chains, negative_filter, forwarder
+    response_cache = ResponseCache(args.cache_size)
+    forwarder = create_forwarder(args)
+    cname_chains = ResponseCache(CNAME_CHAIN_CACHE_SIZE)
+    negative_filter = NegativeFilter(background=True)
+    store = load_record_store(zone_path=args.zone_file)
+    store.watch()
+    servers = create_servers(args, reuse_port=True)
+    start_servers(servers)
+    # every worker keeps its own metrics, served on consecutive ports
+    if args.stats_port:
+        start_stats_server(args.stats_port + position)
+    ready.release()
+    parent_pid = os.getppid()
+    try:
+        # exiting along with the supervising process
+        while os.getppid() == parent_pid:
+            time.sleep(1)
+            sys.stderr.flush()
+            sys.stdout.flush()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        for server in servers:
+            server.shutdown()
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Simple DNS implementation in Python.')
+    parser.add_argument('--request_port', default=2053, type=int, help='The server port to listen for DNS Clients.')
+    parser.add_argument('--register_port', default=2063, type=int,
+                        help='The server port to listen for registrations (0 disables it).')
+    parser.add_argument('--register_address', default='127.0.0.1',
+                        help='Address the registration port is bound to.')
+    parser.add_argument('--udp', default=True, help='Listen to UDP.')
+    parser.add_argument('--tcp', help='Listen to TCP.')
+    parser.add_argument('--engine', default='threaded', choices=['threaded', 'asyncio'],
+                        help='Serve clients from a pool of handler threads or from an asyncio event loop.')
+    parser.add_argument('--pool_size', default=HANDLER_POOL_SIZE, type=int,
+                        help='Handler threads of the threaded engine (0 starts a thread per request).')
+    parser.add_argument('--queue_size', default=HANDLER_QUEUE_SIZE, type=int,
+                        help='Requests waiting for a handler thread before shedding load.')
+    parser.add_argument('--overload_policy', default='drop', choices=OVERLOAD_POLICIES,
+                        help='What to do with UDP queries arriving while the queue is full.')
+    parser.add_argument('--tcp_idle_timeout', default=TCP_IDLE_TIMEOUT, type=float,
+                        help='Seconds an idle TCP connection is kept open.')
+    parser.add_argument('--tcp_connections_per_client', default=TCP_CONNECTIONS_PER_CLIENT, type=int,
+                        help='TCP connections accepted from a single client address.')
+    parser.add_argument('--tcp_max_connections', default=TCP_MAX_CONNECTIONS, type=int,
+                        help='TCP connections accepted from all the clients together.')
+    parser.add_argument('--rrl_rate', default=0, type=float,
+                        help='UDP responses a second allowed per client prefix and response (0 disables the limit).')
+    parser.add_argument('--rrl_slip', default=RRL_SLIP, type=int,
+                        help='One limited response out of this many is sent truncated instead of dropped '
+                             '(0 drops them all).')
+    parser.add_argument('--rrl_table_size', default=RRL_TABLE_SIZE, type=int,
+                        help='Token buckets kept by the response rate limiter.')
+    parser.add_argument('--query_log', default='-', help='File receiving the query log ("-" for stdout).')
+    parser.add_argument('--query_log_level', default='info', choices=QUERY_LOG_LEVELS,
+                        help='Queries written to the query log: none, failed ones or all of them.')
+    parser.add_argument('--query_log_sample', default=1.0, type=float,
+                        help='Fraction of the queries written to the query log.')
+    parser.add_argument('--stats_port', default=0, type=int,
+                        help='Local port serving the server metrics as JSON on /stats (0 disables it).')
+    parser.add_argument('--headless', action='store_true',
+                        help='Only serve: no registration cli, no seed record, no package installation.')
+    parser.add_argument('--workers', default=0, type=int,
+                        help='Number of worker processes sharing the request port (0 serves from this process).')
+    parser.add_argument('--cache_size', default=RESPONSE_CACHE_SIZE, type=int,
+                        help='Number of packed answers kept in the response cache (0 disables it).')
+    parser.add_argument('--forward', metavar='UPSTREAMS',
+                        help='Comma separated resolvers (host, host:port or [ipv6]:port) answering the names '
+                             'missing from the records.')
+    parser.add_argument('--forward_timeout', default=FORWARD_TIMEOUT, type=float,
+                        help='Seconds to wait for an upstream resolver before trying the next one.')
+    parser.add_argument('--forward_cache_size', default=FORWARD_CACHE_SIZE, type=int,
+                        help='Number of forwarded answers kept until their TTL expires.')
+    parser.add_argument('--forward_threads', default=FORWARD_THREADS, type=int,
+                        help='Number of threads waiting for the upstream resolvers.')
+    parser.add_argument('--forward_queue_size', default=FORWARD_QUEUE_SIZE, type=int,
+                        help='Maximum number of forwarded queries waiting for an answer; further ones get SERVFAIL.')
+    parser.add_argument('--transfer_zones', default='', metavar='ZONES',
+                        help='Comma separated zones (names, "." for all the records) served with a SOA record '
+                             'and transferred to secondary servers with AXFR and IXFR.')
+    parser.add_argument('--allow_transfer', default=TRANSFER_ALLOWED, metavar='NETWORKS',
+                        help='Comma separated addresses and networks allowed to transfer the zones.')
+    parser.add_argument('--notify', metavar='SECONDARIES',
+                        help='Comma separated secondary servers (host, host:port or [ipv6]:port) sent a NOTIFY '
+                             'whenever the records of a transfer zone change.')
+    parser.add_argument('--zone_file', help='Serve records from a mapped zone file instead of %s.' % PERSISTENT_RECORDS)
+    parser.add_argument('--import_records', metavar='FILE',
+                        help='Import the records of a zone (master) file or CSV file and exit.')
+    parser.add_argument('--import_format', choices=['zone', 'csv'],
+                        help='Format of the imported file (guessed from its extension by default).')
+    parser.add_argument('--import_processes', default=0, type=int,
+                        help='Processes validating the imported records in parallel (0 validates them inline).')
+    parser.add_argument('--convert_records', action='store_true',
+                        help='Convert %s into the zone file given by --zone_file and exit.' % PERSISTENT_RECORDS)
+    args = parser.parse_args()
+
+    if args.import_records:
+        store = RecordStore(zone_path=args.zone_file)
+        store.load()
+
+        def report_progress(lines, records, errors, rate):
+            print("%d lines, %d records, %d errors (%.0f lines/s)" % (lines, records, errors, rate), file=sys.stderr)
+
+        imported, errors = import_records(args.import_records, store, args.import_format, report_progress,
+                                          args.import_processes)
+        for number, error in errors[:IMPORT_ERRORS_SHOWN]:
+            print("%s:%d: %s" % (args.import_records, number, error))
+        if len(errors) > IMPORT_ERRORS_SHOWN:
+            print("... %d more errors" % (len(errors) - IMPORT_ERRORS_SHOWN))
+        print("Imported %d records from %s, %d lines rejected" % (imported, args.import_records, len(errors)))
+        return
+
+    if args.convert_records:
+        if not args.zone_file:
+            parser.error('--convert_records requires --zone_file')
+        written = convert_records(PERSISTENT_RECORDS, args.zone_file)
+        print("Converted %d records from %s into %s" % (written, PERSISTENT_RECORDS, args.zone_file))
+        return
+
+    global forwarder, notifier
+    forwarder = create_forwarder(args)
+    zone_transfers.configure([zone for zone in args.transfer_zones.split(',') if zone], args.allow_transfer)
+    response_cache.size = args.cache_size
+    response_limiter.configure(args.rrl_rate, args.rrl_slip, size=args.rrl_table_size)
+    query_log.level = args.query_log_level
+    query_log.sample_rate = args.query_log_sample
+    if args.query_log != '-':
+        query_log.stream = open(args.query_log, 'a')
+
     # starting server with one fake entry (first run)
     # not mandatory, can be removed later
-    resource_records = pickle.load(open(PERSISTENT_RECORDS, "rb"))
-    if len(resource_records) == 0:
-        record = DNSResourceRecord("www.google.com", "A", "IN", "1.2.3.4", 3600)
-        dns_resource_records = [[record.domain_name, record]]
-        pickle.dump(dns_resource_records, open(PERSISTENT_RECORDS, "wb"))
+    store = load_record_store(zone_path=args.zone_file)
+    if store.is_empty() and not args.headless:
+        store.apply([('add', DNSResourceRecord("www.google.com", "IN", "A", "1.2.3.4", 3600))])
+    # keeping the resident records in sync with the registration process
+    store.watch()
+    # secondaries are notified by this process only, workers announce the same serials
+    if args.notify:
+        notifier = Notifier([parse_upstream(secondary) for secondary in args.notify.split(',') if secondary])
+        store.add_listener(notifier.changed)
+        notifier.changed(None)
+
+    # starting servers with respective sockets handling,
+    # either in this process or in worker processes sharing the request port
+    servers, supervisor = [], None
+    if args.workers > 0:
+        ready = Semaphore(0)
+        supervisor = WorkerSupervisor(args.workers, run_worker, (args, ready))
+        supervisor.start()
+        print("Started %d worker processes on port %d" % (args.workers, args.request_port))
+    else:
+        servers = create_servers(args)
+        start_servers(servers)
+        if args.stats_port:
+            start_stats_server(args.stats_port)
+    # registrations are written by this process only, workers follow them through the journal
+    if args.register_port:
+        servers.append(start_registration_server(args.register_address, args.register_port))
+
+    # stopping the servers and workers on termination as well as on interrupts
+    signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+    try:
+        if supervisor is not None:
+            for _ in range(args.workers):
+                ready.acquire()
+        report_ready("serving %s on port %d" % (args.zone_file or PERSISTENT_RECORDS, args.request_port))
 
-    # starting cli process for registration
-    registration_process = Process(target=domain_registration)
-    registration_process.start()
-    registration_process.join()
+        if not args.headless:
+            # starting cli process for registration
+            registration_process = Process(target=domain_registration, args=(PERSISTENT_RECORDS, args.zone_file))
+            registration_process.start()
+            registration_process.join()
 
-    try:
         while True:
             time.sleep(30)
             sys.stderr.flush()
@@ -384,7 +3821,12 @@ def main():
     finally:
         for server in servers:
             server.shutdown()
+        if supervisor is not None:
+            supervisor.stop()
 
 
 if __name__ == '__main__':
+    # records pickled here or by tools importing this module (benchmark.py, tests) refer to server.DNSResourceRecord
+    sys.modules.setdefault('server', sys.modules['__main__'])
+    DNSResourceRecord.__module__ = MappedResourceRecord.__module__ = 'server'
     main()
@@ -1,7 +1,43 @@
+import io
+import json
+import multiprocessing
+import os
+import queue
+import socket
+import struct
+import subprocess
+import sys
+import tempfile
+import threading
+import time
 import unittest
-from dnslib import CLASS, QTYPE, A, AAAA, CNAME, TXT
+import unittest.mock
+import urllib.request
+from dnslib import CLASS, OPCODE, QTYPE, RCODE, RR, A, AAAA, CNAME, TXT, EDNS0, DNSQuestion, DNSRecord
+import benchmark
+import server
 from server import validate_domain_class, validate_domain_type, \
-    validate_domain_data, validate_new_domain, get_data_by_type
+    validate_domain_data, validate_new_domain, get_data_by_type, \
+    DNSResourceRecord, RecordStore, MappedZone, check_domain_entry, convert_records, \
+    handle_dns_client, handle_domain_registration
+
+
+class RecordStoreTestCaseBase(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp_dir = tempfile.TemporaryDirectory()
+        self.records_path = os.path.join(self.tmp_dir.name, "records.p")
+        self.store = RecordStore(self.records_path)
+        self.store.add_listener(server.invalidate_caches)
+        self.store.load()
+        self.previous_store = server.record_store
+        server.record_store = self.store
+
+    def tearDown(self):
+        server.record_store = self.previous_store
+        server.response_cache.clear()
+        server.cname_chains.clear()
+        self.tmp_dir.cleanup()
 
 
 class DomainClassTestCase(unittest.TestCase):
@@ -312,4 +348,1656 @@ class DataByTypeTestCase(unittest.TestCase):
 
     def test_aaaa_with_txt_data(self):
         result = get_data_by_type(QTYPE[28], "txtvers=1")
-        self.assertIsNone(result)
\ No newline at end of file
+        self.assertIsNone(result)
+
+
+class ValidateEntriesTestCase(unittest.TestCase):
+
+    entries = ["www.google.com IN A 1.2.3.4",
+               "www.google.com IN A 01.2.3.4",
+               ("ipv6.google.com", "IN", "AAAA", "21DA:D3:0::9C5A"),
+               ("ipv6.google.com", "IN", "AAAA", "2001:db8::10001"),
+               ("ipv6.google.com", "IN", "AAAA", "fe80::1%eth0"),
+               "mail.google.com IN CNAME www.google.com",
+               "*.google.com IN TXT abc=def",
+               "123.google.com IN A 1.2.3.4"]
+
+    def test_results_in_order(self):
+        expected = [validate_new_domain(entry) if isinstance(entry, str) else server.validate_domain_fields(*entry)
+                    for entry in self.entries]
+        self.assertEqual([result is not None for result in expected],
+                         [True, False, True, False, False, True, True, False])
+        self.assertEqual(list(server.validate_domain_entries(iter(self.entries))), expected)
+        self.assertEqual(list(server.validate_domain_entries(iter(self.entries * 5), processes=2, chunk_size=3)),
+                         expected * 5)
+
+
+class RecordStoreTestCase(RecordStoreTestCaseBase):
+
+    def test_load_missing_file(self):
+        self.assertEqual(len(self.store), 0)
+        self.assertEqual(check_domain_entry("www.google.com.", "IN", "A"), [])
+
+    def test_lookup_is_case_insensitive(self):
+        self.store.apply([('add', DNSResourceRecord("www.Google.com", "IN", "A", "1.2.3.4"))])
+        result = check_domain_entry("WWW.google.COM.", "IN", "A")
+        self.assertEqual([record.data for record in result], ["1.2.3.4"])
+
+    def test_lookup_follows_cname(self):
+        self.store.apply([('add', DNSResourceRecord("www.google.com", "IN", "CNAME", "google.com"))])
+        self.store.apply([('add', DNSResourceRecord("google.com", "IN", "A", "1.2.3.4"))])
+        result = check_domain_entry("www.google.com.", "IN", "A")
+        self.assertEqual([record.data for record in result], ["google.com", "1.2.3.4"])
+
+    def test_cname_chain_is_memoized_until_a_link_changes(self):
+        self.store.apply([('add', DNSResourceRecord("www.google.com", "IN", "CNAME", "cdn.google.com")),
+                          ('add', DNSResourceRecord("cdn.google.com", "IN", "CNAME", "edge.cdn.net")),
+                          ('add', DNSResourceRecord("edge.cdn.net", "IN", "A", "1.2.3.4"))])
+        result = check_domain_entry("www.google.com.", "IN", "A")
+        self.assertEqual([record.data for record in result], ["cdn.google.com", "edge.cdn.net", "1.2.3.4"])
+        self.assertIn(("www.google.com", "IN", "A"), server.cname_chains._entries)
+        self.store.apply([('replace', DNSResourceRecord("edge.cdn.net", "IN", "A", "5.6.7.8"))])
+        result = check_domain_entry("www.google.com.", "IN", "A")
+        self.assertEqual([record.data for record in result], ["cdn.google.com", "edge.cdn.net", "5.6.7.8"])
+
+    def test_cname_chain_to_missing_name(self):
+        self.store.apply([('add', DNSResourceRecord("www.google.com", "IN", "CNAME", "google.com"))])
+        self.assertEqual([record.data for record in check_domain_entry("www.google.com", "IN", "A")], ["google.com"])
+        self.store.apply([('add', DNSResourceRecord("google.com", "IN", "A", "1.2.3.4"))])
+        result = check_domain_entry("www.google.com", "IN", "A")
+        self.assertEqual([record.data for record in result], ["google.com", "1.2.3.4"])
+
+    def test_cname_loop_answers_servfail(self):
+        self.store.apply([('add', DNSResourceRecord("a.google.com", "IN", "CNAME", "b.google.com")),
+                          ('add', DNSResourceRecord("b.google.com", "IN", "CNAME", "a.google.com"))])
+        with self.assertRaises(server.CnameChainError):
+            check_domain_entry("a.google.com", "IN", "A")
+        reply = DNSRecord.parse(handle_dns_client(DNSRecord.question("a.google.com", "A").pack())[0])
+        self.assertEqual(reply.header.rcode, RCODE.SERVFAIL)
+        self.store.apply([('replace', DNSResourceRecord("b.google.com", "IN", "A", "1.2.3.4"))])
+        reply = DNSRecord.parse(handle_dns_client(DNSRecord.question("a.google.com", "A").pack())[0])
+        self.assertEqual(reply.header.rcode, RCODE.NOERROR)
+        self.assertEqual(str(reply.rr[-1].rdata), "1.2.3.4")
+
+    def test_cname_chain_too_long(self):
+        length = server.CNAME_CHAIN_MAX_LENGTH + 2
+        self.store.apply([('add', DNSResourceRecord("host%d.google.com" % position, "IN", "CNAME",
+                                                    "host%d.google.com" % (position + 1))) for position in range(length)])
+        with self.assertRaises(server.CnameChainError):
+            check_domain_entry("host0.google.com", "IN", "A")
+        self.assertEqual(len(check_domain_entry("host3.google.com", "IN", "A")), length - 3)
+
+    def test_lookup_other_class(self):
+        self.store.apply([('add', DNSResourceRecord("www.google.com", "IN", "A", "1.2.3.4"))])
+        self.assertEqual(check_domain_entry("www.google.com.", "CH", "A"), [])
+
+    def test_save_and_reload(self):
+        self.store.apply([('add', DNSResourceRecord("www.google.com", "IN", "A", "1.2.3.4"))])
+        self.store.compact()
+        store = RecordStore(self.records_path)
+        store.load()
+        self.assertEqual([record.data for record in store.lookup("www.google.com", "IN", "A")], ["1.2.3.4"])
+
+    def test_snapshots_are_not_modified(self):
+        self.store.apply([('add', DNSResourceRecord("www.google.com", "IN", "A", "1.2.3.4"))])
+        snapshot = self.store.snapshot()
+        self.store.apply([('replace', DNSResourceRecord("www.google.com", "IN", "A", "5.6.7.8")),
+                          ('add', DNSResourceRecord("mail.google.com", "IN", "A", "1.2.3.4"))])
+        self.assertEqual([record.data for record in snapshot.lookup("www.google.com", "IN", "A")], ["1.2.3.4"])
+        self.assertFalse(snapshot.exists("mail.google.com"))
+        self.assertEqual([record.data for record in self.store.lookup("www.google.com", "IN", "A")], ["5.6.7.8"])
+        self.assertTrue(self.store.snapshot().exists("mail.google.com"))
+
+    def test_readers_never_see_partial_changes(self):
+        self.store.apply([('add', DNSResourceRecord("www.google.com", "IN", "A", "1.2.3.4"))])
+        seen, insert = [], server.RecordIndex.insert
+
+        def read_then_insert(index, record):
+            # a reader running between the removal and the insertion of a replace
+            seen.append([record.data for record in self.store.lookup("www.google.com", "IN", "A")])
+            insert(index, record)
+
+        with unittest.mock.patch.object(server.RecordIndex, 'insert', read_then_insert):
+            self.store.apply([('replace', DNSResourceRecord("www.google.com", "IN", "A", "5.6.7.8"))])
+        self.assertEqual(seen, [["1.2.3.4"]])
+        self.assertEqual([record.data for record in self.store.lookup("www.google.com", "IN", "A")], ["5.6.7.8"])
+
+    def test_compaction_merges_layers(self):
+        store = RecordStore(self.records_path, compact_min_size=0)
+        store.load()
+        store.apply([('add', DNSResourceRecord("www.google.com", "IN", "A", "1.2.3.4")),
+                     ('add', DNSResourceRecord("mail.google.com", "IN", "A", "1.2.3.4"))])
+        store.compaction.join()
+        store.apply([('delete', "mail.google.com"),
+                     ('add', DNSResourceRecord("www.google.com", "IN", "A", "5.6.7.8"))])
+        store.compaction.join()
+        self.assertEqual(store.snapshot().records, {})
+        self.assertFalse(store.has_name("mail.google.com"))
+        self.assertFalse(store.snapshot().exists("mail.google.com"))
+        self.assertEqual([record.data for record in store.lookup("www.google.com", "IN", "A")], ["1.2.3.4", "5.6.7.8"])
+
+    def test_refresh_picks_up_external_changes(self):
+        self.store.compact()
+        other = RecordStore(self.records_path)
+        other.load()
+        other.apply([('add', DNSResourceRecord("www.google.com", "IN", "A", "1.2.3.4"))])
+        self.assertTrue(self.store.refresh())
+        self.assertTrue(self.store.has_name("www.google.com."))
+
+    def test_registration_replaces_name(self):
+        self.assertTrue(handle_domain_registration("www.google.com IN A 1.2.3.4"))
+        self.assertTrue(handle_domain_registration("www.google.com IN TXT abc=def"))
+        self.assertEqual(check_domain_entry("www.google.com.", "IN", "A"), [])
+        result = check_domain_entry("www.google.com.", "IN", "TXT")
+        self.assertEqual([record.data for record in result], ["abc=def"])
+        store = RecordStore(self.records_path)
+        store.load()
+        self.assertEqual(len(store), 1)
+
+    def test_registration_cli_forked_during_a_change(self):
+        entries = iter(["www.google.com IN A 1.2.3.4"])
+
+        def prompt(message):
+            for entry in entries:
+                return entry
+            raise EOFError
+
+        cli = multiprocessing.get_context('fork').Process(target=server.domain_registration,
+                                                          args=(self.records_path,))
+        self.addCleanup(cli.kill)
+        with unittest.mock.patch('prompt_toolkit.prompt', prompt), unittest.mock.patch('os.system'), \
+                unittest.mock.patch('time.sleep'):
+            # forked while a thread of the server holds the lock of its store
+            with self.store.lock:
+                cli.start()
+            cli.join(10)
+        self.assertEqual(cli.exitcode, 0)
+        self.assertTrue(self.store.refresh())
+        self.assertEqual([record.data for record in check_domain_entry("www.google.com.", "IN", "A")], ["1.2.3.4"])
+
+    def test_dns_client_answer(self):
+        self.store.apply([('add', DNSResourceRecord("www.google.com", "IN", "A", "1.2.3.4"))])
+        query = DNSRecord.question("www.google.com", "A")
+        reply = DNSRecord.parse(handle_dns_client(query.pack())[0])
+        self.assertEqual(reply.header.id, query.header.id)
+        self.assertEqual(str(reply.a.rdata), "1.2.3.4")
+
+    def test_dns_client_nxdomain(self):
+        query = DNSRecord.question("missing.google.com", "A")
+        reply = DNSRecord.parse(handle_dns_client(query.pack())[0])
+        self.assertEqual(reply.header.rcode, RCODE.NXDOMAIN)
+
+
+class RecordJournalTestCase(RecordStoreTestCaseBase):
+
+    def reloaded_store(self):
+        store = RecordStore(self.records_path)
+        store.load()
+        return store
+
+    def test_apply_appends_to_journal(self):
+        self.store.compact()
+        snapshot_size = os.path.getsize(self.records_path)
+        self.store.apply([('add', DNSResourceRecord("www.google.com", "IN", "A", "1.2.3.4"))])
+        self.store.apply([('add', DNSResourceRecord("www.google.com", "IN", "A", "5.6.7.8"))])
+        self.assertEqual(os.path.getsize(self.records_path), snapshot_size)
+        records = self.reloaded_store().lookup("www.google.com", "IN", "A")
+        self.assertEqual([record.data for record in records], ["1.2.3.4", "5.6.7.8"])
+
+    def test_replace_and_delete(self):
+        self.store.apply([('add', DNSResourceRecord("www.google.com", "IN", "A", "1.2.3.4")),
+                          ('add', DNSResourceRecord("mail.google.com", "IN", "A", "1.2.3.5")),
+                          ('replace', DNSResourceRecord("www.google.com", "IN", "TXT", "abc=def")),
+                          ('delete', "mail.google.com")])
+        store = self.reloaded_store()
+        self.assertEqual(len(store), 1)
+        self.assertFalse(store.has_name("mail.google.com"))
+        self.assertEqual(store.lookup("www.google.com", "IN", "TXT")[0].data, "abc=def")
+
+    def test_torn_tail_is_ignored(self):
+        self.store.apply([('add', DNSResourceRecord("www.google.com", "IN", "A", "1.2.3.4"))])
+        with open(self.store.journal.path, "ab") as journal_file:
+            journal_file.write(b"\x00\x00\x01\x00garbage")
+        store = self.reloaded_store()
+        self.assertEqual(len(store), 1)
+        store.apply([('add', DNSResourceRecord("mail.google.com", "IN", "A", "1.2.3.5"))])
+        self.assertEqual(len(self.reloaded_store()), 2)
+
+    def test_compaction_follows_snapshot_size(self):
+        self.store.apply([('add', DNSResourceRecord("host%d.google.com" % index, "IN", "A", "1.2.3.4"))
+                          for index in range(100)])
+        self.store.compact()
+        self.store.compact_min_size = 0
+        # a change much smaller than the snapshot is only journaled
+        self.store.apply([('add', DNSResourceRecord("www.google.com", "IN", "A", "1.2.3.4"))])
+        self.assertIsNone(self.store.compaction)
+        self.store.apply([('add', DNSResourceRecord("mail%d.google.com" % index, "IN", "A", "1.2.3.4"))
+                          for index in range(30)])
+        self.store.compaction.join()
+        self.assertEqual(self.store._journal_entries, 0)
+        self.assertEqual(len(self.reloaded_store()), 131)
+
+    def test_compaction_runs_off_the_commit_path(self):
+        self.store.compact_min_size = 0
+        writing, release = threading.Event(), threading.Event()
+        write_snapshot = RecordStore._write_snapshot
+
+        def slow_write_snapshot(store, index, generation):
+            writing.set()
+            release.wait(5)
+            return write_snapshot(store, index, generation)
+
+        with unittest.mock.patch.object(RecordStore, '_write_snapshot', slow_write_snapshot):
+            self.store.apply([('add', DNSResourceRecord("www.google.com", "IN", "A", "1.2.3.4"))])
+            self.assertTrue(writing.wait(5))
+            # changes are committed while the snapshot is being written, and carried to the new journal
+            self.store.apply([('add', DNSResourceRecord("mail.google.com", "IN", "A", "1.2.3.5"))])
+            self.assertEqual(len(self.reloaded_store()), 2)
+            release.set()
+            self.store.compaction.join()
+        self.assertEqual((self.store._generation, self.store._journal_entries), (1, 1))
+        self.assertEqual(len(self.store), 2)
+        store = self.reloaded_store()
+        self.assertEqual((len(store), store.snapshot().serial), (2, self.store.snapshot().serial))
+
+    def test_compaction_interrupted_between_renames(self):
+        self.store.compact_min_size = 0
+        replace = os.replace
+
+        def crash_before_journal(source, destination):
+            if source == self.store.journal.path + '.next':
+                raise OSError("interrupted")
+            replace(source, destination)
+
+        with unittest.mock.patch('os.replace', crash_before_journal), \
+                unittest.mock.patch('sys.stderr', io.StringIO()):
+            self.store.apply([('add', DNSResourceRecord("www.google.com", "IN", "A", "1.2.3.4"))])
+            self.store.compaction.join()
+        self.assertTrue(os.path.exists(self.store.journal.path + '.next'))
+        store = self.reloaded_store()
+        self.assertEqual((store._generation, len(store)), (1, 1))
+        self.assertFalse(os.path.exists(self.store.journal.path + '.next'))
+
+    def test_stale_journal_is_not_replayed(self):
+        self.store.apply([('add', DNSResourceRecord("www.google.com", "IN", "A", "1.2.3.4"))])
+        with open(self.store.journal.path, "rb") as journal_file:
+            stale_journal = journal_file.read()
+        self.store.compact()
+        # simulating a crash between the snapshot rename and the journal reset
+        with open(self.store.journal.path, "wb") as journal_file:
+            journal_file.write(stale_journal)
+        self.assertEqual(len(self.reloaded_store()), 1)
+
+
+class MappedZoneTestCase(RecordStoreTestCaseBase):
+
+    def setUp(self):
+        super().setUp()
+        self.store.apply([('add', DNSResourceRecord("www.google.com", "IN", "A", "1.2.3.4")),
+                          ('add', DNSResourceRecord("www.google.com", "IN", "A", "5.6.7.8")),
+                          ('add', DNSResourceRecord("mail.google.com", "IN", "CNAME", "www.google.com")),
+                          ('add', DNSResourceRecord("ipv6.google.com", "IN", "AAAA", "21DA:D3:0::9C5A"))])
+        self.zone_path = os.path.join(self.tmp_dir.name, "records.zone")
+        self.assertEqual(convert_records(self.records_path, self.zone_path), 4)
+        self.zone_store = RecordStore(self.records_path, zone_path=self.zone_path)
+        self.zone_store.add_listener(server.invalidate_caches)
+        self.zone_store.load()
+        server.record_store = self.zone_store
+
+    def test_lookup(self):
+        zone = MappedZone(self.zone_path)
+        # plus the google.com and com empty non-terminals
+        self.assertEqual(zone.name_count, 5)
+        self.assertTrue(zone.exists("google.com"))
+        self.assertFalse(zone.has_name("google.com"))
+        self.assertEqual([record.data for record in zone.lookup("www.google.com", "IN", "A")],
+                         ["1.2.3.4", "5.6.7.8"])
+        self.assertEqual(zone.lookup("www.google.com", "IN", "AAAA"), [])
+        self.assertEqual(zone.lookup("missing.google.com", "IN", "A"), [])
+
+    def test_dns_client_answer(self):
+        query = DNSRecord.question("MAIL.google.com", "A")
+        reply = DNSRecord.parse(handle_dns_client(query.pack())[0])
+        self.assertEqual([str(rr.rdata) for rr in reply.rr], ["www.google.com.", "1.2.3.4", "5.6.7.8"])
+        query = DNSRecord.question("ipv6.google.com", "AAAA")
+        reply = DNSRecord.parse(handle_dns_client(query.pack())[0])
+        self.assertEqual(str(reply.a.rdata), "21da:d3::9c5a")
+
+    def test_changes_overlay_zone(self):
+        self.zone_store.apply([('add', DNSResourceRecord("www.google.com", "IN", "A", "9.9.9.9")),
+                               ('delete', "mail.google.com")])
+        self.assertEqual(len(self.zone_store.lookup("www.google.com", "IN", "A")), 3)
+        self.assertFalse(self.zone_store.has_name("mail.google.com"))
+        self.zone_store.compact()
+        self.assertEqual(MappedZone(self.zone_path).name_count, 4)
+        store = RecordStore(self.records_path, zone_path=self.zone_path)
+        store.load()
+        self.assertEqual(len(store), 4)
+        self.assertEqual(len(store.lookup("www.google.com", "IN", "A")), 3)
+
+    def test_missing_zone_file(self):
+        zone_path = os.path.join(self.tmp_dir.name, "new.zone")
+        store = RecordStore(zone_path=zone_path)
+        store.load()
+        self.assertTrue(store.is_empty())
+        store.apply([('add', DNSResourceRecord("www.google.com", "IN", "A", "1.2.3.4"))])
+        store.compact()
+        self.assertEqual(MappedZone(zone_path).name_count, 3)
+        store = RecordStore(zone_path=zone_path)
+        store.load()
+        self.assertEqual(len(store.lookup("www.google.com", "IN", "A")), 1)
+
+
+class ImportRecordsTestCase(RecordStoreTestCaseBase):
+
+    def write(self, name, content):
+        path = os.path.join(self.tmp_dir.name, name)
+        with open(path, "w") as source:
+            source.write(content)
+        return path
+
+    def test_zone_file_entries(self):
+        lines = ["$ORIGIN example.com.",
+                 "$TTL 600",
+                 "@ IN A 1.2.3.4 ; apex",
+                 "www 300 IN CNAME @",
+                 "    IN 60 TXT \"abc=def\"",
+                 "mail.other.org. A 5.6.7.8",
+                 "alias CNAME mail.other.org.",
+                 "; comment only",
+                 "",
+                 "bad IN SOA ( ns 1 2 3 4 5 )",
+                 "$INCLUDE other.zone"]
+        entries = list(server.zone_file_entries(lines))
+        self.assertEqual([fields for _, fields, _ in entries if fields], [
+            ("example.com", "IN", "A", "1.2.3.4", 600),
+            ("www.example.com", "IN", "CNAME", "example.com", 300),
+            ("www.example.com", "IN", "TXT", "abc=def", 60),
+            ("mail.other.org", "IN", "A", "5.6.7.8", 600),
+            ("alias.example.com", "IN", "CNAME", "mail.other.org", 600)])
+        self.assertEqual([(number, error) for number, fields, error in entries if fields is None],
+                         [(10, "multi-line records are not supported"), (11, "unsupported directive")])
+
+    def test_import_zone_file(self):
+        self.store.apply([('add', DNSResourceRecord("www.example.com", "IN", "A", "9.9.9.9")),
+                          ('add', DNSResourceRecord("other.example.com", "IN", "A", "9.9.9.9"))])
+        path = self.write("example.zone", "$ORIGIN example.com.\n"
+                                          "www IN A 1.2.3.4\n"
+                                          "www IN A 5.6.7.8\n"
+                                          "bad_name! IN A 1.2.3.4\n"
+                                          "mail IN A 300.1.1.1\n"
+                                          "*.dev IN A 1.2.3.4\n")
+        progress = []
+        imported, errors = server.import_records(path, self.store, progress=lambda *report: progress.append(report))
+        self.assertEqual(imported, 3)
+        self.assertEqual(errors, [(4, "invalid name [bad_name!.example.com]"), (5, "invalid A data [300.1.1.1]")])
+        self.assertEqual(progress[-1][:3], (6, 3, 2))
+        # names of the file replace their registered records, the others are kept
+        self.assertEqual(sorted(record.data for record in check_domain_entry("www.example.com", "IN", "A")),
+                         ["1.2.3.4", "5.6.7.8"])
+        self.assertEqual(len(check_domain_entry("other.example.com", "IN", "A")), 1)
+        self.assertEqual(len(check_domain_entry("host.dev.example.com", "IN", "A")), 1)
+        # written as a new snapshot rather than journaled
+        self.assertEqual(os.path.getsize(self.records_path + ".journal"), len(server.RecordJournal("").encode(
+            [('generation', self.store._generation), ('serial', self.store.snapshot().serial)])))
+        store = RecordStore(self.records_path)
+        store.load()
+        self.assertEqual(len(store), 4)
+
+    def test_import_csv(self):
+        path = self.write("records.csv", "name,class,type,data,ttl\n"
+                                         "www.example.com,IN,A,1.2.3.4,60\n"
+                                         "www.example.com.,in,txt,abc=def\n"
+                                         "www.example.com,IN,A\n")
+        imported, errors = server.import_records(path, self.store, processes=1)
+        self.assertEqual(imported, 2)
+        self.assertEqual(errors, [(4, "expected name,class,type,data[,ttl]")])
+        self.assertEqual([record.ttl for record in check_domain_entry("www.example.com", "IN", "A")], [60])
+        self.assertEqual(len(check_domain_entry("www.example.com", "IN", "TXT")), 1)
+
+    def test_import_into_new_zone_file(self):
+        self.write("records.csv", "www.example.com,IN,A,1.2.3.4\nmail.example.com,IN,TXT,abc=def\n")
+        output = subprocess.check_output([sys.executable, benchmark.SERVER_SCRIPT, '--import_records', 'records.csv',
+                                          '--zone_file', 'records.zone'], cwd=self.tmp_dir.name)
+        self.assertIn(b"Imported 2 records", output)
+        zone = MappedZone(os.path.join(self.tmp_dir.name, "records.zone"))
+        self.assertEqual([record.data for record in zone.lookup("www.example.com", "IN", "A")], ["1.2.3.4"])
+        self.assertEqual(len(zone.lookup("mail.example.com", "IN", "TXT")), 1)
+
+    def test_running_store_follows_import(self):
+        self.store.compact()
+        other = RecordStore(self.records_path)
+        other.load()
+        server.import_records(self.write("example.zone", "www.example.com. IN A 1.2.3.4\n"), other)
+        self.assertTrue(self.store.refresh())
+        self.assertEqual(len(check_domain_entry("www.example.com", "IN", "A")), 1)
+
+
+class RegistrationServerTestCase(RecordStoreTestCaseBase):
+
+    def setUp(self):
+        super().setUp()
+        self.registration_server = server.RegistrationServer(('127.0.0.1', 0))
+        threading.Thread(target=self.registration_server.serve_forever, daemon=True).start()
+
+    def tearDown(self):
+        self.registration_server.shutdown()
+        self.registration_server.server_close()
+        super().tearDown()
+
+    def connect(self):
+        connection = socket.create_connection(self.registration_server.server_address, timeout=5)
+        self.addCleanup(connection.close)
+        return connection, connection.makefile('rb')
+
+    def test_messages_are_acknowledged_in_order(self):
+        connection, reader = self.connect()
+        connection.sendall(b"add www.google.com IN A 1.2.3.4\n"
+                           b"add www.google.com IN A 5.6.7.8\n"
+                           b"www.google.com IN TXT abc=def\n"
+                           b"add bad_name! IN A 1.2.3.4\n"
+                           b"\n"
+                           b"add mail.google.com IN CNAME www.google.com\n"
+                           b"delete mail.google.com\n")
+        acks = [reader.readline() for _ in range(6)]
+        self.assertEqual(acks, [b"OK add www.google.com\n", b"OK add www.google.com\n", b"OK replace www.google.com\n",
+                                b"ERROR invalid name [bad_name!]\n", b"OK add mail.google.com\n",
+                                b"OK delete mail.google.com\n"])
+        self.assertEqual(check_domain_entry("www.google.com", "IN", "A"), [])
+        self.assertEqual(len(check_domain_entry("www.google.com", "IN", "TXT")), 1)
+        self.assertFalse(self.store.has_name("mail.google.com"))
+        store = RecordStore(self.records_path)
+        store.load()
+        self.assertEqual(len(store), 1)
+
+    def test_concurrent_writers_share_commits(self):
+        clients, messages = 8, 200
+
+        def register(client):
+            connection, reader = self.connect()
+            for position in range(messages):
+                connection.sendall(b"add host-%d.client-%d.example.com IN A 1.2.3.4\n" % (position, client))
+                self.assertTrue(reader.readline().startswith(b"OK add"))
+
+        threads = [threading.Thread(target=register, args=(client,)) for client in range(clients)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        stats = self.registration_server.stats()
+        self.assertEqual(stats['operations'], clients * messages)
+        self.assertLessEqual(stats['commits'], clients * messages)
+        self.assertEqual(len(self.store), clients * messages)
+
+    def test_line_too_long(self):
+        connection, reader = self.connect()
+        connection.sendall(b"x" * (server.REGISTRATION_LINE_LIMIT + 10))
+        self.assertEqual(reader.readline(), b"ERROR line too long\n")
+        self.assertEqual(reader.readline(), b"")
+
+
+class NameTreeTestCase(RecordStoreTestCaseBase):
+
+    def query(self, name, qtype="A"):
+        return DNSRecord.parse(handle_dns_client(DNSRecord.question(name, qtype).pack())[0])
+
+    def add_records(self, store):
+        store.apply([('add', DNSResourceRecord("*.example.com", "IN", "A", "1.2.3.4")),
+                     ('add', DNSResourceRecord("www.example.com", "IN", "TXT", "abc=def")),
+                     ('add', DNSResourceRecord("host.dev.example.com", "IN", "A", "5.6.7.8")),
+                     ('add', DNSResourceRecord("*.cdn.example.com", "IN", "CNAME", "www.example.com"))])
+
+    def test_tree(self):
+        tree = server.NameTree()
+        tree.add("host.dev.example.com")
+        tree.add("example.com")
+        self.assertEqual(tree.depth("dev.example.com"), 3)
+        self.assertEqual(tree.depth("other.dev.example.com"), 3)
+        self.assertEqual(tree.depth("example.org"), 0)
+        self.assertEqual((tree.count("example.com"), tree.count("dev.example.com"), tree.count("com")), (2, 1, 2))
+        self.assertNotIn("dev.example.com", tree)
+        tree.remove("host.dev.example.com")
+        self.assertEqual(tree.depth("dev.example.com"), 2)
+        self.assertEqual(tree.count("example.com"), 1)
+        tree.remove("example.com")
+        self.assertEqual(tree.root[0], {})
+
+    def test_copies_share_unchanged_nodes(self):
+        tree = server.NameTree()
+        tree.add("www.example.com")
+        tree.add("www.example.org")
+        copy = tree.copy()
+        copy.add("mail.example.com")
+        copy.remove("www.example.org")
+        self.assertEqual((tree.depth("mail.example.com"), tree.depth("www.example.org")), (2, 3))
+        self.assertEqual((copy.depth("mail.example.com"), copy.depth("www.example.org")), (3, 0))
+        self.assertIs(copy.root[0]["com"][0]["example"][0]["www"], tree.root[0]["com"][0]["example"][0]["www"])
+
+    def check_answers(self):
+        reply = self.query("Anything.example.com")
+        self.assertEqual(reply.header.rcode, RCODE.NOERROR)
+        self.assertEqual([(str(rr.rname), str(rr.rdata)) for rr in reply.rr], [("anything.example.com.", "1.2.3.4")])
+        # the wildcard only covers names missing below example.com
+        self.assertEqual(self.query("a.b.example.com").header.rcode, RCODE.NOERROR)
+        self.assertEqual(self.query("missing.dev.example.com").header.rcode, RCODE.NXDOMAIN)
+        # existing names without records of the type: NODATA
+        reply = self.query("www.example.com")
+        self.assertEqual((reply.header.rcode, reply.rr), (RCODE.NOERROR, []))
+        reply = self.query("dev.example.com")
+        self.assertEqual((reply.header.rcode, reply.rr), (RCODE.NOERROR, []))
+        self.assertEqual(self.query("example.com", "TXT").header.rcode, RCODE.NOERROR)
+        self.assertEqual(self.query("example.org").header.rcode, RCODE.NXDOMAIN)
+        reply = self.query("img.cdn.example.com", "TXT")
+        self.assertEqual([str(rr.rname) for rr in reply.rr], ["img.cdn.example.com.", "www.example.com."])
+
+    def test_wildcards_and_nodata(self):
+        self.add_records(self.store)
+        self.check_answers()
+
+    def test_wildcards_and_nodata_in_zone(self):
+        self.add_records(self.store)
+        zone_path = os.path.join(self.tmp_dir.name, "records.zone")
+        convert_records(self.records_path, zone_path)
+        store = RecordStore(self.records_path, zone_path=zone_path)
+        store.add_listener(server.invalidate_caches)
+        store.load()
+        server.record_store = store
+        self.check_answers()
+
+    def test_changes_invalidate_negative_answers(self):
+        self.add_records(self.store)
+        self.assertEqual(self.query("x.dev.example.com").header.rcode, RCODE.NXDOMAIN)
+        self.store.apply([('add', DNSResourceRecord("*.dev.example.com", "IN", "A", "9.9.9.9"))])
+        self.assertEqual(str(self.query("x.dev.example.com").a.rdata), "9.9.9.9")
+        self.assertEqual(self.query("new.example.org").header.rcode, RCODE.NXDOMAIN)
+        self.store.apply([('add', DNSResourceRecord("a.new.example.org", "IN", "A", "9.9.9.9"))])
+        reply = self.query("new.example.org")
+        self.assertEqual((reply.header.rcode, reply.rr), (RCODE.NOERROR, []))
+        self.store.apply([('delete', "a.new.example.org")])
+        self.assertEqual(self.query("new.example.org").header.rcode, RCODE.NXDOMAIN)
+
+    def check_deletions(self, store):
+        server.record_store = store
+        store.apply([('add', DNSResourceRecord(name, "IN", "A", "1.2.3.4"))
+                     for name in ["host.dev.example.net", "a.example.net", "x.a.example.net", "www.example.net"]])
+        store.compact()
+        store.apply([('delete', "host.dev.example.net"), ('delete', "a.example.net")])
+        for compacted in [False, True]:
+            if compacted:
+                store.compact()
+            # the empty non-terminal left by the deletion vanishes, the name keeping a name below it does not
+            self.assertEqual(self.query("dev.example.net").header.rcode, RCODE.NXDOMAIN)
+            self.assertEqual(self.query("host.dev.example.net").header.rcode, RCODE.NXDOMAIN)
+            reply = self.query("a.example.net")
+            self.assertEqual((reply.header.rcode, reply.rr), (RCODE.NOERROR, []))
+            self.assertEqual(str(self.query("x.a.example.net").a.rdata), "1.2.3.4")
+            self.assertEqual(self.query("example.net", "TXT").header.rcode, RCODE.NOERROR)
+
+    def test_deletions_over_snapshot(self):
+        self.check_deletions(self.store)
+
+    def test_deletions_over_zone(self):
+        store = RecordStore(self.records_path, zone_path=os.path.join(self.tmp_dir.name, "records.zone"))
+        store.add_listener(server.invalidate_caches)
+        store.load()
+        self.check_deletions(store)
+
+    def test_wildcard_registration(self):
+        self.assertTrue(handle_domain_registration("*.example.com IN A 1.2.3.4"))
+        self.assertEqual(str(self.query("foo.example.com").a.rdata), "1.2.3.4")
+        self.assertIsNone(validate_new_domain("*example.com IN A 1.2.3.4"))
+        self.assertIsNone(validate_new_domain("www.example.com IN CNAME *.example.com"))
+
+
+class NegativeFilterTestCase(RecordStoreTestCaseBase):
+
+    def setUp(self):
+        super().setUp()
+        self.filter = server.NegativeFilter()
+        self.filter.attach(self.store)
+        self.previous_filter = server.negative_filter
+        server.negative_filter = self.filter
+        self.store.apply([('add', DNSResourceRecord("www.example.com", "IN", "A", "1.2.3.4")),
+                          ('add', DNSResourceRecord("host.dev.example.com", "IN", "A", "5.6.7.8"))])
+
+    def tearDown(self):
+        server.negative_filter = self.previous_filter
+        super().tearDown()
+
+    def query(self, name, qtype="A"):
+        return DNSRecord.parse(handle_dns_client(DNSRecord.question(name, qtype).pack())[0])
+
+    def test_missing_names(self):
+        self.assertFalse(self.filter.missing("www.example.com"))
+        self.assertFalse(self.filter.missing("dev.example.com"))
+        self.assertFalse(self.filter.missing("example.com"))
+        rejected = sum(self.filter.missing("random-%d.example.com" % position) for position in range(1000))
+        # false positives only send names to the regular lookup
+        self.assertGreater(rejected, 950)
+
+    def test_template_matches_regular_answer(self):
+        query = DNSRecord.question("Random-1.example.com", "A")
+        rejected = self.filter.rejected
+        response = handle_dns_client(query.pack())[0]
+        self.assertEqual(self.filter.rejected, rejected + 1)
+        self.assertNotIn(("random-1.example.com", 1, 1), server.response_cache._entries)
+        self.filter.filter = None
+        self.assertEqual(handle_dns_client(query.pack())[0], response)
+        self.assertEqual(DNSRecord.parse(response).header.rcode, RCODE.NXDOMAIN)
+
+    def test_follows_registrations(self):
+        self.assertEqual(self.query("new.example.com").header.rcode, RCODE.NXDOMAIN)
+        self.store.apply([('add', DNSResourceRecord("new.example.com", "IN", "A", "9.9.9.9"))])
+        self.assertEqual(str(self.query("new.example.com").a.rdata), "9.9.9.9")
+        self.store.apply([('add', DNSResourceRecord("*.wild.example.com", "IN", "A", "9.9.9.9"))])
+        self.assertFalse(self.filter.missing("random.wild.example.com"))
+        self.assertEqual(str(self.query("random.wild.example.com").a.rdata), "9.9.9.9")
+        self.store.apply([('delete', "new.example.com")])
+        self.assertEqual(self.query("new.example.com").header.rcode, RCODE.NXDOMAIN)
+        self.store.load()
+        self.assertTrue(self.filter.missing("new.example.com"))
+
+    def test_background_rebuild(self):
+        background = server.NegativeFilter(background=True)
+        background.store = self.store
+        reading, release = threading.Event(), threading.Event()
+        records = self.store.records
+
+        def slow_records():
+            reading.set()
+            release.wait(5)
+            return records()
+
+        with unittest.mock.patch.object(self.store, 'records', slow_records):
+            background.update(None)
+            reading.wait(5)
+            # names are not filtered while the store is read, and names registered meanwhile are kept
+            self.assertEqual(background.stats()['building'], True)
+            self.assertFalse(background.missing("random.example.com"))
+            background.update({"new.example.com"})
+            release.set()
+            for _ in range(100):
+                if background.filter is not None:
+                    break
+                threading.Event().wait(0.05)
+        server.record_store = self.store
+        self.assertFalse(background.missing("new.example.com"))
+        self.assertFalse(background.missing("www.example.com"))
+        self.assertTrue(background.missing("random.example.com"))
+
+    def test_other_store_is_not_filtered(self):
+        server.record_store = RecordStore(os.path.join(self.tmp_dir.name, "other.p"))
+        self.assertFalse(self.filter.missing("random.example.com"))
+
+
+class ResponseCacheTestCase(RecordStoreTestCaseBase):
+
+    def setUp(self):
+        super().setUp()
+        self.cache = server.response_cache
+        self.hits, self.misses = self.cache.hits, self.cache.misses
+
+    def query(self, name, qtype="A"):
+        query = DNSRecord.question(name, qtype)
+        response = handle_dns_client(query.pack())[0]
+        reply = DNSRecord.parse(response)
+        self.assertEqual(reply.header.id, query.header.id)
+        return reply
+
+    def test_hit_patches_id_and_question_case(self):
+        self.store.apply([('add', DNSResourceRecord("www.google.com", "IN", "A", "1.2.3.4"))])
+        self.query("www.google.com")
+        reply = self.query("WWW.Google.com")
+        self.assertEqual(self.cache.hits - self.hits, 1)
+        self.assertEqual(self.cache.misses - self.misses, 1)
+        self.assertEqual(str(reply.q.qname), "WWW.Google.com.")
+        self.assertEqual(str(reply.a.rdata), "1.2.3.4")
+
+    def test_nxdomain_is_cached_and_invalidated(self):
+        self.assertEqual(self.query("www.google.com").header.rcode, RCODE.NXDOMAIN)
+        self.assertEqual(self.query("www.google.com").header.rcode, RCODE.NXDOMAIN)
+        self.assertEqual(self.cache.hits - self.hits, 1)
+        self.assertTrue(handle_domain_registration("www.google.com IN A 1.2.3.4"))
+        self.assertEqual(str(self.query("www.google.com").a.rdata), "1.2.3.4")
+
+    def test_cname_target_change_invalidates(self):
+        self.store.apply([('add', DNSResourceRecord("www.google.com", "IN", "CNAME", "google.com")),
+                          ('add', DNSResourceRecord("google.com", "IN", "A", "1.2.3.4"))])
+        self.assertEqual(str(self.query("www.google.com").rr[1].rdata), "1.2.3.4")
+        self.store.apply([('replace', DNSResourceRecord("google.com", "IN", "A", "5.6.7.8"))])
+        self.assertEqual(str(self.query("www.google.com").rr[1].rdata), "5.6.7.8")
+
+    def test_query_between_the_invalidations(self):
+        self.store.apply([('add', DNSResourceRecord("www.example.com", "IN", "A", "1.1.1.1"))])
+        self.assertEqual(str(self.query("www.example.com").a.rdata), "1.1.1.1")
+        invalidated = []
+
+        def invalidate(cache):
+            original = cache.invalidate
+
+            def invalidate_then_query(names):
+                original(names)
+                invalidated.append(cache)
+                if len(invalidated) == 1:
+                    # a query served after the first cache is invalidated and before the second one
+                    self.query("www.example.com")
+            return unittest.mock.patch.object(cache, 'invalidate', invalidate_then_query)
+
+        with invalidate(server.response_cache), invalidate(server.cname_chains):
+            self.store.apply([('replace', DNSResourceRecord("www.example.com", "IN", "A", "2.2.2.2"))])
+        self.assertEqual(len(invalidated), 2)
+        self.assertEqual(str(self.query("www.example.com").a.rdata), "2.2.2.2")
+
+    def test_bounded_size(self):
+        cache = server.ResponseCache(2)
+        for index in range(3):
+            cache.put(("host%d" % index, 1, 1), b"", {"host%d" % index}, cache.version)
+        self.assertEqual(len(cache), 2)
+        self.assertIsNone(cache.get(("host0", 1, 1)))
+
+    def test_stale_put_is_dropped(self):
+        cache = server.ResponseCache(2)
+        version = cache.version
+        cache.invalidate({"host0"})
+        cache.put(("host0", 1, 1), b"", {"host0"}, version)
+        self.assertEqual(len(cache), 0)
+
+
+class AsyncioEngineTestCase(RecordStoreTestCaseBase):
+
+    def start_server(self, server_class, handler_class):
+        dns_server = server_class(('127.0.0.1', 0), handler_class)
+        threading.Thread(target=dns_server.serve_forever, daemon=True).start()
+        self.addCleanup(dns_server.shutdown)
+        return dns_server.server_address
+
+    def setUp(self):
+        super().setUp()
+        self.store.apply([('add', DNSResourceRecord("www.google.com", "IN", "A", "1.2.3.4"))])
+
+    def test_udp(self):
+        address = self.start_server(server.AsyncioUDPServer, server.AsyncioUDPRequestHandler)
+        query = DNSRecord.question("www.google.com", "A")
+        with socket.socket(socket.AF_INET, socket.SOCK_DGRAM) as client:
+            client.settimeout(5)
+            client.sendto(query.pack(), address)
+            reply = DNSRecord.parse(client.recv(512))
+        self.assertEqual(reply.header.id, query.header.id)
+        self.assertEqual(str(reply.a.rdata), "1.2.3.4")
+
+    def test_tcp_several_queries_per_connection(self):
+        address = self.start_server(server.AsyncioTCPServer, server.AsyncioTCPRequestHandler)
+        with socket.create_connection(address, timeout=5) as client:
+            for name in ["www.google.com", "missing.google.com"]:
+                query = DNSRecord.question(name, "A").pack()
+                client.sendall(struct.pack('>H', len(query)) + query)
+                size = struct.unpack('>H', client.recv(2))[0]
+                reply = DNSRecord.parse(client.recv(size))
+                self.assertEqual(reply.q.qname, name)
+
+
+def exit_worker(position):
+    pass
+
+
+class WorkersTestCase(unittest.TestCase):
+
+    def test_reuse_port_servers_share_port(self):
+        first = server.ReusePortPooledUDPServer(('127.0.0.1', 0), server.UDPRequestHandler)
+        self.addCleanup(first.server_close)
+        second = server.ReusePortAsyncioUDPServer(first.server_address, server.AsyncioUDPRequestHandler)
+        self.addCleanup(second.server_close)
+        self.assertEqual(first.server_address, second.server_address)
+
+    def test_supervisor_restarts_dead_workers(self):
+        supervisor = server.WorkerSupervisor(2, exit_worker, interval=0.05)
+        supervisor.start()
+        self.addCleanup(supervisor.stop)
+        for _ in range(100):
+            if supervisor.restarts >= 2:
+                break
+            threading.Event().wait(0.05)
+        self.assertGreaterEqual(supervisor.restarts, 2)
+        self.assertEqual(len(supervisor.workers), 2)
+
+
+class FastPathParserTestCase(RecordStoreTestCaseBase):
+
+    def test_standard_query(self):
+        query = DNSRecord.question("WWW.Google.com", "AAAA")
+        question = server.parse_question(query.pack())
+        self.assertEqual(question.id, query.header.id)
+        self.assertEqual(question.labels, [b"WWW", b"Google", b"com"])
+        self.assertEqual(question.key, ("www.google.com", 28, 1))
+        self.assertEqual(question.end, len(query.pack()))
+
+    def test_query_with_edns(self):
+        query = DNSRecord.question("www.google.com", "A")
+        query.add_ar(EDNS0(udp_len=1232))
+        question = server.parse_question(query.pack())
+        self.assertEqual(question.key, ("www.google.com", 1, 1))
+
+    def test_unusual_messages_fall_back(self):
+        multiple = DNSRecord.question("www.google.com", "A")
+        multiple.add_question(DNSRecord.question("mail.google.com", "A").q)
+        response = DNSRecord.question("www.google.com", "A").reply()
+        escaped = DNSRecord.question("we\\.ird.google.com", "A")
+        for message in [multiple.pack(), response.pack(), escaped.pack(), b"\x00" * 16,
+                        DNSRecord.question("www.google.com", "A").pack() + b"\x00"]:
+            self.assertIsNone(server.parse_question(message))
+
+    def test_fast_path_answer_matches_dnslib(self):
+        self.store.apply([('add', DNSResourceRecord("www.google.com", "IN", "A", "1.2.3.4"))])
+        for name in ["www.google.com", "missing.google.com"]:
+            query = DNSRecord.question(name, "A")
+            server.response_cache.clear()
+            fast_answer = handle_dns_client(query.pack())[0]
+            server.response_cache.clear()
+            self.assertEqual(fast_answer, server.db_lookup(DNSRecord.parse(query.pack())))
+
+    def test_cached_answer_echoes_question(self):
+        self.store.apply([('add', DNSResourceRecord("www.google.com", "IN", "A", "1.2.3.4"))])
+        handle_dns_client(DNSRecord.question("www.google.com", "A").pack())
+        query = DNSRecord.question("wWw.GOOGLE.com", "A")
+        reply = DNSRecord.parse(handle_dns_client(query.pack())[0])
+        self.assertEqual(reply.header.id, query.header.id)
+        self.assertEqual(str(reply.q.qname), "wWw.GOOGLE.com.")
+        self.assertEqual(str(reply.a.rdata), "1.2.3.4")
+
+
+class HandlerPoolTestCase(RecordStoreTestCaseBase):
+
+    def setUp(self):
+        super().setUp()
+        self.store.apply([('add', DNSResourceRecord("www.google.com", "IN", "A", "1.2.3.4"))])
+        self.dns_server = server.PooledUDPServer(('127.0.0.1', 0), server.UDPRequestHandler)
+        self.addCleanup(self.dns_server.server_close)
+        self.client = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self.client.settimeout(5)
+        self.addCleanup(self.client.close)
+
+    def serve(self):
+        threading.Thread(target=self.dns_server.serve_forever, daemon=True).start()
+        self.addCleanup(self.dns_server.shutdown)
+
+    def test_pool_answers(self):
+        self.serve()
+        query = DNSRecord.question("www.google.com", "A")
+        self.client.sendto(query.pack(), self.dns_server.server_address)
+        reply = DNSRecord.parse(self.client.recv(512))
+        self.assertEqual(str(reply.a.rdata), "1.2.3.4")
+        self.assertEqual(self.dns_server.stats()['queue_depth'], 0)
+
+    def shed(self, policy):
+        # a full queue with no handler thread consuming it
+        self.dns_server.overload_policy = policy
+        self.dns_server.requests = queue.Queue(1)
+        self.dns_server.requests.put(None)
+        query = DNSRecord.question("www.google.com", "A")
+        self.client.bind(('127.0.0.1', 0))
+        self.dns_server.process_request((query.pack(), self.dns_server.socket), self.client.getsockname())
+        return query
+
+    def test_overload_drop(self):
+        self.shed('drop')
+        self.assertEqual(self.dns_server.dropped, 1)
+        self.assertEqual(self.dns_server.stats()['queue_depth'], 1)
+
+    def test_overload_servfail(self):
+        query = self.shed('servfail')
+        reply = DNSRecord.parse(self.client.recv(512))
+        self.assertEqual(self.dns_server.rejected, 1)
+        self.assertEqual(reply.header.id, query.header.id)
+        self.assertEqual(reply.header.rcode, RCODE.SERVFAIL)
+        self.assertEqual(reply.q, query.q)
+
+    def test_error_response_ignores_responses(self):
+        response = DNSRecord.question("www.google.com", "A").reply().pack()
+        self.assertIsNone(server.error_response(response, RCODE.REFUSED))
+
+
+class EdnsTestCase(RecordStoreTestCaseBase):
+
+    def setUp(self):
+        super().setUp()
+        # about 900 bytes of TXT records: over 512 bytes, under the 1232 bytes EDNS0 answers
+        self.store.apply([('add', DNSResourceRecord("txt.google.com", "IN", "TXT", "%d=%s" % (i, "x" * 100)))
+                          for i in range(8)])
+
+    def query(self, edns=None, udp=True, name="txt.google.com", qtype="TXT"):
+        query = DNSRecord.question(name, qtype)
+        if edns is not None:
+            query.add_ar(edns)
+        packets = handle_dns_client(query.pack(), udp)
+        self.assertEqual(len(packets), 1)
+        return packets[0], DNSRecord.parse(packets[0])
+
+    def test_udp_answers_are_truncated(self):
+        packed, reply = self.query()
+        self.assertLessEqual(len(packed), 512)
+        self.assertEqual((reply.header.tc, reply.rr, reply.ar), (1, [], []))
+        self.assertEqual(str(reply.q.qname), "txt.google.com.")
+        packed, reply = self.query(EDNS0(udp_len=600))
+        self.assertLessEqual(len(packed), 600)
+        self.assertEqual((reply.header.tc, reply.rr, reply.ar[0].rtype), (1, [], QTYPE.OPT))
+
+    def test_edns_answers(self):
+        packed, reply = self.query(EDNS0(udp_len=4096))
+        self.assertEqual((reply.header.tc, len(reply.rr)), (0, 8))
+        self.assertEqual([(rr.rtype, rr.rclass, rr.ttl) for rr in reply.ar], [(QTYPE.OPT, server.EDNS_UDP_SIZE, 0)])
+        # the cached answer serves clients without EDNS0 and TCP clients
+        packed, reply = self.query(udp=False)
+        self.assertEqual((reply.header.tc, len(reply.rr), reply.ar), (0, 8, []))
+        packed, reply = self.query()
+        self.assertEqual(reply.header.tc, 1)
+
+    def test_small_answers(self):
+        self.store.apply([('add', DNSResourceRecord("www.google.com", "IN", "A", "1.2.3.4"))])
+        packed, reply = self.query(EDNS0(udp_len=512), name="www.google.com", qtype="A")
+        self.assertEqual((reply.header.tc, str(reply.a.rdata), reply.ar[0].rtype), (0, "1.2.3.4", QTYPE.OPT))
+        packed, reply = self.query(EDNS0(), name="missing.google.com")
+        self.assertEqual((reply.header.rcode, reply.ar[0].rtype), (RCODE.NXDOMAIN, QTYPE.OPT))
+
+    def test_unsupported_version(self):
+        packed, reply = self.query(EDNS0(version=1, udp_len=4096))
+        self.assertEqual((reply.header.rcode, reply.rr), (0, []))
+        self.assertEqual(reply.ar[0].ttl >> 24, 1)
+
+    def test_parsed_requests(self):
+        query = DNSRecord.question("txt.google.com", "TXT")
+        query.add_ar(EDNS0(udp_len=4096))
+        # an additional record besides the OPT record takes the full parser
+        query.add_ar(RR("extra.google.com", QTYPE.A, rdata=A("1.2.3.4")))
+        self.assertIsNone(server.parse_question(query.pack()))
+        reply = DNSRecord.parse(handle_dns_client(query.pack(), True)[0])
+        self.assertEqual((reply.header.tc, len(reply.rr), reply.ar[0].rclass), (0, 8, server.EDNS_UDP_SIZE))
+
+
+class MultipleQuestionsTestCase(RecordStoreTestCaseBase):
+
+    def setUp(self):
+        super().setUp()
+        self.store.apply([('add', DNSResourceRecord("www.google.com", "IN", "A", "1.2.3.4")),
+                          ('add', DNSResourceRecord("mail.google.com", "IN", "TXT", "abc=def")),
+                          ('add', DNSResourceRecord("alias.google.com", "IN", "CNAME", "www.google.com"))])
+
+    def query(self, *questions, udp=False):
+        query = DNSRecord()
+        for name, qtype in questions:
+            query.add_question(DNSQuestion(name, getattr(QTYPE, qtype)))
+        packets = handle_dns_client(query.pack(), udp)
+        self.assertEqual(len(packets), 1)
+        reply = DNSRecord.parse(packets[0])
+        self.assertEqual((reply.header.id, reply.questions), (query.header.id, query.questions))
+        return reply
+
+    def test_one_response(self):
+        reply = self.query(("www.google.com", "A"), ("mail.google.com", "TXT"), ("alias.google.com", "A"),
+                           ("missing.google.com", "A"), ("www.google.com", "A"))
+        self.assertEqual(reply.header.rcode, RCODE.NOERROR)
+        self.assertEqual([(str(rr.rname), str(rr.rdata)) for rr in reply.rr],
+                         [("www.google.com.", "1.2.3.4"), ("mail.google.com.", '"abc=def"'),
+                          ("alias.google.com.", "www.google.com."), ("www.google.com.", "1.2.3.4")])
+
+    def test_rcode(self):
+        self.assertEqual(self.query(("a.google.com", "A"), ("b.google.com", "A")).header.rcode, RCODE.NXDOMAIN)
+        self.assertEqual(self.query(("a.google.com", "A"), ("www.google.com", "TXT")).header.rcode, RCODE.NOERROR)
+        self.store.apply([('add', DNSResourceRecord("loop.google.com", "IN", "CNAME", "loop.google.com"))])
+        reply = self.query(("www.google.com", "A"), ("loop.google.com", "A"))
+        self.assertEqual((reply.header.rcode, len(reply.rr)), (RCODE.SERVFAIL, 1))
+
+    def test_truncation_keeps_the_questions(self):
+        self.store.apply([('add', DNSResourceRecord("txt.google.com", "IN", "TXT", "%d=%s" % (i, "x" * 100)))
+                          for i in range(8)])
+        reply = self.query(("txt.google.com", "TXT"), ("www.google.com", "A"), udp=True)
+        self.assertEqual((reply.header.tc, reply.rr), (1, []))
+
+
+class RateLimitTestCase(RecordStoreTestCaseBase):
+
+    def setUp(self):
+        super().setUp()
+        self.store.apply([('add', DNSResourceRecord("www.google.com", "IN", "A", "1.2.3.4"))])
+        self.store.apply([('add', DNSResourceRecord("mail.google.com", "IN", "A", "1.2.3.4"))])
+        self.limiter = server.ResponseRateLimiter(rate=1, slip=2, window=3)
+
+    def answer(self, name, address="10.0.0.1", limiter=None):
+        data = DNSRecord.question(name, "A").pack()
+        return (limiter or self.limiter).limit((address, 5353), data, handle_dns_client(data))
+
+    def test_burst_then_slip_and_drop(self):
+        for _ in range(3):
+            self.assertEqual(len(DNSRecord.parse(self.answer("www.google.com")[0]).rr), 1)
+        self.assertEqual(self.answer("www.google.com"), [])
+        reply = DNSRecord.parse(self.answer("www.google.com")[0])
+        self.assertEqual((reply.header.tc, reply.rr, str(reply.q.qname)), (1, [], "www.google.com."))
+        self.assertEqual(self.answer("www.google.com"), [])
+        stats = self.limiter.stats()
+        self.assertEqual((stats['responses'], stats['limited'], stats['slipped'], stats['dropped']), (6, 3, 1, 2))
+
+    def test_buckets(self):
+        self.limiter.slip = 0
+        for _ in range(3):
+            self.answer("www.google.com")
+        # same /24 and response: same bucket
+        self.assertEqual(self.answer("www.google.com", "10.0.0.2"), [])
+        self.assertEqual(len(self.answer("www.google.com", "10.0.1.1")), 1)
+        self.assertEqual(len(self.answer("mail.google.com")), 1)
+        # every NXDOMAIN of a prefix shares a bucket
+        for name in ["a.google.com", "b.google.com", "c.google.com"]:
+            self.assertEqual(len(self.answer(name, "::1")), 1)
+        self.assertEqual(self.answer("d.google.com", "::2"), [])
+
+    def test_refill(self):
+        key = 12345
+        for _ in range(3):
+            self.assertTrue(self.limiter._take(key, 100.0))
+        self.assertFalse(self.limiter._take(key, 100.5))
+        self.assertTrue(self.limiter._take(key, 101.5))
+        self.assertFalse(self.limiter._take(key, 101.5))
+
+    def test_table_is_bounded(self):
+        limiter = server.ResponseRateLimiter(rate=1, size=16)
+        for client in range(1000):
+            self.answer("www.google.com", "10.%d.%d.1" % (client // 256, client % 256), limiter)
+        self.assertEqual(len(limiter.keys), 16)
+        self.assertEqual(limiter.stats()['evictions'], 1000 - 16)
+
+    def test_disabled(self):
+        limiter = server.ResponseRateLimiter()
+        for _ in range(10):
+            self.assertEqual(len(self.answer("www.google.com", limiter=limiter)), 1)
+
+    def test_udp_answers_are_limited(self):
+        server.response_limiter.configure(1, slip=1, window=1)
+        self.addCleanup(server.response_limiter.configure, 0)
+        dns_server = server.PooledUDPServer(('127.0.0.1', 0), server.UDPRequestHandler)
+        self.addCleanup(dns_server.server_close)
+        threading.Thread(target=dns_server.serve_forever, daemon=True).start()
+        self.addCleanup(dns_server.shutdown)
+        client = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        client.settimeout(5)
+        self.addCleanup(client.close)
+        replies = []
+        for _ in range(2):
+            client.sendto(DNSRecord.question("www.google.com", "A").pack(), dns_server.server_address)
+            replies.append(DNSRecord.parse(client.recv(512)))
+        self.assertEqual([(reply.header.tc, len(reply.rr)) for reply in replies], [(0, 1), (1, 0)])
+        self.assertEqual(server.server_metrics.snapshot()['rate_limit']['slipped'], 1)
+
+
+class StubUpstream:
+
+    # upstream resolver answering A queries on UDP and TCP on the same port: names starting with "missing" get
+    # NXDOMAIN and names starting with "big" get a truncated UDP answer
+    def __init__(self, ttl=300, delay=0):
+        self.ttl = ttl
+        self.delay = delay
+        self.queries = []
+        self.connections = 0
+        while True:
+            self.udp = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+            self.udp.bind(('127.0.0.1', 0))
+            self.address = self.udp.getsockname()
+            self.tcp = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+            try:
+                self.tcp.bind(self.address)
+                break
+            except OSError:
+                self.udp.close()
+                self.tcp.close()
+        self.tcp.listen()
+        threading.Thread(target=self.serve_udp, daemon=True).start()
+        threading.Thread(target=self.serve_tcp, daemon=True).start()
+
+    def answer(self, data, tcp):
+        query = DNSRecord.parse(data)
+        name = str(query.q.qname).rstrip('.')
+        self.queries.append((name, 'tcp' if tcp else 'udp'))
+        time.sleep(self.delay)
+        reply = query.reply()
+        if name.startswith("missing"):
+            reply.header.rcode = RCODE.NXDOMAIN
+        elif name.startswith("big") and not tcp:
+            reply.header.tc = 1
+        else:
+            reply.add_answer(RR(name, QTYPE.A, rdata=A("10.0.0.1"), ttl=self.ttl))
+        return reply.pack()
+
+    def serve_udp(self):
+        while True:
+            try:
+                data, address = self.udp.recvfrom(65535)
+                self.udp.sendto(self.answer(data, False), address)
+            except OSError:
+                return
+
+    def serve_tcp(self):
+        while True:
+            try:
+                connection, _ = self.tcp.accept()
+            except OSError:
+                return
+            self.connections += 1
+            threading.Thread(target=self.serve_connection, args=(connection,), daemon=True).start()
+
+    def serve_connection(self, connection):
+        with connection:
+            while True:
+                size = connection.recv(2)
+                if len(size) < 2:
+                    return
+                response = self.answer(connection.recv(struct.unpack('>H', size)[0]), True)
+                connection.sendall(struct.pack('>H', len(response)) + response)
+
+    def close(self):
+        self.udp.close()
+        self.tcp.close()
+
+
+class ForwarderTestCase(RecordStoreTestCaseBase):
+
+    def setUp(self):
+        super().setUp()
+        self.store.apply([('add', DNSResourceRecord("www.google.com", "IN", "A", "1.2.3.4"))])
+        self.upstream = StubUpstream()
+        self.now = 0
+        self.previous_forwarder = server.forwarder
+        self.set_forwarder([self.upstream.address])
+
+    def tearDown(self):
+        server.forwarder.close()
+        server.forwarder = self.previous_forwarder
+        self.upstream.close()
+        super().tearDown()
+
+    def set_forwarder(self, upstreams, **kwargs):
+        if server.forwarder is not self.previous_forwarder:
+            server.forwarder.close()
+        server.forwarder = server.Forwarder(upstreams, timeout=1, **kwargs)
+        server.forwarder.clock = lambda: self.now
+
+    def query(self, name, qtype="A", udp=False):
+        query = DNSRecord.question(name, qtype)
+        packets = handle_dns_client(query.pack(), udp)
+        self.assertEqual(len(packets), 1)
+        reply = DNSRecord.parse(packets[0])
+        self.assertEqual((reply.header.id, reply.q), (query.header.id, query.q))
+        return reply
+
+    def test_forwards_missing_names(self):
+        reply = self.query("example.org")
+        self.assertEqual((reply.header.rcode, str(reply.a.rdata), reply.a.ttl), (RCODE.NOERROR, "10.0.0.1", 300))
+        self.assertEqual(self.query("missing.example.org").header.rcode, RCODE.NXDOMAIN)
+        # registered names, with or without records of the queried type, are answered locally
+        self.assertEqual(str(self.query("www.google.com").a.rdata), "1.2.3.4")
+        reply = self.query("www.google.com", "AAAA")
+        self.assertEqual((reply.header.rcode, reply.rr), (RCODE.NOERROR, []))
+        self.assertEqual(self.upstream.queries, [("example.org", "udp"), ("missing.example.org", "udp")])
+
+    def test_cached_answers_count_down(self):
+        self.query("Example.ORG")
+        self.now = 100
+        reply = self.query("EXAMPLE.org")
+        self.assertEqual((str(reply.q.qname), reply.a.ttl), ("EXAMPLE.org.", 200))
+        self.assertEqual(len(self.upstream.queries), 1)
+        # expired answers are queried again
+        self.now = 300
+        self.assertEqual(self.query("example.org").a.ttl, 300)
+        self.assertEqual(len(self.upstream.queries), 2)
+
+    def test_concurrent_queries_are_coalesced(self):
+        self.upstream.delay = 0.2
+        threads = [threading.Thread(target=self.query, args=("example.org",)) for _ in range(5)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(self.upstream.queries, [("example.org", "udp")])
+        self.assertEqual(server.forwarder.stats()['coalesced'], 4)
+
+    def test_prefetch_before_expiry(self):
+        self.query("example.org")
+        self.now = 280
+        self.assertEqual(self.query("example.org").a.ttl, 20)
+        server.forwarder.prefetcher.shutdown(wait=True)
+        self.assertEqual(len(self.upstream.queries), 2)
+        # the refreshed answer is served without waiting for the upstream
+        self.now = 400
+        self.assertEqual(self.query("example.org").a.ttl, 180)
+        self.assertEqual(len(self.upstream.queries), 2)
+
+    def test_truncated_answers_use_tcp(self):
+        self.assertEqual(str(self.query("big.example.org").a.rdata), "10.0.0.1")
+        self.assertEqual(str(self.query("big2.example.org").a.rdata), "10.0.0.1")
+        self.assertEqual([transport for _, transport in self.upstream.queries], ["udp", "tcp", "udp", "tcp"])
+        # one UDP socket and one TCP connection, both reused
+        self.assertEqual((server.forwarder.stats()['sockets_opened'], self.upstream.connections), (2, 1))
+
+    def test_failover(self):
+        dead = StubUpstream()
+        dead.close()
+        self.set_forwarder([dead.address, self.upstream.address])
+        self.assertEqual(str(self.query("example.org").a.rdata), "10.0.0.1")
+        self.set_forwarder([dead.address])
+        reply = self.query("example.org")
+        self.assertEqual((reply.header.rcode, reply.rr), (RCODE.SERVFAIL, []))
+        self.assertEqual(server.forwarder.stats()['failures'], 1)
+
+    def check_local_answers_while_forwarding(self, server_class, handler_class):
+        self.upstream.delay = 0.2
+        self.set_forwarder([self.upstream.address], threads=2)
+        dns_server = server_class(('127.0.0.1', 0), handler_class)
+        dns_server.pool_size = 2
+        threading.Thread(target=dns_server.serve_forever, daemon=True).start()
+        if not isinstance(dns_server, server.AsyncioServer):
+            # asyncio servers close once stopped
+            self.addCleanup(dns_server.server_close)
+        self.addCleanup(dns_server.shutdown)
+        client = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self.addCleanup(client.close)
+        client.settimeout(5)
+        for index in range(8):
+            client.sendto(DNSRecord.question("host%d.example.org" % index, "A").pack(), dns_server.server_address)
+        query = DNSRecord.question("www.google.com", "A")
+        started = time.monotonic()
+        client.sendto(query.pack(), dns_server.server_address)
+        while True:
+            reply = DNSRecord.parse(client.recv(65535))
+            if reply.header.id == query.header.id:
+                break
+        # the handlers are not waiting for the upstream
+        self.assertLess(time.monotonic() - started, 0.3)
+        self.assertEqual(str(reply.a.rdata), "1.2.3.4")
+        for _ in range(8):
+            self.assertEqual(DNSRecord.parse(client.recv(65535)).header.rcode, RCODE.NOERROR)
+
+    def test_local_answers_while_forwarding(self):
+        self.check_local_answers_while_forwarding(server.PooledUDPServer, server.UDPRequestHandler)
+
+    def test_local_answers_while_forwarding_asyncio(self):
+        self.check_local_answers_while_forwarding(server.AsyncioUDPServer, server.AsyncioUDPRequestHandler)
+
+    def test_pending_forwards_are_bounded(self):
+        self.upstream.delay = 0.3
+        self.set_forwarder([self.upstream.address], threads=1, queue_size=1)
+        responses = queue.Queue()
+        for name in ["a.example.org", "b.example.org"]:
+            server.serve_query(DNSRecord.question(name, "A").pack(), ('127.0.0.1', 5300), responses.put)
+        # the second question is shed straight away, the first one answered once the upstream replies
+        reply = DNSRecord.parse(responses.get(timeout=1))
+        self.assertEqual((str(reply.q.qname), reply.header.rcode), ("b.example.org.", RCODE.SERVFAIL))
+        reply = DNSRecord.parse(responses.get(timeout=5))
+        self.assertEqual((str(reply.q.qname), str(reply.a.rdata)), ("a.example.org.", "10.0.0.1"))
+        self.assertEqual(server.forwarder.stats()['shed'], 1)
+
+    def test_served_zones_are_not_forwarded(self):
+        server.zone_transfers.configure(["google.com"])
+        self.addCleanup(server.zone_transfers.configure, [])
+        self.assertEqual(self.query("missing.google.com").header.rcode, RCODE.NXDOMAIN)
+        self.assertEqual(self.query("missing.google.com", udp=True).header.rcode, RCODE.NXDOMAIN)
+        self.assertEqual(str(self.query("example.org").a.rdata), "10.0.0.1")
+        self.assertEqual(self.upstream.queries, [("example.org", "udp")])
+
+    def test_cache_size(self):
+        self.set_forwarder([self.upstream.address], cache_size=2)
+        for name in ("a.example.org", "b.example.org", "a.example.org", "c.example.org", "a.example.org"):
+            self.query(name)
+        self.assertEqual([name for name, _ in self.upstream.queries],
+                         ["a.example.org", "b.example.org", "c.example.org"])
+        self.query("b.example.org")
+        self.assertEqual(len(self.upstream.queries), 4)
+
+
+class ZoneTransferTestCase(RecordStoreTestCaseBase):
+
+    client = ('127.0.0.1', 5300)
+
+    def setUp(self):
+        super().setUp()
+        server.zone_transfers.configure(["example.com"])
+        self.addCleanup(server.zone_transfers.configure, [])
+        self.store.apply([('add', DNSResourceRecord("www.example.com", "IN", "A", "1.2.3.4")),
+                          ('add', DNSResourceRecord("mail.example.com", "IN", "TXT", "abc=def")),
+                          ('add', DNSResourceRecord("www.google.com", "IN", "A", "5.6.7.8"))])
+
+    def query(self, qtype, serial=None, udp=False, client=client):
+        query = DNSRecord.question("example.com", qtype)
+        if serial is not None:
+            query.add_auth(server.zone_transfers.soa("example.com", serial))
+        return [DNSRecord.parse(message) for message in handle_dns_client(query.pack(), udp, client)]
+
+    def records(self, messages):
+        return [(str(rr.rname), QTYPE[rr.rtype], rr.rdata.times[0] if rr.rtype == QTYPE.SOA else str(rr.rdata))
+                for message in messages for rr in message.rr]
+
+    def test_soa(self):
+        reply = self.query("SOA")[0]
+        self.assertEqual((reply.header.aa, reply.a.rdata.times[0]), (1, self.store.snapshot().serial))
+        self.store.apply([('delete', "mail.example.com")])
+        self.assertEqual(self.query("SOA")[0].a.rdata.times[0], 4)
+        # names outside the transfer zones have no SOA
+        reply = DNSRecord.parse(handle_dns_client(DNSRecord.question("google.com", "SOA").pack())[0])
+        self.assertEqual((reply.header.rcode, reply.rr), (RCODE.NOERROR, []))
+
+    def test_axfr(self):
+        self.assertEqual(self.records(self.query("AXFR")),
+                         [("example.com.", "SOA", 3), ("www.example.com.", "A", "1.2.3.4"),
+                          ("mail.example.com.", "TXT", '"abc=def"'), ("example.com.", "SOA", 3)])
+
+    def test_axfr_streams_messages(self):
+        self.store.apply([('add', DNSResourceRecord("host%d.example.com" % position, "IN", "A", "10.0.0.1"))
+                          for position in range(3000)])
+        query = DNSRecord.question("example.com", "AXFR")
+        messages = handle_dns_client(query.pack(), False, self.client)
+        self.assertNotIsInstance(messages, list)
+        messages = list(messages)
+        self.assertGreater(len(messages), 2)
+        self.assertTrue(all(len(message) <= server.TRANSFER_MESSAGE_SIZE for message in messages))
+        replies = [DNSRecord.parse(message) for message in messages]
+        self.assertTrue(all(reply.header.id == query.header.id and reply.q == query.q for reply in replies))
+        records = self.records(replies)
+        self.assertEqual((records[0], records[-1], len(records)), (records[-1], ("example.com.", "SOA", 3003), 3004))
+
+    def test_ixfr(self):
+        serial = self.store.snapshot().serial
+        self.store.apply([('replace', DNSResourceRecord("www.example.com", "IN", "A", "9.9.9.9")),
+                          ('add', DNSResourceRecord("new.example.com", "IN", "A", "1.1.1.1")),
+                          ('add', DNSResourceRecord("other.google.com", "IN", "A", "1.1.1.1")),
+                          ('add', DNSResourceRecord("gone.example.com", "IN", "A", "1.1.1.1")),
+                          ('delete', "gone.example.com")])
+        self.assertEqual(self.records(self.query("IXFR", serial)),
+                         [("example.com.", "SOA", 8), ("example.com.", "SOA", 3), ("www.example.com.", "A", "1.2.3.4"),
+                          ("example.com.", "SOA", 8), ("www.example.com.", "A", "9.9.9.9"),
+                          ("new.example.com.", "A", "1.1.1.1"), ("example.com.", "SOA", 8)])
+        # up to date clients, as well as UDP clients, get the current SOA
+        self.assertEqual(self.records(self.query("IXFR", 8)), [("example.com.", "SOA", 8)])
+        self.assertEqual(self.records(self.query("IXFR", serial, udp=True)), [("example.com.", "SOA", 8)])
+
+    def test_ixfr_history(self):
+        serial = self.store.snapshot().serial
+        self.store.apply([('add', DNSResourceRecord("new.example.com", "IN", "A", "1.1.1.1"))])
+        self.store.compact()
+        self.assertEqual(len(self.records(self.query("IXFR", serial))), 5)
+        # the serial of the records is kept by the journal
+        store = RecordStore(self.records_path)
+        store.load()
+        self.assertEqual(store.snapshot().serial, 4)
+        # clients older than the history get the whole zone
+        self.store.changes.clear()
+        self.assertEqual(self.records(self.query("IXFR", serial))[1:-1],
+                         [("www.example.com.", "A", "1.2.3.4"), ("mail.example.com.", "TXT", '"abc=def"'),
+                          ("new.example.com.", "A", "1.1.1.1")])
+
+    def test_errors(self):
+        self.assertEqual(self.query("AXFR", client=('192.0.2.1', 5300))[0].header.rcode, RCODE.REFUSED)
+        self.assertEqual(self.query("AXFR", udp=True)[0].header.rcode, RCODE.FORMERR)
+        self.assertEqual(self.query("IXFR")[0].header.rcode, RCODE.FORMERR)
+        reply = DNSRecord.parse(handle_dns_client(DNSRecord.question("google.com", "AXFR").pack(), False,
+                                                  self.client)[0])
+        self.assertEqual(reply.header.rcode, RCODE.NOTAUTH)
+
+    def test_tcp_transfers(self):
+        self.store.apply([('add', DNSResourceRecord("host%d.example.com" % position, "IN", "A", "10.0.0.1"))
+                          for position in range(3000)])
+        for server_class, handler_class in ((server.PooledTCPServer, server.TCPRequestHandler),
+                                            (server.AsyncioTCPServer, server.AsyncioTCPRequestHandler)):
+            dns_server = server_class(('127.0.0.1', 0), handler_class)
+            threading.Thread(target=dns_server.serve_forever, daemon=True).start()
+            self.addCleanup(dns_server.shutdown)
+            query = DNSRecord.question("example.com", "AXFR").pack()
+            with socket.create_connection(dns_server.server_address, timeout=5) as client, \
+                    client.makefile('rb') as reader:
+                client.sendall(struct.pack('>H', len(query)) + query)
+                records = []
+                while len(records) < 2 or records[-1][1] != "SOA":
+                    size = struct.unpack('>H', reader.read(2))[0]
+                    records.extend(self.records([DNSRecord.parse(reader.read(size))]))
+            self.assertEqual(len(records), 3004)
+
+    def test_notify(self):
+        secondary = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        secondary.bind(('127.0.0.1', 0))
+        secondary.settimeout(5)
+        self.addCleanup(secondary.close)
+        notifier = server.Notifier([secondary.getsockname()])
+        notifier.changed({"www.google.com"})
+        notifier.changed({"www.example.com"})
+        data, address = secondary.recvfrom(512)
+        notify = DNSRecord.parse(data)
+        self.assertEqual((notify.header.opcode, str(notify.q.qname), notify.a.rdata.times[0]),
+                         (OPCODE.NOTIFY, "example.com.", 3))
+        # retried until acknowledged
+        self.assertEqual(secondary.recvfrom(512)[0], data)
+        secondary.sendto(notify.reply().pack(), address)
+        for _ in range(50):
+            if notifier.acknowledged:
+                break
+            time.sleep(0.1)
+        self.assertEqual((notifier.sent, notifier.acknowledged), (2, 1))
+
+
+class PersistentTCPTestCase(RecordStoreTestCaseBase):
+
+    def setUp(self):
+        super().setUp()
+        self.store.apply([('add', DNSResourceRecord("www.google.com", "IN", "A", "1.2.3.4"))])
+        self.dns_server = server.PooledTCPServer(('127.0.0.1', 0), server.TCPRequestHandler)
+        self.dns_server.idle_timeout = 0.5
+        self.dns_server.connections_per_client = 2
+        threading.Thread(target=self.dns_server.serve_forever, daemon=True).start()
+        self.addCleanup(self.dns_server.server_close)
+        self.addCleanup(self.dns_server.shutdown)
+
+    def connect(self):
+        client = socket.create_connection(self.dns_server.server_address, timeout=5)
+        self.addCleanup(client.close)
+        return client
+
+    def read_reply(self, client):
+        reader = client.makefile('rb')
+        self.addCleanup(reader.close)
+        size = struct.unpack('>H', reader.read(2))[0]
+        return DNSRecord.parse(reader.read(size))
+
+    def test_pipelined_queries(self):
+        client = self.connect()
+        queries = [DNSRecord.question(name, "A") for name in ["www.google.com", "missing.google.com"] * 3]
+        stream = b''.join(struct.pack('>H', len(query.pack())) + query.pack() for query in queries)
+        # splitting the stream in the middle of a message
+        client.sendall(stream[:7])
+        client.sendall(stream[7:])
+        replies = {}
+        reader = client.makefile('rb')
+        self.addCleanup(reader.close)
+        for _ in queries:
+            reply = DNSRecord.parse(reader.read(struct.unpack('>H', reader.read(2))[0]))
+            replies[reply.header.id] = reply
+        self.assertEqual(set(replies), set(query.header.id for query in queries))
+        for query in queries:
+            self.assertEqual(replies[query.header.id].q.qname, query.q.qname)
+
+    def test_idle_connection_is_closed(self):
+        client = self.connect()
+        self.assertEqual(client.recv(1), b'')
+
+    def test_connections_per_client(self):
+        clients = [self.connect() for _ in range(3)]
+        self.assertEqual(clients[2].recv(1), b'')
+        query = DNSRecord.question("www.google.com", "A").pack()
+        clients[0].sendall(struct.pack('>H', len(query)) + query)
+        self.assertEqual(str(self.read_reply(clients[0]).a.rdata), "1.2.3.4")
+        self.assertEqual(self.dns_server.refused_connections, 1)
+
+    def test_idle_connections_do_not_hold_handlers(self):
+        self.dns_server.idle_timeout = 5
+        self.dns_server.connections_per_client = self.dns_server.pool_size + 1
+        idle = [self.connect() for _ in range(self.dns_server.pool_size)]
+        # letting the server accept the idle connections first
+        time.sleep(0.2)
+        started = time.perf_counter()
+        client = self.connect()
+        query = DNSRecord.question("www.google.com", "A").pack()
+        client.sendall(struct.pack('>H', len(query)) + query)
+        self.assertEqual(str(self.read_reply(client).a.rdata), "1.2.3.4")
+        self.assertLess(time.perf_counter() - started, 1.0)
+        self.assertEqual(self.dns_server.stats()['connections'], len(idle) + 1)
+
+    def test_max_connections(self):
+        self.dns_server.max_connections = 1
+        clients = [self.connect() for _ in range(2)]
+        self.assertEqual(clients[1].recv(1), b'')
+        self.assertEqual(self.dns_server.refused_connections, 1)
+
+
+class QueryLoggerTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.stream = io.StringIO()
+        self.logger = server.QueryLogger(self.stream, flush_interval=3600)
+        self.query = DNSRecord.question("www.google.com", "AAAA")
+        self.answer = self.query.reply().pack()
+
+    def test_format(self):
+        self.logger.log(("127.0.0.1", 5353), self.query.pack(), [self.answer], 0)
+        self.logger.flush()
+        fields = self.stream.getvalue().split()
+        self.assertEqual(fields[1:5], ["127.0.0.1#5353", "www.google.com", "AAAA", "NOERROR"])
+        self.assertTrue(fields[5].endswith("ms"))
+
+    def test_failed_query_without_answer(self):
+        self.logger.level = 'error'
+        self.logger.log(("127.0.0.1", 5353), self.query.pack(), [self.answer], 0)
+        self.logger.log(("127.0.0.1", 5353), b"garbage", [], 0)
+        self.logger.flush()
+        lines = self.stream.getvalue().splitlines()
+        self.assertEqual(len(lines), 1)
+        self.assertEqual(lines[0].split()[2:5], ["-", "-", "SERVFAIL"])
+
+    def test_off_and_sampling(self):
+        self.logger.level = 'off'
+        self.logger.log(("127.0.0.1", 5353), self.query.pack(), [self.answer], 0)
+        self.logger.level = 'info'
+        self.logger.sample_rate = 0.0
+        self.logger.log(("127.0.0.1", 5353), self.query.pack(), [self.answer], 0)
+        self.logger.flush()
+        self.assertEqual(self.stream.getvalue(), "")
+
+    def test_full_buffer_drops(self):
+        self.logger.queue_size = 2
+        for _ in range(3):
+            self.logger.log(("127.0.0.1", 5353), self.query.pack(), [self.answer], 0)
+        self.assertEqual(self.logger.dropped, 1)
+        self.logger.flush()
+        self.assertEqual(len(self.stream.getvalue().splitlines()), 2)
+
+
+class MetricsTestCase(RecordStoreTestCaseBase):
+
+    def setUp(self):
+        super().setUp()
+        self.store.apply([('add', DNSResourceRecord("www.google.com", "IN", "A", "1.2.3.4"))])
+
+    def test_histogram(self):
+        histogram = server.LatencyHistogram()
+        for seconds in [0.000001] * 98 + [0.001, 1.0]:
+            histogram.observe(seconds)
+        snapshot = histogram.snapshot()
+        self.assertEqual(snapshot['count'], 100)
+        self.assertEqual(snapshot['p50_us'], 2)
+        self.assertEqual(snapshot['p99_us'], 1024)
+
+    def test_stages_and_counters(self):
+        metrics = server.server_metrics
+        before = metrics.snapshot()
+        handle_dns_client(DNSRecord.question("www.google.com", "A").pack())
+        handle_dns_client(DNSRecord.question("www.google.com", "A").pack())
+        handle_dns_client(DNSRecord.question("missing.google.com", "AAAA").pack())
+        after = metrics.snapshot()
+        self.assertEqual(after['queries'] - before['queries'], 3)
+        self.assertEqual(after['qtypes']['A'] - before['qtypes'].get('A', 0), 2)
+        self.assertEqual(after['rcodes']['NXDOMAIN'] - before['rcodes'].get('NXDOMAIN', 0), 1)
+        for stage in ['parse', 'cache', 'lookup', 'pack']:
+            self.assertGreater(after['stages'][stage]['count'], before['stages'].get(stage, {'count': 0})['count'])
+
+    def test_chaos_txt(self):
+        query = DNSRecord.question("stats.server", "TXT", "CH")
+        reply = DNSRecord.parse(handle_dns_client(query.pack())[0])
+        self.assertEqual(reply.header.id, query.header.id)
+        lines = [b"".join(rr.rdata.data).decode() for rr in reply.rr]
+        self.assertTrue(any(line.startswith("queries=") for line in lines))
+        self.assertTrue(any(line.startswith("response_cache.hits=") for line in lines))
+
+    def test_chaos_txt_over_udp(self):
+        full = len(handle_dns_client(DNSRecord.question("stats.server", "TXT", "CH").pack())[0])
+        self.assertGreater(full, server.EDNS_UDP_SIZE)
+        for query, limit in [(DNSRecord.question("stats.server", "TXT", "CH"), server.CLASSIC_UDP_SIZE),
+                             (self.edns_query(4096), server.EDNS_UDP_SIZE)]:
+            response = handle_dns_client(query.pack(), udp=True)[0]
+            self.assertLessEqual(len(response), limit)
+            reply = DNSRecord.parse(response)
+            self.assertEqual(reply.header.tc, 0)
+            lines = [b"".join(rr.rdata.data).decode() for rr in reply.rr]
+            self.assertIn("queries", [line.split("=")[0] for line in lines])
+            self.assertTrue(any(line.startswith("rcodes.") for line in lines))
+
+    def edns_query(self, payload_size):
+        query = DNSRecord.question("stats.server", "TXT", "CH")
+        query.add_ar(EDNS0(udp_len=payload_size))
+        return query
+
+    def test_http_endpoint(self):
+        stats_server = server.start_stats_server(0)
+        self.addCleanup(stats_server.server_close)
+        self.addCleanup(stats_server.shutdown)
+        url = "http://127.0.0.1:%d/stats" % stats_server.server_address[1]
+        with urllib.request.urlopen(url, timeout=5) as response:
+            stats = json.load(response)
+        self.assertIn('stages', stats)
+        self.assertIn('active_handlers', stats)
+
+
+class ColdStartTestCase(unittest.TestCase):
+
+    def test_headless_cold_start(self):
+        with tempfile.TemporaryDirectory() as directory:
+            process, cold_start = benchmark.start_server(directory, benchmark.free_port(), stdout=subprocess.PIPE)
+            benchmark.stop_server(process)
+            output = process.stdout.read().decode()
+            process.stdout.close()
+            self.assertLess(cold_start, benchmark.COLD_START_BUDGET)
+            self.assertIn("Ready: serving records.p", output)
+            # no seed record written
+            self.assertNotIn(server.PERSISTENT_RECORDS, os.listdir(directory))
+
+    def test_import_has_no_cli_dependency(self):
+        code = "import sys, server; print('prompt_toolkit' in sys.modules)"
+        output = subprocess.check_output([sys.executable, '-c', code], cwd=os.path.dirname(benchmark.SERVER_SCRIPT))
+        self.assertEqual(output.strip(), b'False')
+
+    def test_import_has_no_optional_engine_dependency(self):
+        code = "import sys, server; print([name for name in ('asyncio', 'http.server') if name in sys.modules])"
+        output = subprocess.check_output([sys.executable, '-c', code], cwd=os.path.dirname(benchmark.SERVER_SCRIPT))
+        self.assertEqual(output.strip(), b'[]')
+
+
+class BenchmarkTestCase(unittest.TestCase):
+
+    def test_query_names(self):
+        names = benchmark.query_names(benchmark.parse_mix('hit=1,cname=0,miss=0'), 10, 50, seed=1)
+        self.assertEqual(len(names), 50)
+        self.assertTrue(all(name.startswith('host-') for name in names))
+        self.assertEqual(names, benchmark.query_names({'hit': 1.0}, 10, 50, seed=1))
+        with self.assertRaises(ValueError):
+            benchmark.parse_mix('hit=1,bogus=1')
+
+    def test_run_benchmark(self):
+        for protocol in ['udp', 'tcp']:
+            result = benchmark.run_benchmark(20, protocol, clients=1, duration=0.5, queries=200,
+                                             mix='hit=0.5,miss=0.25,cname=0.25')
+            self.assertEqual(result['records'], 22)
+            self.assertEqual(result['errors'], 0)
+            self.assertGreater(result['answered'], 0)
+            self.assertGreater(result['rcodes']['NOERROR'], 0)
+            self.assertGreater(result['rcodes']['NXDOMAIN'], 0)
+            self.assertLessEqual(result['p50_ms'], result['p999_ms'])